@@ -15,7 +15,6 @@
 
 import sys
 import os
-import re
 import syslog
 import signal
 import subprocess
@@ -24,14 +23,28 @@ import datetime
 import traceback
 import pickle
 import shutil
+import errno
+import collections
+import zlib
+import hashlib
+import threading
+import json
+import heapq
+import select
+import re
 from optparse import OptionParser
 
 
 
 afs_servers = ["afs-fs-01.cssd.pitt.edu", "afs-fs-02.cssd.pitt.edu", "afs-fs-03.cssd.pitt.edu"]
 #afs_servers = ["afs-fs-01.cssd.pitt.edu"]
+vos_path = "/usr/sbin/vos"
+bpbackup_command = ["/usr/bin/sudo", "/usr/openv/netbackup/bin/bpbackup", "-p", "DATA-AFS-DUMP", "-L", "/var/log/afs-dump-netbackup.log", "-w"]
 kerberos_keytab = "/usr/local/etc/SOME_ADMIN_PRINCIPAL.keytab"
+auth_failed_file = "/home/afsdumper/afs_backup.auth-failed" # Made by the authentication child when it can't keep us authenticated
+auth_command_timeout = 60 # Seconds each of kinit, aklog, klist and tokens get before they are killed
 auther_pid = -1 # Don't change this
+run_started = int(time.time()) # Ties together the metrics of each server's dumper from this run
 
 
 
@@ -47,11 +60,161 @@ parser.add_option(
     help="Go into debug mode (shows every step of every volume being worked on)"
 )
 
+parser.add_option(
+    "--dumps-per-server",
+    action="store", type="int", dest="dumps_per_server", default=4,
+    help="Number of volumes to dump at once from each server (default: %default)"
+)
+
+parser.add_option(
+    "--dumps-per-partition",
+    action="store", type="int", dest="dumps_per_partition", default=2,
+    help="Number of volumes to dump at once from each /vicep partition of a server (default: %default)"
+)
+
+
+parser.add_option(
+    "--pipeline",
+    action="store_true", dest="pipeline", default=False,
+    help="Hand dumps to NetBackup in batches while later volumes are still dumping and remove each batch once it is backed up, " +
+        "rather than backing up everything once all dumps are done"
+)
+
+parser.add_option(
+    "--batch-volumes",
+    action="store", type="int", dest="batch_volumes", default=500,
+    help="With --pipeline, start backing up a batch once this many dumps are waiting (default: %default)"
+)
+
+parser.add_option(
+    "--batch-gb",
+    action="store", type="float", dest="batch_gb", default=100,
+    help="With --pipeline, start backing up a batch once this many GB of dumps are waiting (default: %default)"
+)
+
+parser.add_option(
+    "--compress-level",
+    action="store", type="int", dest="compress_level", default=6,
+    help="gzip level (1-9) dumps are compressed at as vos writes them, with their sizes and SHA-256 digests kept in a manifest, " +
+        "or 0 to have vos write uncompressed dumps itself (default: %default)"
+)
+
+parser.add_option(
+    "--resume",
+    action="store_true", dest="resume", default=False,
+    help="Carry on from a run which did not finish: volumes its journal shows were dumped are skipped, " +
+        "and its lock file is taken over if the run is no longer going"
+)
+
+parser.add_option(
+    "--order",
+    action="store", type="choice", dest="order", default="largest", choices=["largest", "listed"],
+    help="Order to dump volumes in: largest (biggest expected dump first, so no dump is left running long after the rest) " +
+        "or listed (the order vos lists them in) (default: %default)"
+)
+
+parser.add_option(
+    "--dry-run",
+    action="store_true", dest="dry_run", default=False,
+    help="Show what each server would dump and when it is projected to finish, using --dump-mbps and --dump-overhead, and exit"
+)
+
+parser.add_option(
+    "--dump-mbps",
+    action="store", type="float", dest="dump_mbps", default=25,
+    help="MB/s a single dump is expected to run at for --dry-run (default: %default)"
+)
+
+parser.add_option(
+    "--dump-overhead",
+    action="store", type="float", dest="dump_overhead", default=2,
+    help="Seconds each dump is expected to take on top of moving its data for --dry-run (default: %default)"
+)
+
+parser.add_option(
+    "--budget",
+    action="append", type="string", dest="budgets", default=[], metavar="HH:MM-HH:MM=DUMPS[/MBPS]",
+    help="Between the times given hold each server to DUMPS dumps at once and, if given, MBPS MB/s of dump data in all, " +
+        "e.g. 07:00-19:00=1/20 for business hours.  May be given more than once, the first which covers the time is used " +
+        "and --dumps-per-server applies at other times.  Limits are checked as the run goes so running dumps slow down or " +
+        "speed up (and fewer or more are started) as the time of day moves from one to another."
+)
+
+parser.add_option(
+    "--full-schedule",
+    action="store", type="choice", dest="full_schedule", default="sunday", choices=["sunday", "hash", "balanced"],
+    help="How volumes are given the day of their full dump: sunday (every volume on Sundays), hash (spread by volume name) " +
+        "or balanced (spread so each day's fulls are about the same size) (default: %default)"
+)
+
+parser.add_option(
+    "--full-period",
+    action="store", type="int", dest="full_period", default=7,
+    help="Number of days each volume gets a full dump within, hash and balanced schedules only (default: %default)"
+)
+
+parser.add_option(
+    "--show-schedule",
+    action="store_true", dest="show_schedule", default=False,
+    help="Show the full dumps each server would get on each day of the next full period with the schedule given and exit"
+)
 
 (options, args) = parser.parse_args()
 
 
 
+# Return a --budget as (start minute of the day, end minute of the day, dumps, MB/s or None)
+def parse_budget(budget):
+    (times, limits) = budget.split("=", 1)
+    (start, end) = times.split("-", 1)
+
+    minutes = []
+    for clock_time in [start, end]:
+        (hour, minute) = clock_time.split(":", 1)
+
+        if int(hour) > 24 or int(minute) > 59:
+            raise ValueError("bad time " + clock_time)
+
+        minutes.append(int(hour) * 60 + int(minute))
+
+    if "/" in limits:
+        (dumps, mbps) = limits.split("/", 1)
+        (dumps, mbps) = (int(dumps), float(mbps))
+
+    else:
+        (dumps, mbps) = (int(limits), None)
+
+    if dumps < 1 or (mbps is not None and mbps <= 0):
+        raise ValueError("limits must be more than 0")
+
+    return (minutes[0], minutes[1], dumps, mbps)
+
+try:
+    options.budgets = [parse_budget(budget) for budget in options.budgets]
+
+except ValueError as err:
+    parser.error("Unable to understand --budget: " + str(err))
+
+if options.dumps_per_server < 1 or options.dumps_per_partition < 1:
+    parser.error("--dumps-per-server and --dumps-per-partition must be at least 1")
+
+if options.full_schedule == "sunday" and options.full_period != 7:
+    parser.error("--full-period can only be changed with the hash and balanced schedules")
+
+if options.compress_level < 0 or options.compress_level > 9:
+    parser.error("--compress-level must be from 0 to 9")
+
+if options.compress_level == 0 and len([budget for budget in options.budgets if budget[3] is not None]) > 0:
+    parser.error("A MB/s --budget needs --compress-level above 0, dumps can only be slowed as they pass through us")
+
+if options.dump_mbps <= 0:
+    parser.error("--dump-mbps must be more than 0")
+
+if options.full_period < 1:
+    parser.error("--full-period must be at least 1")
+
+
+
 
 # Print a stack trace, exception, and an error string to STDERR
 # and exit with the exit status given or don't exit
@@ -115,420 +278,1685 @@ def try_cleanup_temp_files():
 
 
 
+# Return a list of dicts describing the backup volumes in the lines of a "vos listvol -format" in the order they are
+# listed: name, partition, update_time (seconds since the epoch) and size (KB), and a list of the names of the volumes
+# whose update time could not be read
+# Nothing is logged so afs_backup_simulator.py can use it too
+def parse_listvol(lines):
+    volumes = []
+    unknown_update_list = []
+    entry = None
+    for line in lines:
+        fields = line.split()
 
+        if len(fields) == 0:
+            continue
 
-# Prepare syslog
-syslog.openlog(os.path.basename(sys.argv[0]), syslog.LOG_NOWAIT, syslog.LOG_DAEMON)
+        if fields[0] == "BEGIN_OF_ENTRY":
+            entry = {}
 
+        elif fields[0] == "END_OF_ENTRY":
+            if entry is not None and entry.get("type") == "BK" and "name" in entry:
+                try:
+                    update_time = int(entry["updateDate"])
 
+                except (KeyError, ValueError):
+                    unknown_update_list.append(entry["name"])
 
+                    # We don't know the update time so pretend it is the highest value possible to force a dump to take place later
+                    update_time = 2147483647
 
+                try:
+                    size = int(entry["diskused"])
 
-if os.path.exists("/home/afsdumper/afs_backup.lock"):
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Existing lock file /home/afsdumper/afs_backup.lock found, exiting. - NOC-NETCOOL-TICKET\n")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Existing lock file /home/afsdumper/afs_backup.lock found, exiting.\n", 1)
+                except (KeyError, ValueError):
+                    size = 0
 
+                volumes.append({"name" : entry["name"], "partition" : entry.get("part"), "update_time" : update_time, "size" : size})
 
+            entry = None
 
-print "AFS Backup " + str(os.getpid()) + " - Info - Creating lock file"
-syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Creating lock file.\n")
+        # e.g. "updateDate    1420070400    Thu Jan  1 00:00:00 2015", only the first value is wanted
+        elif entry is not None and len(fields) >= 2:
+            entry[fields[0]] = fields[1]
 
-try:
-    lock_file_handle = open("/home/afsdumper/afs_backup.lock", "w")
-    lock_file_handle.write(str(os.getpid()))
-    lock_file_handle.close()
+    return (volumes, unknown_update_list)
 
-except:
-    try_cleanup_temp_files()
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to create lock file /home/afsdumper/afs_backup.lock, exiting. - NOC-NETCOOL-TICKET\n")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Failed to create lock file /home/afsdumper/afs_backup.lock found, exiting.\n", 1)
 
 
+# Return a list of the backup volumes on a server as parse_listvol() does
+# Everything comes from one "vos listvol -format" call read as it streams in rather than a "vos examine" per volume
+def list_backup_volumes(afs_server):
+    vos_info = subprocess.Popen([vos_path, "listvol", afs_server, "-format"], stdin=None, stdout=subprocess.PIPE, shell=False)
 
+    (volumes, unknown_update_list) = parse_listvol(iter(vos_info.stdout.readline, ""))
 
+    for volume in unknown_update_list:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to get last update timestamp of volume " + volume + ".\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to get last update timestamp of volume " + volume + "\n", None)
 
-print "AFS Backup " + str(os.getpid()) + " - Info - Forking child to handle Kerberos and AFS authentication"
-syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Forking child to handle Kerberos and AFS authentication\n")
+    status = vos_info.wait()
 
-pid = os.fork()
+    if status != 0:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(status) + ") of vos while listing volumes on server " + afs_server + ".\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(status) + ") of vos while listing volumes on server " + afs_server + "\n", None)
 
-if pid == 0: # We're the child
-    os.setsid()
+    return volumes
 
-    while True:
-        print "AFS Backup " + str(os.getpid()) + " - Info - Getting Kerberos 5 ticket using keytab " + kerberos_keytab
-        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Getting Kerberos 5 ticket using keytab " + kerberos_keytab + "\n")
 
-        signal.alarm(60)
 
-        kinit_info = subprocess.Popen(["/usr/bin/kinit", "-k", "-t", kerberos_keytab, "SOME_ADMIN_PRINCIPAL"], stdin=None, stdout=None, shell=False)
-        status = kinit_info.wait()
+# Return the backup history of a volume as a dict of:
+# last_time    When the last successful dump (full or incremental) started, 0 if never
+# full_time    When the last successful full dump started, None if there is none to build incrementals on
+# chain        The dumps needed to restore the volume in the order to apply them, the last full then every
+#              incremental since: dicts of level ("full" or "incremental"), time, since (0 for a full) and file,
+#              compressed dumps also have bytes and sha256 of the file then raw_bytes and raw_sha256 of the dump in it
+# full_day     The day of the full period the volume gets its full dump on with the balanced schedule
+# Older versions only kept the time of the last dump without saying if it was full, those are converted
+# with no full so the volume's next dump is a full one
+def volume_history(afs_backup_history, volume):
+    history = afs_backup_history.get(volume)
 
-        signal.alarm(0)
+    if history is None:
+        history = {"last_time" : 0, "full_time" : None, "chain" : []}
+        afs_backup_history[volume] = history
 
-        if status != 0:
-            try_cleanup_temp_files()
-            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Unable to get Kerberos ticket, kinit exited with a status of " + str(status) + ", exiting. - NOC-NETCOOL-TICKET")
-            error("AFS Backup " + str(os.getpid()) + " - Error - Unable to get Kerberos ticket, kinit exited with a status of " + str(status) + ", exiting.\n", 1)
+    elif isinstance(history, (int, long)):
+        history = {"last_time" : history, "full_time" : None, "chain" : []}
+        afs_backup_history[volume] = history
 
+    return history
 
 
 
+# Return True if a volume has changed since it was last backed up
+def volume_changed(volume_info, afs_backup_history):
+    volume = volume_info["name"]
+    last_update_time = volume_info["update_time"]
 
-        print "AFS Backup " + str(os.getpid()) + " - Info - Getting AFS token"
-        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Getting AFS token\n")
+    # This is when the last backup was ran
+    last_backup_time = volume_history(afs_backup_history, volume)["last_time"]
 
-        signal.alarm(60)
+    if options.debug is True:
+        print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " last backup time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_backup_time)) + " (" + str(last_backup_time) + ")"
+        syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " last backup time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_backup_time)) + " (" + str(last_backup_time) + ").\n")
 
-        aklog_info = subprocess.Popen(["/usr/bin/aklog"], stdin=None, stdout=None, shell=False)
-        status = aklog_info.wait()
+        print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " last update time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_update_time)) + " (" + str(last_update_time) + ")"
+        syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " last update time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_update_time)) + " (" + str(last_update_time) + ").\n")
 
-        signal.alarm(0)
+    # Do we need to backup this volume?
+    if last_update_time > last_backup_time:
+        if options.debug is True:
+            print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " has changed since last full backup, dumping."
+            syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " has changed since last full backup, dumping.\n")
 
-        if status != 0:
-            try_cleanup_temp_files()
-            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Unable to get AFS token, aklog exited with a status of " + str(status) + ", exiting. - NOC-NETCOOL-TICKET")
-            error("AFS Backup " + str(os.getpid()) + " - Error - Unable to get AFS token, aklog exited with a status of " + str(status) + ", exiting.\n", 1)
+        return True
 
-        # Sleep for an hour then restart the loop to re-authenticate
-        wakeup_time = int(time.time()) + (60 * 60)
-        while True:
-            if time.time() > wakeup_time:
-                break
+    if options.debug is True:
+        print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " has not changed since last full backup, skipping."
+        syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " has not changed since last full backup, skipping.\n")
 
-            else:
-                time.sleep(60)
+    return False
 
 
-else: # We're the parent
-    auther_pid = pid
-    print "AFS Backup " + str(os.getpid()) + " - Info - Authentication handling child had pid " + str(auther_pid) + ", waiting 30 seconds for authentication"
-    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Authentication handling child had pid " + str(auther_pid) + ", waiting 30 seconds for authentication\n")
 
-    # Give that child some time to authenticate
-    time.sleep(30)
+# With --pipeline each server's dumper backs up its finished dumps in batches as it goes, one batch at a time.
+# The pipeline is a dict of:
+# server      The server the dumps are from
+# pending     Dump files waiting for the next batch
+# size        Bytes in pending
+# running     (process, files) of the batch being backed up or None
+# batches     Number of batches started
+# failed      Number of batches NetBackup failed to back up, their files are left for the final backup to pick up
+def new_backup_pipeline(afs_server):
+    return {"server" : afs_server, "pending" : [], "size" : 0, "running" : None, "batches" : 0, "failed" : 0}
 
 
 
+# Add a finished dump file to a pipeline and start a batch if enough are waiting and none is running
+def add_to_backup_pipeline(pipeline, dump_path):
+    pipeline["pending"].append(dump_path)
 
+    try:
+        pipeline["size"] = pipeline["size"] + os.path.getsize(dump_path)
 
-dumper_pids = []
-for afs_server in afs_servers:
-    print "AFS Backup " + str(os.getpid()) + " - Info - Forking child to dump volumes from " + afs_server
-    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Forking child to dump volumes from " + afs_server + ".\n")
+    except OSError:
+        pass
 
-    if os.path.exists("/usr/local/dump/" + afs_server) is False:
-        os.mkdir("/usr/local/dump/" + afs_server)
+    if len(pipeline["pending"]) >= options.batch_volumes or pipeline["size"] >= options.batch_gb * 1073741824:
+        start_backup_batch(pipeline)
 
-    pid = os.fork()
 
-    if pid == 0: # We're the child
-        os.setsid()
 
-        pickle_file = "/home/afsdumper/afs_backup-" + afs_server + ".pkl"
+# Start backing up every waiting dump file of a pipeline with "bpbackup -f" unless a batch is already running
+def start_backup_batch(pipeline):
+    if pipeline["running"] is not None or len(pipeline["pending"]) == 0:
+        return
 
-        print "AFS Backup " + str(os.getpid()) + " - Info - Getting pickle file (" + pickle_file + ") of previous backups"
-        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Getting pickle file (" + pickle_file + ") of previous backups")
+    afs_server = pipeline["server"]
+    files = pipeline["pending"]
+    list_file = "/home/afsdumper/afs_backup-" + afs_server + "-batch.txt"
 
-        if os.path.isfile(pickle_file):
-            pickle_handle = open(pickle_file, "r")
+    (pipeline["pending"], pipeline["size"]) = ([], 0)
+    pipeline["batches"] = pipeline["batches"] + 1
 
-            afs_backup_history = pickle.load(pickle_handle)
+    try:
+        list_handle = open(list_file, "w")
+        list_handle.write("\n".join(files) + "\n")
+        list_handle.close()
 
-            pickle_handle.close()
+        bpbackup_info = subprocess.Popen(bpbackup_command + ["-f", list_file], stdin=None, stdout=None, shell=False)
 
-        else:
-            print "AFS Backup " + str(os.getpid()) + " - Warning - No pickle file (" + pickle_file + ") of previous backups found, moving on anyway"
-            syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - No pickle file (" + pickle_file + ") of previous backups found, moving on anyway. - NOC-NETCOOL-TICKET")
+    except (IOError, OSError) as err:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to start backing up batch " + str(pipeline["batches"]) + " of server " + afs_server + ": " + str(err) + ", leaving it for the final backup.\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to start backing up batch " + str(pipeline["batches"]) + " of server " + afs_server + ": " + str(err) + ", leaving it for the final backup\n", None)
 
-            afs_backup_history = {}
+        pipeline["failed"] = pipeline["failed"] + 1
+        return
 
+    print "AFS Backup " + str(os.getpid()) + " - Info - Backing up batch " + str(pipeline["batches"]) + " of " + str(len(files)) + " dumps from server " + afs_server
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Backing up batch " + str(pipeline["batches"]) + " of " + str(len(files)) + " dumps from server " + afs_server + ".\n")
 
-        # On Sundays do a full dump
-        todays_weekdate = datetime.date.fromtimestamp(time.time()).strftime("%A").lower()
+    pipeline["running"] = (bpbackup_info, files)
 
-        print "AFS Backup " + str(os.getpid()) + " - Info - Dumping volumes from server " + afs_server
-        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Dumping volumes from server " + afs_server + ".\n")
 
-        vos_info = subprocess.Popen(["/usr/sbin/vos", "listvol", afs_server, "-quiet"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=False)
 
-        total_volume_count = 0
-        failed_volume_count = 0
-        for line in vos_info.communicate("\n")[0].split(os.linesep):
-            line = line.rstrip()
+# Handle the running batch of a pipeline finishing with the exit status given: remove its dump files if it was backed up
+# then start the next batch if enough are waiting
+def finish_backup_batch(pipeline, status):
+    (bpbackup_info, files) = pipeline["running"]
+    pipeline["running"] = None
 
-            if re.search(" BK ", line) is None:
-                continue
+    if status != 0:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Netbackup returned non-zero error code " + str(status) + " for a batch of " + str(len(files)) + " dumps from server " + pipeline["server"] + ", leaving it for the final backup.\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Netbackup returned non-zero error code " + str(status) + " for a batch of " + str(len(files)) + " dumps from server " + pipeline["server"] + ", leaving it for the final backup\n", None)
+
+        pipeline["failed"] = pipeline["failed"] + 1
 
-            total_volume_count = total_volume_count + 1
+    else:
+        for dump_path in files:
+            try:
+                os.remove(dump_path)
 
-            volume = line.split()[0]
+            except OSError as err:
+                syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to remove backed up dump " + dump_path + ": " + str(err) + ".\n")
+                error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to remove backed up dump " + dump_path + ": " + str(err) + "\n", None)
 
-            if options.debug is True:
-                print "AFS Backup " + str(os.getpid()) + " - Debug - Working on volume " + volume
-                syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Working on volume " + volume + ".\n")
+    if len(pipeline["pending"]) >= options.batch_volumes or pipeline["size"] >= options.batch_gb * 1073741824:
+        start_backup_batch(pipeline)
 
-            # On Sundays do a full dump
-            if todays_weekdate == "sunday":
-            #if True is True:
-                if options.debug is True:
-                    print "AFS Backup " + str(os.getpid()) + " - Debug - Full backup needed, dumping volume " + volume
-                    syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Debug - Full backup needed, dumping volume " + volume + ".\n")
 
-                with open(os.devnull, "w") as devnull:
-                    vos2_info = subprocess.Popen(["/usr/sbin/vos", "dump", volume, "-file", "/usr/local/dump/" + afs_server + "/" + volume], stdin=None, stdout=None, stderr=devnull, shell=False)
-                    status = vos2_info.wait()
 
-                if status != 0:
-                    syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(status) + ") of vos while dumping volume " + volume + ".\n")
-                    error("AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(status) + ") of vos while dumping volume " + volume + "\n", None)
+# Back up whatever is left in a pipeline and wait for it, once no more dumps are coming
+def flush_backup_pipeline(pipeline):
+    while pipeline["running"] is not None or len(pipeline["pending"]) > 0:
+        if pipeline["running"] is None:
+            start_backup_batch(pipeline)
+            continue
 
-                    failed_volume_count = failed_volume_count + 1
+        finish_backup_batch(pipeline, pipeline["running"][0].wait())
 
-                else:
-                    afs_backup_history[volume] = int(time.time())
+        start_backup_batch(pipeline)
+
+
+
+# Return (dumps at once, MB/s or None for no limit) a server is held to at a time (default: now) by --budget
+def current_budget(at_time=None):
+    local_time = time.localtime(at_time)
+    minute = local_time.tm_hour * 60 + local_time.tm_min
+
+    for (start, end, dumps, mbps) in options.budgets:
+        # A budget can run past midnight, e.g. 22:00-06:00
+        if (start <= end and start <= minute < end) or (start > end and (minute >= start or minute < end)):
+            return (min(dumps, options.dumps_per_server), mbps)
+
+    return (options.dumps_per_server, None)
+
+
+
+# A server's dumps share a throttle holding their data to the MB/s of the budget, a dict of:
+# lock       Held while changing the rest
+# mbps       The current limit or None for none
+# allowance  Bytes which can pass before waiting, the dumps are slowed once this goes below 0
+# last       When allowance was last topped up
+# throttled  Seconds dumps spent waiting on the throttle, added up over every dump
+def new_throttle():
+    return {"lock" : threading.Lock(), "mbps" : None, "allowance" : 0.0, "last" : time.time(), "throttled" : 0.0}
+
+
+
+# Count data passing through a throttle, waiting as long as needed to keep to its MB/s
+# A dump we wait in stops reading from vos so vos stops reading from the fileserver
+def throttle_wait(throttle, data_bytes):
+    throttle["lock"].acquire()
+
+    try:
+        if throttle["mbps"] is None:
+            return
+
+        rate = throttle["mbps"] * 1048576
+        now = time.time()
+
+        # Allow a burst of up to a second's worth
+        throttle["allowance"] = min(throttle["allowance"] + (now - throttle["last"]) * rate, rate) - data_bytes
+        throttle["last"] = now
+
+        delay = -throttle["allowance"] / rate
+
+    finally:
+        throttle["lock"].release()
+
+    if delay > 0:
+        time.sleep(delay)
+
+        throttle["lock"].acquire()
+        throttle["throttled"] = throttle["throttled"] + delay
+        throttle["lock"].release()
+
+
+
+# Compress a dump as vos writes it to a stream into a gzip file, ran in a thread per dump
+# zlib and hashlib let go of the GIL while they work so the dumps running at once are compressed on as many cores
+# The result dict gets bytes and sha256 of the file, raw_bytes and raw_sha256 of the dump and error if writing failed,
+# the stream is read to the end even then so vos is never left blocked writing to it
+# The data read is held to the throttle given
+def pump_dump(stream, dump_path, result, throttle):
+    compressor = zlib.compressobj(options.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    (file_digest, raw_digest) = (hashlib.sha256(), hashlib.sha256())
+    (file_bytes, raw_bytes) = (0, 0)
+
+    try:
+        dump_handle = open(dump_path, "wb")
+
+    except IOError as err:
+        result["error"] = str(err)
+        dump_handle = None
+
+    for chunk in iter(lambda: stream.read(1048576), ""):
+        raw_digest.update(chunk)
+        raw_bytes = raw_bytes + len(chunk)
+
+        if dump_handle is None:
+            continue
+
+        throttle_wait(throttle, len(chunk))
+
+        try:
+            data = compressor.compress(chunk)
+            dump_handle.write(data)
+
+        except (IOError, OSError, zlib.error) as err:
+            result["error"] = str(err)
+            dump_handle.close()
+            dump_handle = None
+            continue
+
+        file_digest.update(data)
+        file_bytes = file_bytes + len(data)
+
+    stream.close()
+
+    if dump_handle is not None:
+        try:
+            data = compressor.flush()
+            dump_handle.write(data)
+            dump_handle.close()
+
+            file_digest.update(data)
+            file_bytes = file_bytes + len(data)
 
-                    if options.debug is True:
-                        syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Debug - Successfully dumped volume " + volume + ".\n")
-                        print "AFS Backup " + str(os.getpid()) + " - Debug - Successfully dumped volume " + volume
+        except (IOError, OSError, zlib.error) as err:
+            result["error"] = str(err)
 
-                print "Backup time: " + str(afs_backup_history[volume])
+    result.update({"bytes" : file_bytes, "sha256" : file_digest.hexdigest(), "raw_bytes" : raw_bytes, "raw_sha256" : raw_digest.hexdigest()})
 
-            else: # On other weekdays check if the volume has changed since last Thursday and only dump it if it has
-                vos3_info = subprocess.Popen(["/usr/sbin/vos", "examine", "-id", volume], stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=False)
-                for line in vos3_info.communicate("\n")[0].split(os.linesep):
-                    line = line.rstrip()
 
-                    if re.search("Last Update", line) is None:
-                        continue
 
-                    try:
-                        day = int(line.split()[4])
-                        month = line.split()[3]
-                        year = int(line.split()[6])
-                        vol_time = line.split()[5]
-                        hour = int(vol_time.split(":")[0])
-                        minute = int(vol_time.split(":")[1])
+# Return a dict of partition -> deque of the volumes to dump from it, in the order they are to be dumped (see --order)
+# and the order to consider the partitions in for next_volume()
+def make_dump_queues(volumes):
+    if options.order == "largest":
+        volumes = sorted(volumes, key=lambda volume_info: volume_info.get("estimate", volume_info["size"]), reverse=True)
 
-                    except:
-                        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to get last update timestamp of volume " + volume + ".\n")
-                        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to get last update timestamp of volume " + volume + "\n", None)
+    queues = collections.OrderedDict()
+    for volume_info in volumes:
+        queues.setdefault(volume_info["partition"], collections.deque()).append(volume_info)
 
-                        # We don't know the update time so pretend it is the highest value possible to force a dump to take place later
-                        last_update_time = 2147483647
+    return (queues, queues.keys())
 
-                    else:
-                        if month == "Jan":
-                            month = 1
 
-                        elif month == "Feb":
-                            month = 2
 
-                        elif month == "Mar":
-                            month = 3
+# Take the next volume to dump off of the queues from make_dump_queues(), or return None if every partition with
+# volumes left already has options.dumps_per_partition dumps running (partition_running says how many each has)
+# Largest first: the biggest volume at the head of a partition's queue, listed: the partition with the fewest
+# dumps running with ties taking turns
+def next_volume(queues, partition_order, partition_running):
+    waiting_partitions = [partition for partition in partition_order if len(queues[partition]) > 0 and partition_running[partition] < options.dumps_per_partition]
 
-                        elif month == "Apr":
-                            month = 4
+    if len(waiting_partitions) == 0:
+        return None
 
-                        elif month == "May":
-                            month = 5
+    if options.order == "largest":
+        partition = max(waiting_partitions, key=lambda partition: queues[partition][0].get("estimate", queues[partition][0]["size"]))
 
-                        elif month == "Jun":
-                            month = 6
+    else:
+        partition = min(waiting_partitions, key=lambda partition: partition_running[partition])
+
+    partition_order.remove(partition)
+    partition_order.append(partition)
+
+    return queues[partition].popleft()
+
+
+
+# Return the projected seconds it takes to dump a list of volumes as dump_volumes() would, and of those the seconds
+# the last dump from each partition finishes at as a dict
+# Each dump takes options.dump_overhead seconds plus its estimated size at options.dump_mbps
+def project_dumps(volumes):
+    (queues, partition_order) = make_dump_queues(volumes)
+    partition_running = dict((partition, 0) for partition in partition_order)
+    partition_finish = dict((partition, 0.0) for partition in partition_order)
+
+    running = [] # (finish time, partition) as a heap
+    now = 0.0
+
+    while True:
+        while len(running) < options.dumps_per_server:
+            volume_info = next_volume(queues, partition_order, partition_running)
+
+            if volume_info is None:
+                break
+
+            seconds = options.dump_overhead + volume_info.get("estimate", volume_info["size"]) / 1024.0 / options.dump_mbps
+
+            heapq.heappush(running, (now + seconds, volume_info["partition"]))
+            partition_running[volume_info["partition"]] = partition_running[volume_info["partition"]] + 1
+
+        if len(running) == 0:
+            break
+
+        (now, partition) = heapq.heappop(running)
+        partition_running[partition] = partition_running[partition] - 1
+        partition_finish[partition] = now
+
+    return (now, partition_finish)
 
-                        elif month == "Jul":
-                            month = 7
 
-                        elif month == "Aug":
-                            month = 8
 
-                        elif month == "Sep":
-                            month = 9
+# Show what a server would dump today and when it is projected to finish
+def show_dry_run(afs_server):
+    afs_backup_history = load_history("/home/afsdumper/afs_backup-" + afs_server + ".pkl")
+
+    volumes = list_backup_volumes(afs_server)
+    assign_full_days(volumes, afs_backup_history)
+    dump_list = plan_dumps(volumes, afs_backup_history, datetime.date.today().toordinal())
+
+    fulls = [volume_info for volume_info in dump_list if volume_info["level"] == "full"]
+    incrementals = [volume_info for volume_info in dump_list if volume_info["level"] == "incremental"]
+
+    (seconds, partition_finish) = project_dumps(dump_list)
+
+    print ""
+    print "Server " + afs_server + ": " + str(len(volumes)) + " volumes, " + str(len(fulls)) + " full dumps (" + "%.1f" % (sum(volume_info["estimate"] for volume_info in fulls) / 1048576.0) + " GB), " + \
+        str(len(incrementals)) + " incremental dumps (" + "%.1f" % (sum(volume_info["estimate"] for volume_info in incrementals) / 1048576.0) + " GB estimated)"
+    print "Projected to take " + str(datetime.timedelta(seconds=int(seconds))) + " in " + options.order + " order, finishing at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(time.time() + seconds))
+
+    for partition in sorted(partition_finish):
+        print "    " + str(partition) + " finishes after " + str(datetime.timedelta(seconds=int(partition_finish[partition])))
+
+    if len(dump_list) > 0:
+        largest = max(dump_list, key=lambda volume_info: volume_info["estimate"])
+        print "    Largest dump is " + largest["name"] + " (" + largest["level"] + ", " + "%.1f" % (largest["estimate"] / 1048576.0) + " GB)"
+
+
+
+# Dump volumes of a server given as a list from list_backup_volumes() with each volume's "level" ("full" or
+# "incremental") and "since" (the time an incremental dump starts from) set
+# Returns how many failed to dump and a list of the names of the ones which succeeded
+# Up to options.dumps_per_server dumps run at once and no more than options.dumps_per_partition of those
+# from any one partition, so every partition is worked on at once rather than one after another.
+# Which volume goes next is up to next_volume().
+# The history of each volume which dumped successfully gets the dump added to its chain (see volume_history()).
+# Each successful dump is handed to the backup pipeline if one is given.
+# Every dump, successful or not, is written to the journal if one is given.
+# The --budget for the time of day is checked as it goes, a lower limit on dumps at once lets the ones running finish
+# without starting more (a stopped dump would time out on the fileserver) while a MB/s limit slows the running dumps.
+def dump_volumes(afs_server, volumes, afs_backup_history, pipeline=None, journal_handle=None):
+    (queues, partition_order) = make_dump_queues(volumes)
+    partition_running = dict((partition, 0) for partition in partition_order)
+
+    running = {} # pid -> (process, volume_info, start time, dump file, (pump thread, pump result) or None, exact start time)
+    staging_dir = "/usr/local/dump/" + afs_server + "/"
+    failed_volume_count = 0
+    dumped_list = []
+    dump_metrics = []
+    queued_time = time.time() # Every volume is queued from the start
+
+    throttle = new_throttle()
+    held_back = 0.0 # Seconds volumes were waiting with fewer dumps running than --dumps-per-server because of the budget
+    last_check = time.time()
+    auth_failed = False
+
+    devnull = open(os.devnull, "w")
+
+    while True:
+        (budget_dumps, throttle["mbps"]) = current_budget()
+
+        now = time.time()
+        if budget_dumps < options.dumps_per_server and len(running) >= budget_dumps and len([queue for queue in queues.values() if len(queue) > 0]) > 0:
+            held_back = held_back + now - last_check
+
+        last_check = now
 
-                        elif month == "Oct":
-                            month = 10
+        # Dumps started without a token would only fail, let the running ones finish and leave the rest
+        if not auth_failed and os.path.exists(auth_failed_file):
+            auth_failed = True
 
-                        elif month == "Nov":
-                            month = 11
+            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Authentication failed, not starting any more dumps from server " + afs_server + ". - NOC-NETCOOL-TICKET\n")
+            error("AFS Backup " + str(os.getpid()) + " - Error - Authentication failed, not starting any more dumps from server " + afs_server + "\n", None)
 
-                        elif month == "Dec":
-                            month = 12
+        while len(running) < budget_dumps and not auth_failed:
+            volume_info = next_volume(queues, partition_order, partition_running)
 
-                        dt = datetime.datetime(year, month, day, hour, minute)
-                        last_update_time = int(time.mktime(dt.timetuple()))
+            if volume_info is None:
+                break
 
-                        #print str(year) + ":" + str(month) + ":" + str(day) + ":" + str(hour) + ":" + str(minute)
+            volume = volume_info["name"]
+            partition = volume_info["partition"]
 
-                    # This is when the last backup was ran
-                    try:
-                        last_backup_time = afs_backup_history[volume]
+            start_time = int(time.time())
 
-                    except KeyError:
-                        last_backup_time = 0
+            # Each dump gets its own file so a full and the incrementals on top of it can all be restored
+            dump_file = volume + "." + volume_info["level"] + "." + time.strftime("%Y%m%d%H%M%S", time.localtime(start_time))
 
-                    if options.debug is True:
-                        print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " last backup time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_backup_time)) + " (" + str(last_backup_time) + ")"
-                        syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " last backup time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_backup_time)) + " (" + str(last_backup_time) + ").\n")
+            if options.compress_level > 0:
+                dump_file = dump_file + ".gz"
 
-                        print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " last update time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_update_time)) + " (" + str(last_update_time) + ")"
-                        syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " last update time is " + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_update_time)) + " (" + str(last_update_time) + ").\n")
+            # The dump is written to dump_file.partial and only renamed to dump_file once it is whole, anything
+            # cut short by a kill is left as .partial for clean_staging() rather than backed up as if it was good
+            partial_path = staging_dir + dump_file + ".partial"
 
-                        #time.sleep(5)
+            # vos takes the time as mm/dd/yyyy hh:mm, dropping the seconds only makes the incremental take in a little more
+            if volume_info["level"] == "incremental":
+                dump_time = time.strftime("%m/%d/%Y %H:%M", time.localtime(volume_info["since"]))
 
-                    # Do we need to backup this volume?
-                    if last_update_time > last_backup_time:
-                        if options.debug is True:
-                            print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " has changed since last full backup, dumping."
-                            syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " has changed since last full backup, dumping.\n")
+            else:
+                dump_time = "0"
 
-                        with open(os.devnull, "w") as devnull:
-                            vos4_info = subprocess.Popen(["/usr/sbin/vos", "dump", volume, "-file", "/usr/local/dump/" + afs_server + "/" + volume], stdin=subprocess.PIPE, stdout=None, stderr=devnull, shell=False)
-                            status = vos4_info.wait()
+            if options.debug is True:
+                print "AFS Backup " + str(os.getpid()) + " - Debug - Dumping volume " + volume + " from partition " + str(partition) + " (" + volume_info["level"] + " since " + dump_time + ")"
+                syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Debug - Dumping volume " + volume + " from partition " + str(partition) + " (" + volume_info["level"] + " since " + dump_time + ").\n")
 
-                        if status != 0:
-                            syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(status) + ") of vos while dumping volume " + volume + ".\n")
-                            error("AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(status) + ") of vos while dumping volume " + volume, None)
+            try:
+                if options.compress_level > 0:
+                    vos_info = subprocess.Popen([vos_path, "dump", volume, "-time", dump_time], stdin=None, stdout=subprocess.PIPE, stderr=devnull, shell=False)
 
-                            failed_volume_count = failed_volume_count + 1
+                else:
+                    vos_info = subprocess.Popen([vos_path, "dump", volume, "-time", dump_time, "-file", partial_path], stdin=None, stdout=None, stderr=devnull, shell=False)
 
-                        else:
-                            afs_backup_history[volume] = int(time.time())
+            except OSError as err:
+                syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to run vos to dump volume " + volume + ": " + str(err) + ".\n")
+                error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to run vos to dump volume " + volume + ": " + str(err) + "\n", None)
 
-                            if options.debug is True:
-                                syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Debug - Successfully dumped volume " + volume + ".\n")
-                                print "AFS Backup " + str(os.getpid()) + " - Debug - Successfully dumped volume " + volume
+                failed_volume_count = failed_volume_count + 1
+                continue
 
-                    else:
-                        if options.debug is True:
-                            print "AFS Backup " + str(os.getpid()) + " - Debug - Volume " + volume + " has not changed since last full backup, skipping."
-                            syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Info - Volume " + volume + " has not changed since last full backup, skipping.\n")
+            if options.compress_level > 0:
+                pump_result = {}
+                pump_thread = threading.Thread(target=pump_dump, args=(vos_info.stdout, partial_path, pump_result, throttle))
+                pump_thread.daemon = True
+                pump_thread.start()
 
-                    if options.debug is True:
-                        print ""
+                pump = (pump_thread, pump_result)
 
-        if failed_volume_count > 100:
-            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to dump greater than 100 volumes from server " + afs_server + ". - NOC-NETCOOL-TICKET\n")
-            error("AFS Backup " + str(os.getpid()) + " - Error - Failed to dump greater than 100 volumes from server " + afs_server + "\n", None)
+            else:
+                pump = None
 
-        print "AFS Backup " + str(os.getpid()) + " - Info - Completed dump from server " + afs_server + ", " + str(total_volume_count) + " volumes found, " + str(failed_volume_count) + " volumes failed to dump"
-        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Completed dump from server " + afs_server + ", " + str(total_volume_count) + " volumes found, " + str(failed_volume_count) + " volumes failed to dump\n")
+            running[vos_info.pid] = (vos_info, volume_info, start_time, dump_file, pump, time.time())
+            partition_running[partition] = partition_running[partition] + 1
 
+        if len(running) == 0:
+            break
 
+        # See if a dump finished, checking back often so the budget is kept up to date
         try:
-            # Remove the old pickle
+            (pid, status) = os.waitpid(-1, os.WNOHANG)
+
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+
+            raise
+
+        if pid == 0:
+            time.sleep(0.05)
+            continue
+
+        # A batch finished backing up
+        if pipeline is not None and pipeline["running"] is not None and pid == pipeline["running"][0].pid:
+            if os.WIFEXITED(status):
+                pipeline["running"][0].returncode = os.WEXITSTATUS(status)
+
+            else:
+                pipeline["running"][0].returncode = -os.WTERMSIG(status)
+
+            finish_backup_batch(pipeline, pipeline["running"][0].returncode)
+            continue
+
+        if pid not in running:
+            continue
+
+        (vos_info, volume_info, start_time, dump_file, pump, started) = running.pop(pid)
+        finished = time.time()
+        volume = volume_info["name"]
+        partition_running[volume_info["partition"]] = partition_running[volume_info["partition"]] - 1
+
+        if os.WIFEXITED(status):
+            vos_info.returncode = os.WEXITSTATUS(status)
+
+        else:
+            vos_info.returncode = -os.WTERMSIG(status)
+
+        # vos is done writing, the pump is done once it has the rest of the pipe
+        if pump is not None:
+            pump[0].join()
+
+        rename_error = None
+
+        if vos_info.returncode == 0 and (pump is None or "error" not in pump[1]):
             try:
-                os.unlink(pickle_file + "-old")
+                os.rename(staging_dir + dump_file + ".partial", staging_dir + dump_file)
 
-            except:
-                pass
+            except OSError as err:
+                rename_error = str(err)
 
+        metric = {"volume" : volume, "partition" : volume_info["partition"], "level" : volume_info["level"], "wait" : round(started - queued_time, 3), "start" : round(started, 3), "duration" : round(finished - started, 3)}
+        dump_metrics.append(metric)
+
+        if vos_info.returncode != 0 or (pump is not None and "error" in pump[1]) or rename_error is not None:
+            if vos_info.returncode != 0:
+                syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(vos_info.returncode) + ") of vos while dumping volume " + volume + ".\n")
+                error("AFS Backup " + str(os.getpid()) + " - Warning - Non-zero exit status (" + str(vos_info.returncode) + ") of vos while dumping volume " + volume + "\n", None)
+
+            elif rename_error is not None:
+                syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to rename dump of volume " + volume + " into place: " + rename_error + ".\n")
+                error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to rename dump of volume " + volume + " into place: " + rename_error + "\n", None)
+
+            else:
+                syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to write dump of volume " + volume + ": " + pump[1]["error"] + ".\n")
+                error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to write dump of volume " + volume + ": " + pump[1]["error"] + "\n", None)
+
+            failed_volume_count = failed_volume_count + 1
+            metric.update({"ok" : False, "bytes" : 0, "file_bytes" : 0})
+
+            # Don't back up half a dump
             try:
-                os.rename(pickle_file, pickle_file + "-old")
+                os.remove(staging_dir + dump_file + ".partial")
 
-            except:
+            except OSError:
                 pass
 
-            pickle_handle = open(pickle_file, "w")
+            if journal_handle is not None:
+                write_journal(journal_handle, {"event" : "dump", "volume" : volume, "ok" : False})
 
-            pickle.dump(afs_backup_history, pickle_handle)
+        else:
+            dump = {"level" : volume_info["level"], "time" : start_time, "since" : volume_info["since"], "file" : dump_file}
 
-            pickle_handle.close()
+            if pump is not None:
+                dump.update(pump[1])
+                metric.update({"ok" : True, "bytes" : pump[1]["raw_bytes"], "file_bytes" : pump[1]["bytes"]})
 
+            else:
+                try:
+                    dump_bytes = os.path.getsize(staging_dir + dump_file)
 
-        except:
-            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to save pickle file (" + pickle_file + ") of backup history. - NOC-NETCOOL-TICKET")
-            error("AFS Backup " + str(os.getpid()) + " - Error - Failed to save pickle file (" + pickle_file + ") of backup history.\n", None)
+                except OSError:
+                    dump_bytes = 0
 
+                metric.update({"ok" : True, "bytes" : dump_bytes, "file_bytes" : dump_bytes})
 
-        sys.exit(0)
+            if journal_handle is not None:
+                write_journal(journal_handle, {"event" : "dump", "volume" : volume, "ok" : True, "dump" : dump})
+
+            record_dump(afs_backup_history, volume, dump)
+            dumped_list.append(volume)
+
+            if pipeline is not None:
+                add_to_backup_pipeline(pipeline, staging_dir + dump_file)
+
+            if options.debug is True:
+                syslog.syslog(syslog.LOG_DEBUG, "AFS Backup " + str(os.getpid()) + " - Debug - Successfully dumped volume " + volume + ".\n")
+                print "AFS Backup " + str(os.getpid()) + " - Debug - Successfully dumped volume " + volume
+
+    devnull.close()
+
+    # Volumes left undumped after authentication failed count as failed
+    if auth_failed:
+        failed_volume_count = failed_volume_count + sum(len(queue) for queue in queues.values())
+
+    if len(options.budgets) > 0:
+        print "AFS Backup " + str(os.getpid()) + " - Info - Budget for server " + afs_server + " held volumes back for " + str(datetime.timedelta(seconds=int(held_back))) + " and slowed dumps for " + str(datetime.timedelta(seconds=int(throttle["throttled"]))) + " of dump time"
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Budget for server " + afs_server + " held volumes back for " + str(datetime.timedelta(seconds=int(held_back))) + " and slowed dumps for " + str(datetime.timedelta(seconds=int(throttle["throttled"]))) + " of dump time.\n")
+
+    write_dump_metrics(afs_server, dump_metrics, queued_time, time.time(), held_back, throttle["throttled"])
+
+    return (failed_volume_count, dumped_list)
+
+
+
+# Return MB/s for a number of bytes moved in a number of seconds, 0 if no time went by
+def rate_mbps(byte_count, seconds):
+    if seconds <= 0:
+        return 0.0
+
+    return round(byte_count / 1048576.0 / seconds, 2)
 
 
+
+# Return the dumps, failures, raw bytes, seconds spent dumping (summed over every dump), seconds from the first start
+# to the last finish, the longest queue wait and the MB/s over both spans of time of a list of dump metrics
+def sum_dump_metrics(dump_metrics):
+    summary = {"dumps" : len(dump_metrics), "failed" : len([metric for metric in dump_metrics if not metric["ok"]])}
+    summary["bytes"] = sum(metric["bytes"] for metric in dump_metrics)
+    summary["dump_seconds"] = round(sum(metric["duration"] for metric in dump_metrics), 3)
+
+    if len(dump_metrics) > 0:
+        summary["span_seconds"] = round(max(metric["start"] + metric["duration"] for metric in dump_metrics) - min(metric["start"] for metric in dump_metrics), 3)
+        summary["max_wait"] = max(metric["wait"] for metric in dump_metrics)
+
     else:
-        print "AFS Backup " + str(os.getpid()) + " - Info - Dumper process for server " + afs_server + " has pid " + str(pid)
-        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Dumper process for server " + afs_server + " has pid " + str(pid) + ".\n")
+        summary["span_seconds"] = 0
+        summary["max_wait"] = 0
+
+    # Per dump says how fast a single vos dump goes, over the span says how fast the server or partition was emptied
+    summary["mbps_per_dump"] = rate_mbps(summary["bytes"], summary["dump_seconds"])
+    summary["mbps"] = rate_mbps(summary["bytes"], summary["span_seconds"])
 
-        dumper_pids.append(pid)
+    return summary
 
 
 
-# Wait for our children to exit
-for dumper_pid in dumper_pids:
-    os.waitpid(dumper_pid, 0)
+# Append this run's dump metrics of a server to /home/afsdumper/afs_backup-<server>-metrics.jsonl and write its timeline
+# to /home/afsdumper/afs_backup-<server>-timeline.txt
+# The metrics file keeps every run, one JSON object per line: a "volume" record for each dump, a "partition" record
+# for each partition and a "server" record, all with the run's start time in "run" to tie them together
+# The timeline is only this run: the partitions slowest first then each dump's start and finish from when dumping started
+def write_dump_metrics(afs_server, dump_metrics, queued_time, finish_time, held_back, throttled):
+    metrics_file = "/home/afsdumper/afs_backup-" + afs_server + "-metrics.jsonl"
+    timeline_file = "/home/afsdumper/afs_backup-" + afs_server + "-timeline.txt"
 
+    partition_summaries = collections.OrderedDict()
+    for partition in sorted(set(metric["partition"] for metric in dump_metrics)):
+        partition_summaries[partition] = sum_dump_metrics([metric for metric in dump_metrics if metric["partition"] == partition])
 
+    server_summary = sum_dump_metrics(dump_metrics)
+    server_summary.update({"started" : int(queued_time), "finished" : int(finish_time), "held_back" : round(held_back, 3), "throttled" : round(throttled, 3)})
 
+    try:
+        metrics_handle = open(metrics_file, "a")
 
+        for metric in dump_metrics:
+            record = {"record" : "volume", "run" : run_started, "server" : afs_server, "mbps" : rate_mbps(metric["bytes"], metric["duration"])}
+            record.update(metric)
 
-try:
-    os.kill(auther_pid, 15)
-    os.waitpid(auther_pid, 0)
+            metrics_handle.write(json.dumps(record, sort_keys=True) + "\n")
+
+        for (partition, summary) in partition_summaries.items():
+            record = {"record" : "partition", "run" : run_started, "server" : afs_server, "partition" : partition}
+            record.update(summary)
+
+            metrics_handle.write(json.dumps(record, sort_keys=True) + "\n")
 
-except:
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to kill authentication handling child process with PID " + str(auther_pid) + ". - NOC-NETCOOL-TICKET\n")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Failed to kill authentication handling child process with PID " + str(auther_pid) + ".\n", None)
+        record = {"record" : "server", "run" : run_started, "server" : afs_server}
+        record.update(server_summary)
 
+        metrics_handle.write(json.dumps(record, sort_keys=True) + "\n")
+        metrics_handle.close()
 
+    except IOError as err:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to write dump metrics " + metrics_file + ": " + str(err) + ".\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to write dump metrics " + metrics_file + ": " + str(err) + "\n", None)
 
+    try:
+        timeline_handle = open(timeline_file, "w")
+
+        timeline_handle.write("Dumps of server " + afs_server + " started " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(queued_time)) + ", finished " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(finish_time)) + "\n\n")
+        timeline_handle.write("%-10s %6s %10s %9s %8s %14s %10s\n" % ("Partition", "Dumps", "MB", "Span", "MB/s", "MB/s per dump", "Max wait"))
 
+        for (partition, summary) in sorted(partition_summaries.items(), key=lambda item: item[1]["span_seconds"], reverse=True):
+            timeline_handle.write("%-10s %6d %10.1f %9s %8.1f %14.1f %10s\n" % (
+                partition, summary["dumps"], summary["bytes"] / 1048576.0, datetime.timedelta(seconds=int(summary["span_seconds"])),
+                summary["mbps"], summary["mbps_per_dump"], datetime.timedelta(seconds=int(summary["max_wait"]))
+            ))
 
-print "AFS Backup " + str(os.getpid()) + " - Info - All dumper child processes have exited, calling out to netbackup to start the backup."
-syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - All dumper child processes have exited, calling out to netbackup to start the backup" + ".\n")
+        timeline_handle.write("\n%-9s %-9s %-9s %-10s %-11s %10s %8s  %s\n" % ("Start", "Finish", "Waited", "Partition", "Level", "MB", "MB/s", "Volume"))
 
-bpbackup_info = subprocess.Popen(["/usr/bin/sudo", "/usr/openv/netbackup/bin/bpbackup", "-p", "DATA-AFS-DUMP", "-L", "/var/log/afs-dump-netbackup.log", "-w", "/usr/local/dump"], stdin=None, stdout=None, shell=False)
-status = bpbackup_info.wait()
+        for metric in sorted(dump_metrics, key=lambda metric: metric["start"]):
+            timeline_handle.write("%-9s %-9s %-9s %-10s %-11s %10.1f %8.1f  %s%s\n" % (
+                "+" + str(datetime.timedelta(seconds=int(metric["start"] - queued_time))), "+" + str(datetime.timedelta(seconds=int(metric["start"] + metric["duration"] - queued_time))),
+                datetime.timedelta(seconds=int(metric["wait"])), metric["partition"], metric["level"], metric["bytes"] / 1048576.0,
+                rate_mbps(metric["bytes"], metric["duration"]), metric["volume"], "" if metric["ok"] else " (failed)"
+            ))
 
-if status != 0:
-    try_cleanup_temp_files()
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Netbackup returned non-zero error code " + str(status) + ". - NOC-NETCOOL-TICKET")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Netbackup returned non-zero error code " + str(status) + ".\n", None)
+        timeline_handle.close()
 
+    except IOError as err:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to write dump timeline " + timeline_file + ": " + str(err) + ".\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to write dump timeline " + timeline_file + ": " + str(err) + "\n", None)
 
+    print "AFS Backup " + str(os.getpid()) + " - Info - Dumped " + str(server_summary["bytes"] / 1048576) + " MB from server " + afs_server + " in " + str(datetime.timedelta(seconds=int(server_summary["span_seconds"]))) + " at " + str(server_summary["mbps"]) + " MB/s (" + str(server_summary["mbps_per_dump"]) + " MB/s per dump)"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Dumped " + str(server_summary["bytes"] / 1048576) + " MB from server " + afs_server + " in " + str(datetime.timedelta(seconds=int(server_summary["span_seconds"]))) + " at " + str(server_summary["mbps"]) + " MB/s (" + str(server_summary["mbps_per_dump"]) + " MB/s per dump).\n")
 
 
 
-print "AFS Backup " + str(os.getpid()) + " - Info - Backup completed, removing local copy of volumes"
-syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Backup completed, removing local copy of volumes.\n")
+# Write the size and SHA-256 digest of each compressed dump in the restore chain of the volumes dumped from a server
+# this run, and of the raw dump in it, next to the dumps so NetBackup has them with the dumps and afs_dump_restore.py
+# can check them
+# The earlier full and incremental dumps of each chain are carried forward from the history so a whole chain can be
+# checked against the manifest of its latest run (as afs_backup-chains.txt lists it) without finding each old one
+# One line per dump: file, bytes, sha256, raw bytes and raw sha256
+# Returns the manifest's path or None if it could not be written or there is nothing to put in it
+def write_checksum_manifest(afs_server, dumped_list, afs_backup_history):
+    if options.compress_level == 0:
+        return None
+
+    manifest_file = "/usr/local/dump/" + afs_server + "/afs_backup-checksums.txt"
 
-for afs_server in afs_servers:
     try:
-        shutil.rmtree("/usr/local/dump/" + afs_server)
+        manifest_handle = open(manifest_file, "w")
 
-    except:
-        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove local copy of volumes for server " + afs_server + ". - NOC-NETCOOL-TICKET")
-        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove local copy of volumes for server " + afs_server + ".\n", None)
+        manifest_handle.write("# file\tbytes\tsha256\traw bytes\traw sha256\n")
 
+        for volume in sorted(dumped_list):
+            for dump in volume_history(afs_backup_history, volume)["chain"]:
+                if "sha256" in dump:
+                    manifest_handle.write("\t".join([dump["file"], str(dump["bytes"]), dump["sha256"], str(dump["raw_bytes"]), dump["raw_sha256"]]) + "\n")
 
+        manifest_handle.close()
 
+        return manifest_file
 
+    except (IOError, OSError) as err:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to write checksum manifest " + manifest_file + ": " + str(err) + ". - NOC-NETCOOL-TICKET")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to write checksum manifest " + manifest_file + ": " + str(err) + "\n", None)
 
-# We're done, clean up after ourselves
-try:
-    unlog_info = subprocess.Popen(["/usr/bin/unlog"], stdin=None, stdout=None, shell=False)
-    status = unlog_info.wait()
+        return None
 
-except:
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove AFS token, unlog exited with status " + str(status) + ". - NOC-NETCOOL-TICKET\n")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove AFS token, unlog exited with status " + str(status) + ".\n", None)
 
 
+# Write the restore chain of each volume dumped from a server this run next to the dumps so it is backed up with them
+# One line per dump to apply, in order: volume, level, time of the dump, time it is incremental from and file
+# Returns the manifest's path or None if it could not be written
+def write_chain_manifest(afs_server, dumped_list, afs_backup_history):
+    manifest_file = "/usr/local/dump/" + afs_server + "/afs_backup-chains.txt"
 
-try:
-    kdestroy_info = subprocess.Popen(["/usr/bin/kdestroy"], stdin=None, stdout=None, shell=False)
-    status = kdestroy_info.wait()
+    try:
+        manifest_handle = open(manifest_file, "w")
 
-except:
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove Kerberos ticket, kdestroy exited with status " + str(status) + ". - NOC-NETCOOL-TICKET\n")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove Kerberos ticket, kdestroy exited with status " + str(status) + ".\n", None)
+        manifest_handle.write("# volume\tlevel\tdump time\tincremental since\tfile\n")
 
+        for volume in sorted(dumped_list):
+            for dump in volume_history(afs_backup_history, volume)["chain"]:
+                manifest_handle.write("\t".join([volume, dump["level"], str(dump["time"]), str(dump["since"]), dump["file"]]) + "\n")
 
+        manifest_handle.close()
 
-try:
-    os.remove("/home/afsdumper/afs_backup.lock")
+        return manifest_file
+
+    except (IOError, OSError) as err:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to write restore chain manifest " + manifest_file + ": " + str(err) + ". - NOC-NETCOOL-TICKET")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to write restore chain manifest " + manifest_file + ": " + str(err) + "\n", None)
+
+        return None
+
+
+
+# Return the backup history of a server's volumes saved by the last run (see volume_history()), the file it came from
+# and a list of (file, exception) of the files which could not be read
+# A pickle which can't be read (e.g. cut short by a crash) is passed over for the one before it, pickle_file-old,
+# if neither can be read the history is empty and the file None
+# Nothing is logged so afs_backup_simulator.py can use it too
+def read_history(pickle_file):
+    failures = []
+
+    for history_file in [pickle_file, pickle_file + "-old"]:
+        if not os.path.isfile(history_file):
+            continue
+
+        try:
+            pickle_handle = open(history_file, "rb")
+
+            afs_backup_history = pickle.load(pickle_handle)
+
+            pickle_handle.close()
+
+        except (IOError, pickle.UnpicklingError, EOFError, ValueError, KeyError, IndexError) as err:
+            failures.append((history_file, err))
+            continue
+
+        return (afs_backup_history, history_file, failures)
+
+    return ({}, None, failures)
+
+
+
+# Return the backup history of a server's volumes saved by the last run as read_history() does, saying what was found
+# When only pickle_file-old could be read the journal replayed after this fills in the dumps made since
+def load_history(pickle_file):
+    print "AFS Backup " + str(os.getpid()) + " - Info - Getting pickle file (" + pickle_file + ") of previous backups"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Getting pickle file (" + pickle_file + ") of previous backups")
+
+    (afs_backup_history, history_file, failures) = read_history(pickle_file)
+
+    for (failed_file, err) in failures:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to read pickle file (" + failed_file + ") of previous backups: " + repr(err) + ". - NOC-NETCOOL-TICKET")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to read pickle file (" + failed_file + ") of previous backups: " + repr(err) + "\n", None)
+
+    if history_file is None:
+        print "AFS Backup " + str(os.getpid()) + " - Warning - No pickle file (" + pickle_file + ") of previous backups found, moving on anyway"
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - No pickle file (" + pickle_file + ") of previous backups found, moving on anyway. - NOC-NETCOOL-TICKET")
+
+    elif history_file != pickle_file:
+        print "AFS Backup " + str(os.getpid()) + " - Warning - Using the previous pickle file (" + history_file + ") of previous backups, the journal has the rest"
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Using the previous pickle file (" + history_file + ") of previous backups, the journal has the rest")
+
+    return afs_backup_history
+
+
+
+# Save the backup history of a server's volumes, keeping the last one as pickle_file-old
+# The history is written to pickle_file.tmp and synced before being renamed over pickle_file so a crash at any point
+# leaves a whole pickle_file behind
+# Returns True if it was saved
+def save_history(pickle_file, afs_backup_history):
+    temp_file = pickle_file + ".tmp"
+
+    try:
+        pickle_handle = open(temp_file, "wb")
+
+        pickle.dump(afs_backup_history, pickle_handle)
+
+        pickle_handle.flush()
+        os.fsync(pickle_handle.fileno())
+        pickle_handle.close()
+
+        # Keep the last one as -old, linked rather than renamed so pickle_file is there until the new one replaces it
+        try:
+            os.unlink(pickle_file + "-old")
 
-except:
-    syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove lock file /var/log/afs_backup.lock. - NOC-NETCOOL-TICKET\n")
-    error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove lock file /var/log/afs_backup.lock found, exiting.\n", None)
+        except OSError:
+            pass
+
+        try:
+            os.link(pickle_file, pickle_file + "-old")
+
+        except OSError:
+            pass
+
+        os.rename(temp_file, pickle_file)
+
+        # Make sure the rename itself is on disk
+        dir_fd = os.open(os.path.dirname(pickle_file) or ".", os.O_RDONLY)
+        os.fsync(dir_fd)
+        os.close(dir_fd)
+
+    except (IOError, OSError, pickle.PicklingError) as err:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to save pickle file (" + pickle_file + ") of backup history: " + str(err) + ". - NOC-NETCOOL-TICKET")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to save pickle file (" + pickle_file + ") of backup history: " + str(err) + "\n", None)
+
+        return False
+
+    return True
+
+
+
+# Add a successful dump (a dict as described in volume_history()) to a volume's history
+def record_dump(afs_backup_history, volume, dump):
+    history = volume_history(afs_backup_history, volume)
+
+    if dump["level"] == "full":
+        history["full_time"] = dump["time"]
+        history["chain"] = [dump]
+
+    else:
+        history["chain"].append(dump)
+
+    history["last_time"] = dump["time"]
+
+
+
+# Each server's dumper keeps a journal of the volumes it dumped so a run which dies part way through is not lost.
+# It is a file of one JSON object per line, each written to disk before going on:
+# {"event": "begin", "time": ...}                              A run started
+# {"event": "resume", "time": ...}                             A run carried on with --resume
+# {"event": "dump", "volume": ..., "ok": ..., "dump": {...}}   A volume finished dumping, dump is as in volume_history()
+# {"event": "saved", "time": ...}                              The history was saved with every dump above in it
+
+# Write an event to a journal and make sure it is on disk
+def write_journal(journal_handle, event):
+    try:
+        journal_handle.write(json.dumps(event) + "\n")
+        journal_handle.flush()
+        os.fsync(journal_handle.fileno())
+
+    except (IOError, OSError) as err:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to write to the journal: " + str(err) + ".\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to write to the journal: " + str(err) + "\n", None)
+
+
+
+# Read a server's journal: add the dumps which never made it into the history to it and return a list of the
+# volumes dumped since the run the journal is for began
+def replay_journal(journal_file, afs_backup_history):
+    unsaved_dumps = []
+    done_list = []
+
+    if not os.path.isfile(journal_file):
+        return done_list
+
+    for line in open(journal_file, "r"):
+        try:
+            event = json.loads(line)
+
+        # A line cut short by a crash
+        except ValueError:
+            continue
+
+        if event["event"] == "begin":
+            done_list = []
+
+        elif event["event"] == "saved":
+            unsaved_dumps = []
+
+        elif event["event"] == "dump" and event["ok"]:
+            # JSON hands back unicode, the history is kept in plain strings
+            dump = dict((str(key), str(value) if isinstance(value, unicode) else value) for (key, value) in event["dump"].items())
+
+            unsaved_dumps.append((str(event["volume"]), dump))
+            done_list.append(str(event["volume"]))
+
+    if len(unsaved_dumps) > 0:
+        print "AFS Backup " + str(os.getpid()) + " - Warning - Adding " + str(len(unsaved_dumps)) + " dumps from journal " + journal_file + " a run did not save to the backup history"
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Adding " + str(len(unsaved_dumps)) + " dumps from journal " + journal_file + " a run did not save to the backup history.\n")
+
+    for (volume, dump) in unsaved_dumps:
+        record_dump(afs_backup_history, volume, dump)
+
+    return done_list
+
+
+
+# Remove what a run which died left in a server's staging directory so the final bpbackup doesn't send it to tape:
+# dumps cut short (*.partial) and any other file which is not the dump of a volume in done_list, the volumes the
+# journal shows were dumped (see replay_journal())
+# Returns the number of files removed
+def clean_staging(afs_server, done_list, afs_backup_history):
+    staging_dir = "/usr/local/dump/" + afs_server + "/"
+    keep_files = set(volume_history(afs_backup_history, volume)["chain"][-1]["file"] for volume in done_list)
+    removed_count = 0
+
+    try:
+        staged_files = os.listdir(staging_dir)
+
+    except OSError:
+        return removed_count
+
+    for staged_file in staged_files:
+        if staged_file in keep_files or not os.path.isfile(staging_dir + staged_file):
+            continue
+
+        try:
+            os.remove(staging_dir + staged_file)
+            removed_count = removed_count + 1
+
+        except OSError as err:
+            syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to remove left over file " + staging_dir + staged_file + ": " + str(err) + ".\n")
+            error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to remove left over file " + staging_dir + staged_file + ": " + str(err) + "\n", None)
+
+    if removed_count > 0:
+        print "AFS Backup " + str(os.getpid()) + " - Warning - Removed " + str(removed_count) + " partial or unjournaled files a run left in " + staging_dir
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Removed " + str(removed_count) + " partial or unjournaled files a run left in " + staging_dir + ".\n")
+
+    return removed_count
+
+
+
+# Return the day of the full period a day (as a date ordinal) is, Sundays are day 0 of a 7 day period
+def period_day(day):
+    return day % options.full_period
+
+
+
+# Give each volume (from list_backup_volumes()) the day of the full period it gets a full dump on as "full_day"
+# sunday:   Day 0 for everything
+# hash:     A day picked by the volume's name, which never changes and spreads the number of volumes evenly
+# balanced: The day with the least data to dump in full when the volume was first seen, largest volumes first,
+#           which is kept in its history so the volume keeps its day
+def assign_full_days(volumes, afs_backup_history):
+    if options.full_schedule == "sunday":
+        for volume_info in volumes:
+            volume_info["full_day"] = 0
+
+    elif options.full_schedule == "hash":
+        for volume_info in volumes:
+            volume_info["full_day"] = (zlib.crc32(volume_info["name"]) & 0xffffffff) % options.full_period
+
+    else:
+        day_sizes = [0] * options.full_period
+        new_volumes = []
+
+        for volume_info in volumes:
+            full_day = volume_history(afs_backup_history, volume_info["name"]).get("full_day")
+
+            # A day from a different length of period is as good as none
+            if full_day is None or full_day >= options.full_period:
+                new_volumes.append(volume_info)
+                continue
+
+            volume_info["full_day"] = full_day
+            day_sizes[full_day] = day_sizes[full_day] + volume_info["size"]
+
+        for volume_info in sorted(new_volumes, key=lambda volume_info: volume_info["size"], reverse=True):
+            full_day = day_sizes.index(min(day_sizes))
+
+            volume_info["full_day"] = full_day
+            volume_history(afs_backup_history, volume_info["name"])["full_day"] = full_day
+            day_sizes[full_day] = day_sizes[full_day] + volume_info["size"]
+
+
+
+# Return the volumes (from list_backup_volumes() after assign_full_days()) which need dumping on a day (as a date
+# ordinal) with each one's "level", "since" and "estimate" set for dump_volumes()
+# A volume gets a full dump on its day of the period or once its last full is a whole period old (e.g. its day was
+# missed), otherwise it gets an incremental dump if it changed since it was last dumped.  A volume with no full dump
+# to build on gets one if it changed.
+def plan_dumps(volumes, afs_backup_history, day):
+    dump_list = []
+    for volume_info in volumes:
+        history = volume_history(afs_backup_history, volume_info["name"])
+
+        if history["full_time"] is not None and day - datetime.date.fromtimestamp(history["full_time"]).toordinal() >= options.full_period:
+            (volume_info["level"], volume_info["since"]) = ("full", 0)
+
+        elif volume_info["full_day"] == period_day(day):
+            (volume_info["level"], volume_info["since"]) = ("full", 0)
+
+        # Check if the volume has changed since it was last backed up and only dump it if it has,
+        # taking in only what changed since then unless there is no full dump to build on
+        elif volume_changed(volume_info, afs_backup_history):
+            if history["full_time"] is None:
+                (volume_info["level"], volume_info["since"]) = ("full", 0)
+
+            else:
+                (volume_info["level"], volume_info["since"]) = ("incremental", history["last_time"])
+
+        else:
+            continue
+
+        volume_info["estimate"] = estimate_dump_size(volume_info, history)
+
+        dump_list.append(volume_info)
+
+    return dump_list
+
+
+
+# Return the KB a volume's dump is expected to be: its size for a full, otherwise the size of its last incremental
+# if it had one or its size if not
+def estimate_dump_size(volume_info, history):
+    if volume_info["level"] == "incremental":
+        for dump in reversed(history["chain"]):
+            if dump["level"] == "incremental" and "raw_bytes" in dump:
+                return dump["raw_bytes"] / 1024
+
+    return volume_info["size"]
+
+
+
+# Show the full dumps a server gets on each day of the next full period
+# Today includes the volumes due a full for any reason, later days only the ones on their day of the period.
+# Incrementals can't be known ahead of time so today's are shown at their volumes' full size as an upper bound.
+def show_schedule(afs_server):
+    afs_backup_history = load_history("/home/afsdumper/afs_backup-" + afs_server + ".pkl")
+
+    volumes = list_backup_volumes(afs_server)
+    assign_full_days(volumes, afs_backup_history)
+
+    today = datetime.date.today().toordinal()
+
+    print ""
+    print "Server " + afs_server + ": " + str(len(volumes)) + " volumes, " + options.full_schedule + " full schedule over " + str(options.full_period) + " days"
+    print "%-12s %-10s %10s %14s %14s %14s" % ("Date", "Day", "Fulls", "Full GB", "Incrementals", "Incr GB (max)")
+
+    for day in xrange(today, today + options.full_period):
+        if day == today:
+            dump_list = plan_dumps(volumes, afs_backup_history, day)
+
+        else:
+            dump_list = [dict(volume_info, level="full") for volume_info in volumes if volume_info["full_day"] == period_day(day)]
+
+        fulls = [volume_info["size"] for volume_info in dump_list if volume_info["level"] == "full"]
+        incrementals = [volume_info["size"] for volume_info in dump_list if volume_info["level"] == "incremental"]
+        date = datetime.date.fromordinal(day)
+
+        print "%-12s %-10s %10d %14.1f %14s %14s" % (
+            date.strftime("%Y-%m-%d"), date.strftime("%A"), len(fulls), sum(fulls) / 1048576.0,
+            str(len(incrementals)) if day == today else "-", "%.1f" % (sum(incrementals) / 1048576.0) if day == today else "-"
+        )
+
+
+
+# Dump the volumes of a server which need it and save its backup history, ran in a child process per server
+def dump_server(afs_server):
+    pickle_file = "/home/afsdumper/afs_backup-" + afs_server + ".pkl"
+    journal_file = "/home/afsdumper/afs_backup-" + afs_server + ".journal"
+
+    afs_backup_history = load_history(pickle_file)
+
+    # Pick up what a run which died left in the journal, the dumps it shows are whole and kept for the backup
+    done_list = replay_journal(journal_file, afs_backup_history)
+
+    clean_staging(afs_server, done_list, afs_backup_history)
+
+    try:
+        if options.resume:
+            journal_handle = open(journal_file, "a")
+
+            write_journal(journal_handle, {"event" : "resume", "time" : int(time.time())})
+
+            print "AFS Backup " + str(os.getpid()) + " - Info - Resuming, " + str(len(done_list)) + " volumes from server " + afs_server + " were already dumped"
+            syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Resuming, " + str(len(done_list)) + " volumes from server " + afs_server + " were already dumped.\n")
+
+        else:
+            # Make sure what was picked up is kept before the journal is started over
+            if len(done_list) > 0:
+                save_history(pickle_file, afs_backup_history)
+
+            done_list = []
+
+            journal_handle = open(journal_file, "w")
+
+            write_journal(journal_handle, {"event" : "begin", "time" : int(time.time())})
+
+    except IOError as err:
+        syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Failed to open journal " + journal_file + ": " + str(err) + ", moving on without it. - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Warning - Failed to open journal " + journal_file + ": " + str(err) + ", moving on without it\n", None)
+
+        journal_handle = None
+
+    print "AFS Backup " + str(os.getpid()) + " - Info - Dumping volumes from server " + afs_server
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Dumping volumes from server " + afs_server + ".\n")
+
+    volumes = list_backup_volumes(afs_server)
+
+    total_volume_count = len(volumes)
+
+    assign_full_days(volumes, afs_backup_history)
+    dump_list = plan_dumps(volumes, afs_backup_history, datetime.date.fromtimestamp(time.time()).toordinal())
+
+    if len(done_list) > 0:
+        done_set = set(done_list)
+        dump_list = [volume_info for volume_info in dump_list if volume_info["name"] not in done_set]
+
+    if options.pipeline:
+        pipeline = new_backup_pipeline(afs_server)
+
+    else:
+        pipeline = None
+
+    (failed_volume_count, dumped_list) = dump_volumes(afs_server, dump_list, afs_backup_history, pipeline, journal_handle)
+
+    # The manifests cover the whole run, resumed or not
+    dumped_list = sorted(set(done_list + dumped_list))
+
+    manifest_files = [write_chain_manifest(afs_server, dumped_list, afs_backup_history), write_checksum_manifest(afs_server, dumped_list, afs_backup_history)]
+
+    if pipeline is not None:
+        for manifest_file in manifest_files:
+            if manifest_file is not None:
+                pipeline["pending"].append(manifest_file)
+
+        flush_backup_pipeline(pipeline)
+
+        print "AFS Backup " + str(os.getpid()) + " - Info - Backed up dumps from server " + afs_server + " in " + str(pipeline["batches"]) + " batches, " + str(pipeline["failed"]) + " batches left for the final backup"
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Backed up dumps from server " + afs_server + " in " + str(pipeline["batches"]) + " batches, " + str(pipeline["failed"]) + " batches left for the final backup\n")
+
+    if failed_volume_count > 100:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to dump greater than 100 volumes from server " + afs_server + ". - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to dump greater than 100 volumes from server " + afs_server + "\n", None)
+
+    print "AFS Backup " + str(os.getpid()) + " - Info - Completed dump from server " + afs_server + ", " + str(total_volume_count) + " volumes found, " + str(failed_volume_count) + " volumes failed to dump"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Completed dump from server " + afs_server + ", " + str(total_volume_count) + " volumes found, " + str(failed_volume_count) + " volumes failed to dump\n")
+
+
+    if save_history(pickle_file, afs_backup_history) and journal_handle is not None:
+        write_journal(journal_handle, {"event" : "saved", "time" : int(time.time())})
+
+    if journal_handle is not None:
+        journal_handle.close()
+
+
+
+
+
+# Run a command for the authentication child with a timeout, return its exit status and output
+# A command which can't be ran (e.g. it is missing) or runs too long is given a status of -1, the latter is killed
+def run_auth_command(command, timeout=auth_command_timeout):
+    try:
+        command_info = subprocess.Popen(command, stdin=None, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False)
+
+    except OSError as err:
+        return (-1, "Failed to run " + command[0] + ": " + str(err) + "\n")
+
+    signal.alarm(timeout)
+
+    try:
+        output = command_info.communicate()[0]
+        signal.alarm(0)
+
+    except Alarm:
+        command_info.kill()
+        command_info.wait()
+
+        return (-1, "")
+
+    return (command_info.returncode, output)
+
+
+
+# Get a Kerberos 5 ticket from the keytab and an AFS token from it
+# Returns None if we're authenticated or a string saying why not
+def authenticate():
+    print "AFS Backup " + str(os.getpid()) + " - Info - Getting Kerberos 5 ticket using keytab " + kerberos_keytab
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Getting Kerberos 5 ticket using keytab " + kerberos_keytab + "\n")
+
+    status = run_auth_command(["/usr/bin/kinit", "-k", "-t", kerberos_keytab, "SOME_ADMIN_PRINCIPAL"])[0]
+
+    if status != 0:
+        return "Unable to get Kerberos ticket, kinit exited with a status of " + str(status)
+
+    print "AFS Backup " + str(os.getpid()) + " - Info - Getting AFS token"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Getting AFS token\n")
+
+    status = run_auth_command(["/usr/bin/aklog"])[0]
+
+    if status != 0:
+        return "Unable to get AFS token, aklog exited with a status of " + str(status)
+
+    return None
+
+
+
+# Return when the first of our Kerberos ticket and AFS token expires (seconds since the epoch) or None if we can't tell
+def credentials_expire():
+    expiry_times = []
+
+    # e.g. "10/18/15 21:00:00  10/19/15 07:00:00  krbtgt/PITT.EDU@PITT.EDU"
+    (status, output) = run_auth_command(["/usr/bin/klist"])
+
+    for line in output.splitlines():
+        fields = line.split()
+
+        if status != 0 or len(fields) < 5 or not fields[4].startswith("krbtgt/"):
+            continue
+
+        for time_format in ["%m/%d/%y %H:%M:%S", "%m/%d/%Y %H:%M:%S"]:
+            try:
+                expiry_times.append(int(time.mktime(time.strptime(fields[2] + " " + fields[3], time_format))))
+                break
+
+            except ValueError:
+                pass
+
+    # e.g. "User's (AFS ID 1234) tokens for afs@pitt.edu [Expires Oct 19 07:00]", the year is not given
+    (status, output) = run_auth_command(["/usr/bin/tokens"])
+
+    for line in output.splitlines():
+        if status != 0 or " tokens for " not in line:
+            continue
+
+        if "Expired" in line and "[Expires" not in line:
+            expiry_times.append(0)
+            continue
+
+        match = re.search("\\[Expires (\\w+ +\\d+ \\d+:\\d+)\\]", line)
+
+        if match is None:
+            continue
+
+        this_year = time.localtime().tm_year
+
+        try:
+            expires = int(time.mktime(time.strptime(str(this_year) + " " + match.group(1), "%Y %b %d %H:%M")))
+
+        except ValueError:
+            continue
+
+        # A token made late in December can expire next year
+        if expires < time.time() - 86400:
+            expires = int(time.mktime(time.strptime(str(this_year + 1) + " " + match.group(1), "%Y %b %d %H:%M")))
+
+        expiry_times.append(expires)
+
+    if len(expiry_times) < 2:
+        return None
+
+    return min(expiry_times)
+
+
+
+# Keep us authenticated, ran in a child process until it is killed
+# The first outcome is written to ready_fd ("ready" or "failed <why>") so dumping starts the moment we're authenticated.
+# Renewal is done a quarter of the remaining lifetime before the ticket or token expires and at least 10 minutes
+# before, or hourly if we can't tell when they expire.  If renewal fails auth_failed_file is made saying why so
+# the dumpers stop starting dumps which would fail.
+def keep_authenticated(ready_fd):
+    while True:
+        problem = authenticate()
+
+        if problem is None:
+            expires = credentials_expire()
+
+            if expires is not None and expires <= time.time():
+                problem = "Kerberos ticket or AFS token expired as soon as we got it"
+
+        if problem is not None:
+            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - " + problem + ", exiting. - NOC-NETCOOL-TICKET")
+            error("AFS Backup " + str(os.getpid()) + " - Error - " + problem + ", exiting.\n", None)
+
+            if ready_fd is not None:
+                os.write(ready_fd, "failed " + problem + "\n")
+
+            else:
+                try:
+                    auth_failed_handle = open(auth_failed_file, "w")
+                    auth_failed_handle.write(problem + "\n")
+                    auth_failed_handle.close()
+
+                except IOError:
+                    pass
+
+            sys.exit(1)
+
+        if ready_fd is not None:
+            os.write(ready_fd, "ready\n")
+            os.close(ready_fd)
+            ready_fd = None
+
+        if expires is None:
+            wakeup_time = int(time.time()) + (60 * 60)
+
+        else:
+            remaining = expires - time.time()
+            wakeup_time = int(time.time() + max(60, min(remaining * 0.75, remaining - 600)))
+
+        print "AFS Backup " + str(os.getpid()) + " - Info - Authenticated, renewing at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(wakeup_time))
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Authenticated, renewing at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(wakeup_time)) + "\n")
+
+        while time.time() < wakeup_time:
+            time.sleep(min(60, max(1, wakeup_time - time.time())))
+
+
+
+
+
+# Only run when called, afs_backup_simulator.py imports the functions above
+if __name__ == "__main__":
+    # Prepare syslog
+    syslog.openlog(os.path.basename(sys.argv[0]), syslog.LOG_NOWAIT, syslog.LOG_DAEMON)
+
+
+
+    # Only show what the full schedule or today's run would do, nothing is dumped so no lock or authentication is needed
+    if options.show_schedule:
+        for afs_server in afs_servers:
+            show_schedule(afs_server)
+
+        sys.exit(0)
+
+    if options.dry_run:
+        for afs_server in afs_servers:
+            show_dry_run(afs_server)
+
+        sys.exit(0)
+
+
+
+
+
+    # With --resume a lock left by a run which is no longer going is taken over
+    if options.resume and os.path.exists("/home/afsdumper/afs_backup.lock"):
+        try:
+            lock_file_handle = open("/home/afsdumper/afs_backup.lock", "r")
+            lock_pid = int(lock_file_handle.read().strip())
+            lock_file_handle.close()
+
+            os.kill(lock_pid, 0)
+
+        except (IOError, ValueError):
+            lock_pid = None
+
+        except OSError as err:
+            if err.errno == errno.ESRCH:
+                print "AFS Backup " + str(os.getpid()) + " - Warning - Taking over lock file /home/afsdumper/afs_backup.lock of run " + str(lock_pid) + " which is no longer going"
+                syslog.syslog(syslog.LOG_WARNING, "AFS Backup " + str(os.getpid()) + " - Warning - Taking over lock file /home/afsdumper/afs_backup.lock of run " + str(lock_pid) + " which is no longer going.\n")
+
+                os.remove("/home/afsdumper/afs_backup.lock")
+
+    if os.path.exists("/home/afsdumper/afs_backup.lock"):
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Existing lock file /home/afsdumper/afs_backup.lock found, exiting. - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Existing lock file /home/afsdumper/afs_backup.lock found, exiting.\n", 1)
+
+
+
+    print "AFS Backup " + str(os.getpid()) + " - Info - Creating lock file"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Creating lock file.\n")
+
+    try:
+        lock_file_handle = open("/home/afsdumper/afs_backup.lock", "w")
+        lock_file_handle.write(str(os.getpid()))
+        lock_file_handle.close()
+
+    except:
+        try_cleanup_temp_files()
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to create lock file /home/afsdumper/afs_backup.lock, exiting. - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to create lock file /home/afsdumper/afs_backup.lock found, exiting.\n", 1)
+
+
+
+
+
+    print "AFS Backup " + str(os.getpid()) + " - Info - Forking child to handle Kerberos and AFS authentication"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Forking child to handle Kerberos and AFS authentication\n")
+
+    # A flag left by an earlier run means nothing now
+    try:
+        os.remove(auth_failed_file)
+
+    except OSError:
+        pass
+
+    (ready_read_fd, ready_write_fd) = os.pipe()
+
+    pid = os.fork()
+
+    if pid == 0: # We're the child
+        os.setsid()
+        os.close(ready_read_fd)
+
+        keep_authenticated(ready_write_fd)
+
+
+    else: # We're the parent
+        auther_pid = pid
+        os.close(ready_write_fd)
+
+        print "AFS Backup " + str(os.getpid()) + " - Info - Authentication handling child had pid " + str(auther_pid) + ", waiting for it to authenticate"
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Authentication handling child had pid " + str(auther_pid) + ", waiting for it to authenticate\n")
+
+        # Start as soon as the child says we're authenticated, it runs kinit, aklog, klist and tokens first and each
+        # gets auth_command_timeout seconds, a minute more is given for the child to start and report back
+        ready = ""
+        wait_until = time.time() + auth_command_timeout * 4 + 60
+        while not ready.endswith("\n") and time.time() < wait_until:
+            try:
+                if len(select.select([ready_read_fd], [], [], wait_until - time.time())[0]) == 0:
+                    break
+
+                data = os.read(ready_read_fd, 4096)
+
+            except (OSError, select.error) as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+
+                raise
+
+            # The child went away without saying anything
+            if data == "":
+                break
+
+            ready = ready + data
+
+        os.close(ready_read_fd)
+
+        if ready.strip() != "ready":
+            if ready.startswith("failed "):
+                problem = ready[len("failed "):].strip()
+
+            else:
+                problem = "Authentication handling child did not authenticate in time"
+
+            try_cleanup_temp_files()
+            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - " + problem + ", exiting. - NOC-NETCOOL-TICKET")
+            error("AFS Backup " + str(os.getpid()) + " - Error - " + problem + ", exiting.\n", 1)
+
+
+
+
+
+    dumper_pids = []
+    for afs_server in afs_servers:
+        print "AFS Backup " + str(os.getpid()) + " - Info - Forking child to dump volumes from " + afs_server
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Forking child to dump volumes from " + afs_server + ".\n")
+
+        if os.path.exists("/usr/local/dump/" + afs_server) is False:
+            os.mkdir("/usr/local/dump/" + afs_server)
+
+        pid = os.fork()
+
+        if pid == 0: # We're the child
+            os.setsid()
+
+            dump_server(afs_server)
+
+            sys.exit(0)
+
+
+        else:
+            print "AFS Backup " + str(os.getpid()) + " - Info - Dumper process for server " + afs_server + " has pid " + str(pid)
+            syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Dumper process for server " + afs_server + " has pid " + str(pid) + ".\n")
+
+            dumper_pids.append(pid)
+
+
+
+    # Wait for our children to exit
+    for dumper_pid in dumper_pids:
+        os.waitpid(dumper_pid, 0)
+
+    if os.path.exists(auth_failed_file):
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Lost authentication part way through, volumes were left undumped. - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Lost authentication part way through, volumes were left undumped.\n", None)
+
+
+
+
+
+    try:
+        os.kill(auther_pid, 15)
+        os.waitpid(auther_pid, 0)
+
+    except:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to kill authentication handling child process with PID " + str(auther_pid) + ". - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to kill authentication handling child process with PID " + str(auther_pid) + ".\n", None)
+
+
+
+
+
+    # With --pipeline the dumpers backed up their dumps as they went, only what they could not back up is left
+    left_over_dumps = True
+
+    if options.pipeline:
+        left_over_dumps = False
+
+        for afs_server in afs_servers:
+            if os.path.isdir("/usr/local/dump/" + afs_server) and len(os.listdir("/usr/local/dump/" + afs_server)) > 0:
+                left_over_dumps = True
+
+    if left_over_dumps:
+        print "AFS Backup " + str(os.getpid()) + " - Info - All dumper child processes have exited, calling out to netbackup to start the backup."
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - All dumper child processes have exited, calling out to netbackup to start the backup" + ".\n")
+
+        bpbackup_info = subprocess.Popen(bpbackup_command + ["/usr/local/dump"], stdin=None, stdout=None, shell=False)
+        status = bpbackup_info.wait()
+
+        if status != 0:
+            try_cleanup_temp_files()
+            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Netbackup returned non-zero error code " + str(status) + ". - NOC-NETCOOL-TICKET")
+            error("AFS Backup " + str(os.getpid()) + " - Error - Netbackup returned non-zero error code " + str(status) + ".\n", None)
+
+    else:
+        print "AFS Backup " + str(os.getpid()) + " - Info - All dumper child processes have exited and backed up their dumps, nothing is left for netbackup"
+        syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - All dumper child processes have exited and backed up their dumps, nothing is left for netbackup.\n")
+
+
+
+
+
+    print "AFS Backup " + str(os.getpid()) + " - Info - Backup completed, removing local copy of volumes"
+    syslog.syslog(syslog.LOG_INFO, "AFS Backup " + str(os.getpid()) + " - Info - Backup completed, removing local copy of volumes.\n")
+
+    for afs_server in afs_servers:
+        try:
+            shutil.rmtree("/usr/local/dump/" + afs_server)
+
+        except:
+            syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove local copy of volumes for server " + afs_server + ". - NOC-NETCOOL-TICKET")
+            error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove local copy of volumes for server " + afs_server + ".\n", None)
+
+
+
+
+
+    # We're done, clean up after ourselves
+    try:
+        unlog_info = subprocess.Popen(["/usr/bin/unlog"], stdin=None, stdout=None, shell=False)
+        status = unlog_info.wait()
+
+    except:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove AFS token, unlog exited with status " + str(status) + ". - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove AFS token, unlog exited with status " + str(status) + ".\n", None)
+
+
+
+    try:
+        kdestroy_info = subprocess.Popen(["/usr/bin/kdestroy"], stdin=None, stdout=None, shell=False)
+        status = kdestroy_info.wait()
+
+    except:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove Kerberos ticket, kdestroy exited with status " + str(status) + ". - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove Kerberos ticket, kdestroy exited with status " + str(status) + ".\n", None)
+
+
+
+    try:
+        os.remove("/home/afsdumper/afs_backup.lock")
+
+    except:
+        syslog.syslog(syslog.LOG_ERR, "AFS Backup " + str(os.getpid()) + " - Error - Failed to remove lock file /var/log/afs_backup.lock. - NOC-NETCOOL-TICKET\n")
+        error("AFS Backup " + str(os.getpid()) + " - Error - Failed to remove lock file /var/log/afs_backup.lock found, exiting.\n", None)
 
 
 
-syslog.closelog()
+    syslog.closelog()
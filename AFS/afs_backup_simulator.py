@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# Description: Simulate a night of afs_backup.py offline from a recorded volume inventory and measured throughput
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+import sys
+import os
+import tempfile
+import shutil
+import subprocess
+import datetime
+import time
+import json
+import heapq
+from optparse import OptionParser
+
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+weekdays = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+
+
+# How were we called?
+parser = OptionParser("%prog [options] inventory_dir [afs_backup.py options]\n" +
+    "Simulate a night of afs_backup.py offline to see what a change of concurrency, order, budget, pipeline or full schedule does.\n" +
+    "inventory_dir holds a recorded \"vos listvol SERVER -format\" of each fileserver as SERVER.listvol, replayed by afs_fake_vos.py.\n" +
+    "afs_backup.py's own volume selection, full schedule and dump order are used with the afs_backup.py options given after\n" +
+    "inventory_dir, e.g. \"%prog /tmp/inventory --dumps-per-server 6 --pipeline --full-schedule balanced\".\n" +
+    "Each dump takes its server's per dump overhead plus its expected size at the server's MB/s, measured from afs_backup.py's\n" +
+    "metrics file where there is one.  Shows when dumping and backing up finish, the peak space used in /usr/local/dump\n" +
+    "and the load put on NetBackup."
+)
+
+parser.disable_interspersed_args()
+
+parser.add_option(
+    "--day",
+    action="store", type="string", dest="day", default=None,
+    help="Day to simulate, a day of the week (the next one, today included) or YYYY-MM-DD (default: today)"
+)
+
+parser.add_option(
+    "--start",
+    action="store", type="string", dest="start", default="22:00", metavar="HH:MM",
+    help="Time of day the run starts at, for afs_backup.py's --budget (default: %default)"
+)
+
+parser.add_option(
+    "--history-dir",
+    action="store", type="string", dest="history_dir", default=None,
+    help="Directory with a copy of afs_backup.py's afs_backup-SERVER.pkl backup history of each server, without one every volume " +
+        "gets a full dump (default: inventory_dir)"
+)
+
+parser.add_option(
+    "--metrics-dir",
+    action="store", type="string", dest="metrics_dir", default=None,
+    help="Directory with a copy of afs_backup.py's afs_backup-SERVER-metrics.jsonl of each server to measure its throughput from " +
+        "(default: inventory_dir)"
+)
+
+parser.add_option(
+    "--model",
+    action="append", type="string", dest="models", default=[], metavar="SERVER=MBPS[/OVERHEAD]",
+    help="MB/s each dump from a server runs at and seconds of overhead per dump, rather than measuring them.  Servers with " +
+        "neither a model nor metrics use afs_backup.py's --dump-mbps and --dump-overhead.  May be given more than once."
+)
+
+parser.add_option(
+    "--compress-ratio",
+    action="store", type="float", dest="compress_ratio", default=None,
+    help="Size of a compressed dump as a fraction of the raw dump (default: measured from the metrics, or 1 if there are none)"
+)
+
+parser.add_option(
+    "--netbackup-mbps",
+    action="store", type="float", dest="netbackup_mbps", default=100,
+    help="MB/s each bpbackup backs up dumps at (default: %default)"
+)
+
+parser.add_option(
+    "--netbackup-overhead",
+    action="store", type="float", dest="netbackup_overhead", default=60,
+    help="Seconds each bpbackup takes on top of moving its data (default: %default)"
+)
+
+parser.add_option(
+    "-s", "--server",
+    action="append", type="string", dest="servers", default=[],
+    help="Only simulate this server, may be given more than once (default: every server in inventory_dir)"
+)
+
+(options, args) = parser.parse_args()
+
+if len(args) < 1:
+    parser.error("An inventory directory is needed, see --help")
+
+inventory_dir = args[0]
+
+if not os.path.isdir(inventory_dir):
+    parser.error("Inventory directory " + inventory_dir + " does not exist")
+
+if options.history_dir is None:
+    options.history_dir = inventory_dir
+
+if options.metrics_dir is None:
+    options.metrics_dir = inventory_dir
+
+if options.netbackup_mbps <= 0:
+    parser.error("--netbackup-mbps must be more than 0")
+
+models = {}
+for model in options.models:
+    try:
+        (afs_server, limits) = model.split("=", 1)
+
+        if "/" in limits:
+            (mbps, overhead) = limits.split("/", 1)
+            models[afs_server] = (float(mbps), float(overhead))
+
+        else:
+            models[afs_server] = (float(limits), None)
+
+    except ValueError:
+        parser.error("Invalid --model " + model + ", expected SERVER=MBPS[/OVERHEAD]")
+
+    if models[afs_server][0] <= 0:
+        parser.error("Invalid --model " + model + ", MB/s must be more than 0")
+
+try:
+    start_minute = int(options.start.split(":")[0]) * 60 + int(options.start.split(":")[1])
+
+except (ValueError, IndexError):
+    parser.error("Invalid --start " + options.start + ", expected HH:MM")
+
+# afs_backup.py reads its options when loaded, give it the ones after the inventory directory
+sys.argv = [os.path.join(script_dir, "afs_backup.py")] + args[1:]
+sys.path.insert(0, script_dir)
+sys.dont_write_bytecode = True
+
+import afs_backup
+
+# --debug would have volume_changed() log every volume to syslog
+afs_backup.options.debug = False
+
+
+
+# Return the date to simulate from --day
+def simulated_day(day):
+    today = datetime.date.today()
+
+    if day is None:
+        return today
+
+    if day.lower() in weekdays:
+        return today + datetime.timedelta(days=(weekdays.index(day.lower()) - today.weekday()) % 7)
+
+    try:
+        return datetime.datetime.strptime(day, "%Y-%m-%d").date()
+
+    except ValueError:
+        parser.error("Invalid --day " + day + ", expected a day of the week or YYYY-MM-DD")
+
+
+
+# Return (MB/s, seconds of overhead, stored bytes per raw byte or None, number of dumps) of a server measured from the
+# volume records of its metrics file, or None if there are none
+# The MB/s and overhead are a least squares fit of each dump's duration to its size, so small dumps which are all
+# overhead and large ones which are all data both count for what they are
+def measured_model(afs_server):
+    metrics_file = os.path.join(options.metrics_dir, "afs_backup-" + afs_server + "-metrics.jsonl")
+
+    if not os.path.isfile(metrics_file):
+        return None
+
+    samples = []
+    for line in open(metrics_file, "r"):
+        try:
+            record = json.loads(line)
+
+        except ValueError:
+            continue
+
+        if record.get("record") == "volume" and record.get("ok") and record.get("duration", 0) > 0:
+            samples.append((record["bytes"], record["duration"], record["file_bytes"]))
+
+    if len(samples) == 0:
+        return None
+
+    total_bytes = sum(sample[0] for sample in samples)
+    total_seconds = sum(sample[1] for sample in samples)
+
+    if total_bytes > 0:
+        ratio = sum(sample[2] for sample in samples) / float(total_bytes)
+
+    else:
+        ratio = None
+
+    mean_bytes = total_bytes / float(len(samples))
+    mean_seconds = total_seconds / len(samples)
+    variance = sum((sample[0] - mean_bytes) ** 2 for sample in samples)
+
+    if variance > 0:
+        seconds_per_byte = sum((sample[0] - mean_bytes) * (sample[1] - mean_seconds) for sample in samples) / variance
+
+    else:
+        seconds_per_byte = 0
+
+    # Too few or too alike dumps to tell overhead from data, take it all as data
+    if seconds_per_byte <= 0 or mean_seconds - seconds_per_byte * mean_bytes < 0:
+        if total_bytes == 0:
+            return None
+
+        return (total_bytes / 1048576.0 / total_seconds, 0.0, ratio, len(samples))
+
+    return (1 / (seconds_per_byte * 1048576.0), mean_seconds - seconds_per_byte * mean_bytes, ratio, len(samples))
+
+
+
+# Simulate a server's dumps on a day as afs_backup.py's dump_volumes() and backup pipeline would run them, starting at
+# start_time (seconds since the epoch) with each dump taking overhead seconds plus its expected size at mbps
+# Returns a dict of the server's plan and what happened when, all times in seconds from the start:
+# volumes, fulls, incrementals   Number of volumes and of each level of dump
+# raw_bytes, stored_bytes        Bytes dumped and bytes written to /usr/local/dump
+# dumps_finish                   When the last dump finishes
+# partition_finish               When the last dump of each partition finishes
+# staging                        (time, bytes) of every change to the space used in /usr/local/dump
+# batches                        (start, finish, bytes) of every bpbackup with --pipeline
+def simulate_server(afs_server, day, start_time, mbps, overhead, ratio):
+    # afs_backup.py's quiet helpers only, what it logs goes to syslog (and tickets) as if it were a real run
+    (afs_backup_history, history_file, failures) = afs_backup.read_history(os.path.join(options.history_dir, "afs_backup-" + afs_server + ".pkl"))
+
+    for (failed_file, err) in failures:
+        sys.stderr.write("Failed to read backup history " + failed_file + ": " + repr(err) + "\n")
+
+    if history_file is None:
+        sys.stderr.write("No backup history for server " + afs_server + " in " + options.history_dir + ", every volume gets a full dump\n")
+
+    vos_info = subprocess.Popen([vos_path, "listvol", afs_server, "-format"], stdin=None, stdout=subprocess.PIPE, shell=False)
+    (volumes, unknown_update_list) = afs_backup.parse_listvol(iter(vos_info.stdout.readline, ""))
+
+    if vos_info.wait() != 0:
+        sys.stderr.write("Stand-in vos failed to list the recorded inventory of server " + afs_server + "\n")
+
+    afs_backup.assign_full_days(volumes, afs_backup_history)
+    dump_list = afs_backup.plan_dumps(volumes, afs_backup_history, day.toordinal())
+
+    (queues, partition_order) = afs_backup.make_dump_queues(dump_list)
+    partition_running = dict((partition, 0) for partition in partition_order)
+
+    result = {
+        "volumes" : len(volumes),
+        "fulls" : len([volume_info for volume_info in dump_list if volume_info["level"] == "full"]),
+        "incrementals" : len([volume_info for volume_info in dump_list if volume_info["level"] == "incremental"]),
+        "raw_bytes" : 0, "stored_bytes" : 0, "dumps_finish" : 0.0,
+        "partition_finish" : dict((partition, 0.0) for partition in partition_order),
+        "staging" : [], "batches" : [],
+    }
+
+    events = [] # (time, "dump" or "batch", partition, stored bytes) as a heap
+    running_dumps = 0
+    batch_running = False
+    (pending_dumps, pending_bytes) = (0, 0)
+    now = 0.0
+
+    while True:
+        (budget_dumps, budget_mbps) = afs_backup.current_budget(start_time + now)
+
+        while running_dumps < budget_dumps:
+            volume_info = afs_backup.next_volume(queues, partition_order, partition_running)
+
+            if volume_info is None:
+                break
+
+            # A MB/s budget is shared by the dumps running, taken as split evenly between as many as it allows
+            dump_mbps = mbps
+
+            if budget_mbps is not None:
+                dump_mbps = min(dump_mbps, budget_mbps / budget_dumps)
+
+            raw_bytes = volume_info["estimate"] * 1024
+            stored_bytes = int(raw_bytes * ratio)
+
+            heapq.heappush(events, (now + overhead + raw_bytes / 1048576.0 / dump_mbps, "dump", volume_info["partition"], stored_bytes))
+            partition_running[volume_info["partition"]] = partition_running[volume_info["partition"]] + 1
+            running_dumps = running_dumps + 1
+
+            # The dump's file is counted at its full size from the start
+            result["staging"].append((now, stored_bytes))
+            result["raw_bytes"] = result["raw_bytes"] + raw_bytes
+            result["stored_bytes"] = result["stored_bytes"] + stored_bytes
+
+        # Batches start once enough is waiting, or with whatever is left once dumping is done
+        dumping_done = running_dumps == 0 and len([queue for queue in queues.values() if len(queue) > 0]) == 0
+
+        if afs_backup.options.pipeline and not batch_running and pending_dumps > 0 and \
+            (dumping_done or pending_dumps >= afs_backup.options.batch_volumes or pending_bytes >= afs_backup.options.batch_gb * 1073741824):
+            seconds = options.netbackup_overhead + pending_bytes / 1048576.0 / options.netbackup_mbps
+
+            heapq.heappush(events, (now + seconds, "batch", None, pending_bytes))
+            result["batches"].append((now, now + seconds, pending_bytes))
+            batch_running = True
+            (pending_dumps, pending_bytes) = (0, 0)
+
+        if len(events) == 0:
+            break
+
+        (now, kind, partition, stored_bytes) = heapq.heappop(events)
+
+        if kind == "dump":
+            partition_running[partition] = partition_running[partition] - 1
+            running_dumps = running_dumps - 1
+
+            result["partition_finish"][partition] = now
+            result["dumps_finish"] = now
+
+            (pending_dumps, pending_bytes) = (pending_dumps + 1, pending_bytes + stored_bytes)
+
+        # A batch backed up is removed from /usr/local/dump
+        else:
+            batch_running = False
+            result["staging"].append((now, -stored_bytes))
+
+    return result
+
+
+
+# Return (peak, time of the peak) of the running total of a list of (time, change), removals at the same time first
+def peak_of(changes):
+    (total, peak, peak_time) = (0, 0, 0.0)
+
+    for (change_time, change) in sorted(changes):
+        total = total + change
+
+        if total > peak:
+            (peak, peak_time) = (total, change_time)
+
+    return (peak, peak_time)
+
+
+
+# Return (bytes, start of the hour) of the hour from the start of the run NetBackup is sent the most in, taking each
+# backup's bytes as sent evenly over its time
+def busiest_hour(backups):
+    hours = {}
+
+    for (start, finish, backup_bytes) in backups:
+        rate = backup_bytes / max(finish - start, 1.0)
+
+        for hour in xrange(int(start // 3600), int(finish // 3600) + 1):
+            overlap = min(finish, (hour + 1) * 3600) - max(start, hour * 3600)
+
+            if overlap > 0:
+                hours[hour] = hours.get(hour, 0) + rate * overlap
+
+    if len(hours) == 0:
+        return (0, 0)
+
+    hour = max(hours, key=lambda hour: hours[hour])
+
+    return (hours[hour], hour * 3600)
+
+
+
+def gb(byte_count):
+    return "%.1f" % (byte_count / 1073741824.0)
+
+
+
+def after(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+
+
+
+day = simulated_day(options.day)
+start_time = time.mktime(day.timetuple()) + start_minute * 60
+
+if len(options.servers) > 0:
+    afs_servers = options.servers
+
+else:
+    afs_servers = sorted(listvol_file[:-len(".listvol")] for listvol_file in os.listdir(inventory_dir) if listvol_file.endswith(".listvol"))
+
+if len(afs_servers) == 0:
+    parser.error("No recorded inventories (SERVER.listvol) found in " + inventory_dir)
+
+work_dir = tempfile.mkdtemp(prefix="afs_backup_simulator.")
+
+try:
+    # Everything afs_backup.py asks vos is answered from the recorded inventory
+    subprocess.check_call([sys.executable, os.path.join(script_dir, "afs_fake_vos.py"), "--install", work_dir])
+    os.environ["AFS_FAKE_VOS_INVENTORY"] = os.path.abspath(inventory_dir)
+    vos_path = os.path.join(work_dir, "vos")
+
+    results = {}
+    for afs_server in afs_servers:
+        measured = measured_model(afs_server)
+
+        if afs_server in models:
+            (mbps, overhead) = models[afs_server]
+
+            if overhead is None:
+                overhead = afs_backup.options.dump_overhead
+
+            source = "given"
+
+        elif measured is not None:
+            (mbps, overhead) = measured[0:2]
+            source = "measured from " + str(measured[3]) + " dumps"
+
+        else:
+            (mbps, overhead) = (afs_backup.options.dump_mbps, afs_backup.options.dump_overhead)
+            source = "--dump-mbps"
+
+        if afs_backup.options.compress_level == 0:
+            ratio = 1.0
+
+        elif options.compress_ratio is not None:
+            ratio = options.compress_ratio
+
+        elif measured is not None and measured[2] is not None:
+            ratio = measured[2]
+
+        else:
+            ratio = 1.0
+
+        results[afs_server] = simulate_server(afs_server, day, start_time, mbps, overhead, ratio)
+        results[afs_server].update({"mbps" : mbps, "overhead" : overhead, "ratio" : ratio, "source" : source})
+
+finally:
+    shutil.rmtree(work_dir)
+
+
+
+print ""
+print "Simulated " + day.strftime("%A %Y-%m-%d") + " starting at " + options.start + ": " + afs_backup.options.order + " order, " + \
+    str(afs_backup.options.dumps_per_server) + " dumps per server, " + str(afs_backup.options.dumps_per_partition) + " per partition, " + \
+    afs_backup.options.full_schedule + " full schedule, " + ("pipeline" if afs_backup.options.pipeline else "one backup at the end") + \
+    (", " + str(len(afs_backup.options.budgets)) + " budget windows" if len(afs_backup.options.budgets) > 0 else "")
+print ""
+print "%-28s %8s %7s %7s %9s %9s %7s %9s %11s %11s  %s" % ("Server", "Volumes", "Fulls", "Incrs", "Dump GB", "Stored GB", "MB/s", "Overhead", "Dumps done", "Backed up", "Model")
+
+backups = []
+for afs_server in afs_servers:
+    result = results[afs_server]
+
+    if len(result["batches"]) > 0:
+        result["finish"] = max(result["dumps_finish"], result["batches"][-1][1])
+
+    else:
+        result["finish"] = result["dumps_finish"]
+
+    backups.extend(result["batches"])
+
+    print "%-28s %8d %7d %7d %9s %9s %7.1f %9.1f %11s %11s  %s" % (
+        afs_server, result["volumes"], result["fulls"], result["incrementals"], gb(result["raw_bytes"]), gb(result["stored_bytes"]),
+        result["mbps"], result["overhead"], after(result["dumps_finish"]), after(result["finish"]) if afs_backup.options.pipeline else "-", result["source"]
+    )
+
+    if len(result["partition_finish"]) > 0:
+        slowest = max(result["partition_finish"], key=lambda partition: result["partition_finish"][partition])
+        print "%-28s slowest partition %s finishes after %s" % ("", slowest, after(result["partition_finish"][slowest]))
+
+dumps_finish = max(results[afs_server]["dumps_finish"] for afs_server in afs_servers)
+staging = [change for afs_server in afs_servers for change in results[afs_server]["staging"]]
+
+# Without the pipeline (or for what is left after it) everything is backed up once every server is done, then removed
+if afs_backup.options.pipeline:
+    finish = max(results[afs_server]["finish"] for afs_server in afs_servers)
+
+else:
+    total_stored = sum(results[afs_server]["stored_bytes"] for afs_server in afs_servers)
+    finish = dumps_finish + options.netbackup_overhead + total_stored / 1048576.0 / options.netbackup_mbps
+
+    backups.append((dumps_finish, finish, total_stored))
+    staging.append((finish, -total_stored))
+
+(staging_peak, staging_peak_time) = peak_of(staging)
+(streams_peak, streams_peak_time) = peak_of([(start, 1) for (start, finish_time, backup_bytes) in backups] + [(finish_time, -1) for (start, finish_time, backup_bytes) in backups])
+(hour_bytes, hour_start) = busiest_hour(backups)
+
+print ""
+print "Dumping finishes after " + after(dumps_finish) + " at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(start_time + dumps_finish))
+print "Backing up finishes after " + after(finish) + " at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(start_time + finish))
+print "/usr/local/dump peaks at " + gb(staging_peak) + " GB after " + after(staging_peak_time)
+print "NetBackup gets " + str(len(backups)) + " bpbackup runs with " + gb(sum(backup[2] for backup in backups)) + " GB, up to " + str(streams_peak) + \
+    " at once after " + after(streams_peak_time) + ", busiest hour " + gb(hour_bytes) + " GB from " + time.strftime("%H:%M", time.localtime(start_time + hour_start))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# Description: Verify, read and restore AFS volume dumps made by afs_backup.py
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+import sys
+import os
+import subprocess
+import traceback
+import hashlib
+import zlib
+from optparse import OptionParser
+
+
+
+vos_path = "/usr/sbin/vos"
+
+
+
+# How were we called?
+parser = OptionParser("%prog [options] dump_dir\n" +
+    "Verify, read and restore AFS volume dumps made by afs_backup.py.\n" +
+    "dump_dir is a server's dump directory as afs_backup.py left it (or as restored from NetBackup), holding the dumps,\n" +
+    "afs_backup-chains.txt and afs_backup-checksums.txt.  Compressed (.gz) and uncompressed dumps are both handled."
+)
+
+parser.add_option(
+    "--verify",
+    action="store_true", dest="verify", default=False,
+    help="Check the size and SHA-256 digest of every dump in afs_backup-checksums.txt, compressed and uncompressed.  " +
+        "Earlier dumps of a restore chain made by other runs are listed too and only checked if they have been put in dump_dir"
+)
+
+parser.add_option(
+    "--cat",
+    action="store", type="string", dest="cat", default=None, metavar="DUMP_FILE",
+    help="Write a dump from dump_dir to STDOUT uncompressed, e.g. to give to vos restore by hand"
+)
+
+parser.add_option(
+    "--volume",
+    action="store", type="string", dest="volume", default=None,
+    help="Restore this volume (as named in afs_backup-chains.txt, e.g. user.jaw171.backup) from its full dump and every incremental since"
+)
+
+parser.add_option(
+    "--server",
+    action="store", type="string", dest="server", default=None,
+    help="Server to restore the volume to"
+)
+
+parser.add_option(
+    "--partition",
+    action="store", type="string", dest="partition", default=None,
+    help="Partition to restore the volume to"
+)
+
+parser.add_option(
+    "--name",
+    action="store", type="string", dest="name", default=None,
+    help="Name to restore the volume as"
+)
+
+parser.add_option(
+    "-n", "--dry-run",
+    action="store_true", dest="dry_run", default=False,
+    help="Only show the dumps which would be restored and the vos commands for them"
+)
+
+(options, args) = parser.parse_args()
+
+
+
+# Print a stack trace, exception, and an error string to STDERR
+# then exit with the exit status given (default: 1) or don't exit
+# if passed NoneType
+def fatal_error(error_string, exit_status=1):
+    red = "\033[31m"
+    endcolor = "\033[0m"
+
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+
+    if exc_type is not None:
+        traceback.print_exception(exc_type, exc_value, exc_traceback)
+
+    sys.stderr.write(red + str(error_string) + endcolor + "\n")
+
+    if exit_status is not None:
+        sys.exit(int(exit_status))
+
+
+
+# Return the rows of a tab separated manifest written by afs_backup.py as lists, or [] if there is none
+def read_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return []
+
+    rows = []
+    for line in open(manifest_file, "r"):
+        line = line.rstrip("\n")
+
+        if line == "" or line.startswith("#"):
+            continue
+
+        rows.append(line.split("\t"))
+
+    return rows
+
+
+
+# Yield the uncompressed contents of a dump file in chunks, .gz files are decompressed as they are read
+# A digest object can be given for each of the file as stored and its uncompressed contents
+def read_dump(dump_path, file_digest=None, raw_digest=None):
+    if dump_path.endswith(".gz"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    else:
+        decompressor = None
+
+    dump_handle = open(dump_path, "rb")
+
+    for chunk in iter(lambda: dump_handle.read(1048576), ""):
+        if file_digest is not None:
+            file_digest.update(chunk)
+
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+
+        if raw_digest is not None:
+            raw_digest.update(chunk)
+
+        yield chunk
+
+    dump_handle.close()
+
+    if decompressor is not None:
+        chunk = decompressor.flush()
+
+        if raw_digest is not None:
+            raw_digest.update(chunk)
+
+        yield chunk
+
+
+
+# Return None if a dump matches its row of afs_backup-checksums.txt or a string saying what doesn't
+def check_dump(dump_path, checksum_row):
+    (dump_file, file_bytes, file_sha256, raw_bytes, raw_sha256) = checksum_row
+
+    if not os.path.isfile(dump_path):
+        return "missing"
+
+    if os.path.getsize(dump_path) != int(file_bytes):
+        return "size is " + str(os.path.getsize(dump_path)) + " bytes rather than " + file_bytes
+
+    (file_digest, raw_digest) = (hashlib.sha256(), hashlib.sha256())
+    read_bytes = 0
+
+    try:
+        for chunk in read_dump(dump_path, file_digest, raw_digest):
+            read_bytes = read_bytes + len(chunk)
+
+    except zlib.error as err:
+        return "failed to decompress: " + str(err)
+
+    if file_digest.hexdigest() != file_sha256:
+        return "SHA-256 digest does not match"
+
+    if read_bytes != int(raw_bytes):
+        return "uncompressed size is " + str(read_bytes) + " bytes rather than " + raw_bytes
+
+    if raw_digest.hexdigest() != raw_sha256:
+        return "uncompressed SHA-256 digest does not match"
+
+    return None
+
+
+
+
+
+if len(args) != 1:
+    parser.error("A dump directory is needed, see --help")
+
+dump_dir = args[0]
+
+checksums = dict((row[0], row) for row in read_manifest(os.path.join(dump_dir, "afs_backup-checksums.txt")) if len(row) == 5)
+
+
+
+if options.verify:
+    if len(checksums) == 0:
+        fatal_error("No checksums found in " + os.path.join(dump_dir, "afs_backup-checksums.txt") + " - EXITING")
+
+    # The last dump of each volume's chain is the one made by the run the manifests are from, the others are carried
+    # forward from earlier runs and are only here if they were restored from those runs' backups
+    last_dumps = {}
+    for row in read_manifest(os.path.join(dump_dir, "afs_backup-chains.txt")):
+        if len(row) == 5:
+            last_dumps[row[0]] = row[4]
+
+    this_run = set(last_dumps.values())
+
+    (failed_count, absent_count) = (0, 0)
+    for dump_file in sorted(checksums):
+        if len(this_run) > 0 and dump_file not in this_run and not os.path.isfile(os.path.join(dump_dir, dump_file)):
+            print "ABSENT  " + dump_file + ": made by an earlier run, restore it from that run's backup to check it"
+            absent_count = absent_count + 1
+            continue
+
+        problem = check_dump(os.path.join(dump_dir, dump_file), checksums[dump_file])
+
+        if problem is None:
+            print "OK      " + dump_file
+
+        else:
+            print "FAILED  " + dump_file + ": " + problem
+            failed_count = failed_count + 1
+
+    print str(len(checksums) - absent_count) + " dumps checked, " + str(failed_count) + " failed, " + str(absent_count) + " from earlier runs not in " + dump_dir
+
+    if failed_count > 0:
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+
+if options.cat is not None:
+    try:
+        for chunk in read_dump(os.path.join(dump_dir, options.cat)):
+            sys.stdout.write(chunk)
+
+    except (IOError, zlib.error):
+        fatal_error("Failed to read dump " + os.path.join(dump_dir, options.cat) + " - EXITING")
+
+    sys.exit(0)
+
+
+
+if options.volume is None:
+    parser.error("One of --verify, --cat or --volume is needed, see --help")
+
+if options.server is None or options.partition is None or options.name is None:
+    parser.error("--volume needs --server, --partition and --name")
+
+chain = [row for row in read_manifest(os.path.join(dump_dir, "afs_backup-chains.txt")) if len(row) == 5 and row[0] == options.volume]
+
+if len(chain) == 0 or chain[0][1] != "full":
+    fatal_error("No restore chain starting with a full dump found for volume " + options.volume + " in " + os.path.join(dump_dir, "afs_backup-chains.txt") + " - EXITING")
+
+# Check the whole chain before restoring any of it
+for (volume, level, dump_time, since, dump_file) in chain:
+    if not os.path.isfile(os.path.join(dump_dir, dump_file)):
+        fatal_error("Dump " + dump_file + " of the restore chain is missing from " + dump_dir + " - EXITING")
+
+    if dump_file in checksums:
+        problem = check_dump(os.path.join(dump_dir, dump_file), checksums[dump_file])
+
+        if problem is not None:
+            fatal_error("Dump " + dump_file + " of the restore chain failed to verify: " + problem + " - EXITING")
+
+for (volume, level, dump_time, since, dump_file) in chain:
+    vos_command = [vos_path, "restore", options.server, options.partition, options.name, "-overwrite", level]
+
+    print "Restoring " + level + " dump " + dump_file + ": " + " ".join(vos_command)
+
+    if options.dry_run:
+        continue
+
+    vos_info = subprocess.Popen(vos_command, stdin=subprocess.PIPE, stdout=None, shell=False)
+
+    try:
+        for chunk in read_dump(os.path.join(dump_dir, dump_file)):
+            vos_info.stdin.write(chunk)
+
+        vos_info.stdin.close()
+
+    except (IOError, zlib.error):
+        vos_info.kill()
+        vos_info.wait()
+
+        fatal_error("Failed to feed dump " + dump_file + " to vos - EXITING")
+
+    status = vos_info.wait()
+
+    if status != 0:
+        fatal_error("vos restore of dump " + dump_file + " exited with a status of " + str(status) + " - EXITING")
+
+if options.dry_run:
+    sys.exit(0)
+
+print "Restored volume " + options.volume + " as " + options.name + " on " + options.server + " " + options.partition + " from " + str(len(chain)) + " dumps"
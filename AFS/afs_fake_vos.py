@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Description: Stand-in for vos which replays a recorded volume inventory, for simulating and testing afs_backup.py offline
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+# Record an inventory with "vos listvol SERVER -format > DIR/SERVER.listvol" for each fileserver, then install with
+# "afs_fake_vos.py --install BIN_DIR" and run BIN_DIR/vos with the inventory directory in AFS_FAKE_VOS_INVENTORY.
+# Only what afs_backup.py runs is handled:
+#
+# vos listvol SERVER -format            Replays DIR/SERVER.listvol
+# vos dump VOLUME -time TIME [-file F]  Writes a stand-in dump of the volume to F or STDOUT
+#
+# Settings come from the environment since afs_backup.py runs vos with fixed arguments:
+#
+# AFS_FAKE_VOS_INVENTORY             Directory of recorded SERVER.listvol files (default: .)
+# AFS_FAKE_VOS_DUMP_SCALE            Bytes written per byte of a full dump, 0 writes nothing (default: 0)
+# AFS_FAKE_VOS_INCREMENTAL_PERCENT   Percent of a full dump an incremental dump is (default: 5)
+
+
+
+import sys
+import os
+
+
+
+# Return an environment setting as the given type
+def setting(name, default, setting_type=str):
+    return setting_type(os.environ.get(name, default))
+
+
+
+inventory_dir = setting("AFS_FAKE_VOS_INVENTORY", ".")
+dump_scale = setting("AFS_FAKE_VOS_DUMP_SCALE", 0, float)
+incremental_percent = setting("AFS_FAKE_VOS_INCREMENTAL_PERCENT", 5, float)
+
+
+
+# Return the diskused (KB) of a volume from any server's recorded inventory or None if it isn't in any
+def volume_size(volume):
+    for listvol_file in sorted(os.listdir(inventory_dir)):
+        if not listvol_file.endswith(".listvol"):
+            continue
+
+        entry = {}
+        for line in open(os.path.join(inventory_dir, listvol_file), "r"):
+            fields = line.split()
+
+            if len(fields) == 0:
+                continue
+
+            if fields[0] == "BEGIN_OF_ENTRY":
+                entry = {}
+
+            elif fields[0] == "END_OF_ENTRY":
+                if entry.get("name") == volume:
+                    return int(entry.get("diskused", 0))
+
+            elif len(fields) >= 2:
+                entry[fields[0]] = fields[1]
+
+    return None
+
+
+
+def listvol(args):
+    if len(args) < 1:
+        sys.stderr.write("vos stand-in: listvol needs a server\n")
+        return 1
+
+    listvol_file = os.path.join(inventory_dir, args[0] + ".listvol")
+
+    if not os.path.isfile(listvol_file):
+        sys.stderr.write("vos stand-in: no recorded inventory " + listvol_file + " for server " + args[0] + "\n")
+        return 1
+
+    listvol_handle = open(listvol_file, "r")
+
+    for chunk in iter(lambda: listvol_handle.read(1048576), ""):
+        sys.stdout.write(chunk)
+
+    listvol_handle.close()
+
+    return 0
+
+
+
+def dump(args):
+    if len(args) < 1:
+        sys.stderr.write("vos stand-in: dump needs a volume\n")
+        return 1
+
+    size = volume_size(args[0])
+
+    if size is None:
+        sys.stderr.write("vos stand-in: volume " + args[0] + " is not in the recorded inventory\n")
+        return 255
+
+    dump_bytes = int(size * 1024 * dump_scale)
+
+    if "-time" in args and args[args.index("-time") + 1] != "0":
+        dump_bytes = int(dump_bytes * incremental_percent / 100)
+
+    if "-file" in args:
+        dump_handle = open(args[args.index("-file") + 1], "wb")
+
+    else:
+        dump_handle = sys.stdout
+
+    chunk = "\0" * 1048576
+    while dump_bytes > 0:
+        dump_handle.write(chunk[:dump_bytes])
+        dump_bytes = dump_bytes - len(chunk)
+
+    dump_handle.close()
+
+    return 0
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--install":
+        # Make a directory with a vos link pointing back to us
+        if not os.path.isdir(sys.argv[2]):
+            os.makedirs(sys.argv[2])
+
+        link = os.path.join(sys.argv[2], "vos")
+
+        if os.path.lexists(link):
+            os.unlink(link)
+
+        os.symlink(os.path.abspath(__file__), link)
+
+        sys.exit(0)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ["listvol", "dump"]:
+        sys.stderr.write("Usage: " + os.path.basename(sys.argv[0]) + " --install DIR\n" + "Then run DIR/vos listvol SERVER -format or DIR/vos dump VOLUME -time TIME [-file FILE]\n")
+        sys.exit(1)
+
+    sys.exit(globals()[sys.argv[1]](sys.argv[2:]))
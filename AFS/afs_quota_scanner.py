@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# Description: Scan the quota and usage of every AFS home volume into a table to query
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+import sys
+import os
+import subprocess
+import traceback
+import sqlite3
+import time
+from optparse import OptionParser
+
+
+
+vos_path = "/usr/sbin/vos"
+
+
+
+# How were we called?
+parser = OptionParser("%prog [options]\n" +
+    "Scan the quota and usage of every AFS home volume (u.UCA) in the cell into a table, or query the table.\n" +
+    "A scan takes one \"vos listvol -format\" per fileserver, read as it streams in, rather than an fs listquota per user.\n" +
+    "Every scan is kept with its time so growth can be seen.  The users found by --above can be given straight to\n" +
+    "afs_quote_setter.py with its --usage-db option.  Only complete scans, of every fileserver with no vos failures,\n" +
+    "are queried, a scan with --server or a failed server is kept as partial."
+)
+
+parser.add_option(
+    "--db",
+    action="store", type="string", dest="db", default=os.path.expanduser("~/afs_quota_usage.db"),
+    help="The usage table (default: %default)"
+)
+
+parser.add_option(
+    "-s", "--server",
+    action="append", type="string", dest="servers", default=[],
+    help="Scan this fileserver, may be given more than once (default: every fileserver vos listaddrs shows)"
+)
+
+parser.add_option(
+    "--prefix",
+    action="store", type="string", dest="prefix", default="u.",
+    help="Name prefix of the home volumes, the rest of the name is the UCA (default: %default)"
+)
+
+parser.add_option(
+    "--keep-days",
+    action="store", type="int", dest="keep_days", default=90,
+    help="Remove scans older than this many days after each scan (default: %default)"
+)
+
+parser.add_option(
+    "--above",
+    action="store", type="float", dest="above", default=None, metavar="PERCENT",
+    help="Don't scan, show the users over PERCENT of their quota in the latest complete scan, fullest first"
+)
+
+parser.add_option(
+    "--growers",
+    action="store", type="float", dest="growers", default=None, metavar="DAYS",
+    help="Don't scan, show the users whose usage grew the most over the last DAYS days of complete scans"
+)
+
+parser.add_option(
+    "--top",
+    action="store", type="int", dest="top", default=20,
+    help="Number of users --growers shows (default: %default)"
+)
+
+parser.add_option(
+    "--ucas-only",
+    action="store_true", dest="ucas_only", default=False,
+    help="Only show the UCAs of a query, one per line, e.g. for a UCA file for afs_quote_setter.py"
+)
+
+(options, args) = parser.parse_args()
+
+
+
+# Print a stack trace, exception, and an error string to STDERR
+# then exit with the exit status given (default: 1) or don't exit
+# if passed NoneType
+def fatal_error(error_string, exit_status=1):
+    red = "\033[31m"
+    endcolor = "\033[0m"
+
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+
+    if exc_type is not None:
+        traceback.print_exception(exc_type, exc_value, exc_traceback)
+
+    sys.stderr.write(red + str(error_string) + endcolor + "\n")
+
+    if exit_status is not None:
+        sys.exit(int(exit_status))
+
+
+
+# Open (and create if needed) the usage table
+# usage has a row per home volume per scan, percent is used as a percent of quota (NULL for no quota)
+# scans.complete is 1 for a scan of every fileserver where every vos listvol worked, 0 for a partial scan
+def open_usage(path):
+    db = sqlite3.connect(path)
+    db.text_factory = str
+
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS scans (scan_id INTEGER PRIMARY KEY AUTOINCREMENT, scan_time INTEGER NOT NULL, servers TEXT, volumes INTEGER, complete INTEGER NOT NULL DEFAULT 0)")
+
+        # Tables made before scans were marked complete or partial, what they hold is counted as partial
+        if "complete" not in [row[1] for row in db.execute("PRAGMA table_info(scans)")]:
+            db.execute("ALTER TABLE scans ADD COLUMN complete INTEGER NOT NULL DEFAULT 0")
+
+        db.execute("CREATE TABLE IF NOT EXISTS usage (scan_id INTEGER NOT NULL, uca TEXT NOT NULL, volume TEXT NOT NULL, server TEXT, partition TEXT, quota INTEGER, used INTEGER, percent REAL, PRIMARY KEY (scan_id, uca))")
+        db.execute("CREATE INDEX IF NOT EXISTS usage_percent ON usage (scan_id, percent)")
+        db.execute("CREATE INDEX IF NOT EXISTS usage_uca ON usage (uca, scan_id)")
+
+    return db
+
+
+
+# Return the fileservers of the cell from vos listaddrs
+def list_servers():
+    vos_info = subprocess.Popen([vos_path, "listaddrs"], stdin=None, stdout=subprocess.PIPE, shell=False)
+    out = vos_info.communicate()[0]
+
+    if vos_info.returncode != 0:
+        fatal_error("vos listaddrs exited with a status of " + str(vos_info.returncode) + " - EXITING")
+
+    return [line.strip() for line in out.splitlines() if line.strip() != ""]
+
+
+
+# Yield (uca, volume, partition, quota KB, used KB) of each home volume (RW only) on a server as vos lists it
+# The server is added to failed_servers if vos fails, what it listed before failing is still yielded
+def list_home_volumes(afs_server, failed_servers):
+    vos_info = subprocess.Popen([vos_path, "listvol", afs_server, "-format"], stdin=None, stdout=subprocess.PIPE, shell=False)
+
+    entry = None
+    for line in iter(vos_info.stdout.readline, ""):
+        fields = line.split()
+
+        if len(fields) == 0:
+            continue
+
+        if fields[0] == "BEGIN_OF_ENTRY":
+            entry = {}
+
+        elif fields[0] == "END_OF_ENTRY":
+            if entry is not None and entry.get("type") == "RW" and entry.get("name", "").startswith(options.prefix) and len(entry["name"]) > len(options.prefix):
+                try:
+                    yield (entry["name"][len(options.prefix):], entry["name"], entry.get("part"), int(entry["maxquota"]), int(entry["diskused"]))
+
+                except (KeyError, ValueError):
+                    sys.stderr.write("Failed to get the quota and usage of volume " + entry["name"] + " on server " + afs_server + "\n")
+
+            entry = None
+
+        elif entry is not None and len(fields) >= 2:
+            entry[fields[0]] = fields[1]
+
+    status = vos_info.wait()
+
+    if status != 0:
+        sys.stderr.write("vos listvol of server " + afs_server + " exited with a status of " + str(status) + "\n")
+
+        failed_servers.append(afs_server)
+
+
+
+# Scan the servers given into the usage table as one scan, returning the number of home volumes found and the servers
+# which failed
+# The scan is marked complete only if afs_servers is every fileserver (all_servers) and none of them failed
+def scan(db, afs_servers, all_servers):
+    scan_time = int(time.time())
+    volume_count = 0
+    failed_servers = []
+
+    with db:
+        scan_id = db.execute("INSERT INTO scans (scan_time, servers) VALUES (?, ?)", (scan_time, " ".join(afs_servers))).lastrowid
+
+        for afs_server in afs_servers:
+            start = time.time()
+            rows = []
+
+            for (uca, volume, partition, quota, used) in list_home_volumes(afs_server, failed_servers):
+                # A quota of 0 is no limit
+                if quota > 0:
+                    percent = used * 100.0 / quota
+
+                else:
+                    percent = None
+
+                rows.append((scan_id, uca, volume, afs_server, partition, quota, used, percent))
+
+            # A volume can show up twice while it is being moved, the one seen last is kept
+            db.executemany("INSERT OR REPLACE INTO usage (scan_id, uca, volume, server, partition, quota, used, percent) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            volume_count = volume_count + len(rows)
+
+            print "Scanned " + str(len(rows)) + " home volumes on server " + afs_server + " in " + "%.1f" % (time.time() - start) + " seconds"
+
+        complete = all_servers and len(failed_servers) == 0
+
+        db.execute("UPDATE scans SET volumes = ?, complete = ? WHERE scan_id = ?", (volume_count, int(complete), scan_id))
+
+        if options.keep_days > 0:
+            old_scans = [row[0] for row in db.execute("SELECT scan_id FROM scans WHERE scan_time < ?", (scan_time - options.keep_days * 86400,))]
+
+            for old_scan_id in old_scans:
+                db.execute("DELETE FROM usage WHERE scan_id = ?", (old_scan_id,))
+                db.execute("DELETE FROM scans WHERE scan_id = ?", (old_scan_id,))
+
+    return (volume_count, failed_servers)
+
+
+
+# Return (scan_id, scan_time) of the latest complete scan or None if there is none
+def latest_scan(db):
+    return db.execute("SELECT scan_id, scan_time FROM scans WHERE complete = 1 ORDER BY scan_id DESC LIMIT 1").fetchone()
+
+
+
+# Return [(uca, used KB, quota KB, percent)] of the users over a percent of their quota in the latest complete scan, fullest first
+def users_above(db, percent):
+    scan_row = latest_scan(db)
+
+    if scan_row is None:
+        return []
+
+    return db.execute("SELECT uca, used, quota, percent FROM usage WHERE scan_id = ? AND percent > ? ORDER BY percent DESC", (scan_row[0], percent)).fetchall()
+
+
+
+# Return [(uca, KB grown, used KB now, quota KB now)] of the users who grew the most between the oldest complete scan in
+# the last days given and the latest complete scan, most first
+def top_growers(db, days, top):
+    scan_row = latest_scan(db)
+
+    if scan_row is None:
+        return []
+
+    first_row = db.execute("SELECT scan_id FROM scans WHERE complete = 1 AND scan_time >= ? ORDER BY scan_id LIMIT 1", (scan_row[1] - days * 86400,)).fetchone()
+
+    return db.execute(
+        "SELECT latest.uca, latest.used - first.used AS grown, latest.used, latest.quota FROM usage AS latest " +
+        "JOIN usage AS first ON first.uca = latest.uca AND first.scan_id = ? " +
+        "WHERE latest.scan_id = ? AND latest.used > first.used ORDER BY grown DESC LIMIT ?",
+        (first_row[0], scan_row[0], top)
+    ).fetchall()
+
+
+
+
+
+try:
+    db = open_usage(options.db)
+
+except sqlite3.Error:
+    fatal_error("Unable to open usage table " + options.db + " - EXITING")
+
+if (options.above is not None or options.growers is not None) and latest_scan(db) is None:
+    fatal_error("No complete scan in usage table " + options.db + ", run a scan without --server first - EXITING")
+
+if options.above is not None:
+    rows = users_above(db, options.above)
+
+    if options.ucas_only:
+        for row in rows:
+            print row[0]
+
+    else:
+        print "%-12s %14s %14s %8s" % ("UCA", "Used KB", "Quota KB", "%Used")
+
+        for (uca, used, quota, percent) in rows:
+            print "%-12s %14d %14d %7.1f%%" % (uca, used, quota, percent)
+
+    sys.exit(0)
+
+if options.growers is not None:
+    rows = top_growers(db, options.growers, options.top)
+
+    if options.ucas_only:
+        for row in rows:
+            print row[0]
+
+    else:
+        print "%-12s %14s %14s %14s" % ("UCA", "Grew KB", "Used KB", "Quota KB")
+
+        for (uca, grown, used, quota) in rows:
+            print "%-12s %14d %14d %14d" % (uca, grown, used, quota)
+
+    sys.exit(0)
+
+if len(options.servers) > 0:
+    afs_servers = options.servers
+
+else:
+    afs_servers = list_servers()
+
+start = time.time()
+(volume_count, failed_servers) = scan(db, afs_servers, len(options.servers) == 0)
+
+print "Scanned " + str(volume_count) + " home volumes on " + str(len(afs_servers)) + " servers in " + "%.1f" % (time.time() - start) + " seconds into " + options.db
+
+if len(options.servers) > 0:
+    print "Only some servers were scanned so the scan is kept as partial, queries use the latest complete scan"
+
+if len(failed_servers) > 0:
+    fatal_error("Failed to scan servers " + " ".join(failed_servers) + ", the scan is kept as partial and queries use the latest complete scan")
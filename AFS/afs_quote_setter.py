@@ -19,14 +19,51 @@ import sys
 import os
 import subprocess
 import traceback
-import re
+import threading
+import Queue
+import sqlite3
 from optparse import OptionParser
 
 
 
 # How were we called?
-parser = OptionParser("%prog [options] file_with_ucas.txt quota_amount\n" + 
-    "AFS quota setter"
+parser = OptionParser("%prog [options] file_with_ucas.txt quota_amount\n" +
+    "       %prog [options] --usage-db usage.db quota_amount\n" +
+    "AFS quota setter\n" +
+    "Current quotas are looked up with one fs listquota per batch of users, then the users below quota_amount have it set\n" +
+    "by a pool of fs setquota workers.  Each user done is written to a checkpoint file so a run which is stopped can be\n" +
+    "started again with the same arguments to carry on where it left off.  With --usage-db the users are taken from the\n" +
+    "latest complete scan of afs_quota_scanner.py rather than a file."
+)
+
+parser.add_option(
+    "-b", "--batch-size",
+    action="store", type="int", dest="batch_size", default=200,
+    help="Number of users to look up the quota of with each fs listquota (default: %default)"
+)
+
+parser.add_option(
+    "-w", "--workers",
+    action="store", type="int", dest="workers", default=8,
+    help="Number of fs setquota to run at once (default: %default)"
+)
+
+parser.add_option(
+    "-c", "--checkpoint",
+    action="store", type="string", dest="checkpoint", default=None,
+    help="File to keep the users done in (default: file_with_ucas.txt.checkpoint or usage.db.checkpoint)"
+)
+
+parser.add_option(
+    "--usage-db",
+    action="store", type="string", dest="usage_db", default=None,
+    help="Set the quota of the users over --above percent of their quota in the latest complete scan in this afs_quota_scanner.py usage table"
+)
+
+parser.add_option(
+    "--above",
+    action="store", type="float", dest="above", default=90,
+    help="With --usage-db, the percent of their quota users must be over (default: %default)"
 )
 
 (options, args) = parser.parse_args()
@@ -45,63 +82,248 @@ def fatal_error(error_string, exit_status=1):
     traceback.print_exception(exc_type, exc_value, exc_traceback)
 
     sys.stderr.write("\n" + red + str(error_string) + endcolor + "\n")
-    
+
     if exit_status is not None:
         sys.exit(int(exit_status))
-        
-        
-        
-        
-        
-try:
-    uca_file = sys.argv[1]
-    
-    uca_file_handle = open(uca_file, "r")
-    
-except:
-    fatal_error("Unable to open UCA file, see --help.")
-    
-    
-try:
-    quota_amount = sys.argv[2]
-    
-except:
-    fatal_error("Unable to get quota amount from the command line, see --help.")
-    
-    
-    
-for uca in uca_file_handle:
-    uca = uca.rstrip()
-    
-    
-    uca_path = "/afs/pitt.edu/home/" + uca[0] + "/" + uca[1] + "/" + uca
-    
-    # Verify the new quota is greater than the current quota
-    quota_info = subprocess.Popen(["fs", "lq", uca_path], stdout=subprocess.PIPE, shell=False)
+
+
+
+def uca_path(uca):
+    return "/afs/pitt.edu/home/" + uca[0] + "/" + uca[1] + "/" + uca
+
+
+
+# Return a dict of UCA -> current quota in KB (None for no limit) of the users given, from one fs listquota
+# Users fs can't look up are left out, fs carries on past them and says why on STDERR
+def get_quotas(ucas):
+    quota_info = subprocess.Popen(["fs", "listquota"] + [uca_path(uca) for uca in ucas], stdout=subprocess.PIPE, shell=False)
     out = quota_info.communicate()[0]
-    
-    for line in out.split(os.linesep):
-        line = line.rstrip()
-        
-        # Skip lines we don't care about
-        if re.search("^u\.", line) is not None:
-            current_quota = line.split()[1]
-            
-        
-    if int(current_quota) > int(quota_amount):
-        print "Skipping user " + uca + " as the current quota is higher than the requested quota"
-        
-        continue
-    
-    
-    print "Setting quota of " + quota_amount + " on user " + uca
-    
-    fs_proc = subprocess.Popen(["fs", "sq", uca_path, quota_amount], shell=False)
-    status = fs_proc.wait()
-    
-    if status == 0:
-        print "Success\n"
-        
+
+    # Lines are e.g. "u.jaw171    2000000    123456    6%    42%", a volume with no quota shows "no limit"
+    wanted = set(ucas)
+    quotas = {}
+    for line in out.splitlines():
+        fields = line.split()
+
+        if len(fields) < 2 or not fields[0].startswith("u.") or fields[0][2:] not in wanted:
+            continue
+
+        if fields[1] == "no":
+            quotas[fields[0][2:]] = None
+
+        else:
+            try:
+                quotas[fields[0][2:]] = int(fields[1])
+
+            except ValueError:
+                pass
+
+    return quotas
+
+
+
+# Return the UCAs over a percent of their quota in the latest complete scan of an afs_quota_scanner.py usage table, fullest first
+def read_usage_ucas(usage_db, percent):
+    db = sqlite3.connect(usage_db)
+    db.text_factory = str
+
+    rows = db.execute(
+        "SELECT uca FROM usage WHERE scan_id = (SELECT MAX(scan_id) FROM scans WHERE complete = 1) AND percent > ? ORDER BY percent DESC", (percent,)
+    ).fetchall()
+
+    db.close()
+
+    return [row[0] for row in rows]
+
+
+
+# Return a dict of UCA -> result from a checkpoint file of earlier runs setting the same quota
+def read_checkpoint(checkpoint_file, quota_amount):
+    done = {}
+
+    if not os.path.isfile(checkpoint_file):
+        return done
+
+    for line in open(checkpoint_file, "r"):
+        fields = line.rstrip("\n").split("\t")
+
+        # A run setting some other quota says nothing about this one
+        if len(fields) == 3 and fields[2] == quota_amount:
+            done[fields[0]] = fields[1]
+
+    return done
+
+
+
+# Write a user's result to the checkpoint file as soon as it is known so nothing done is lost if we're stopped
+def write_checkpoint(uca, result):
+    checkpoint_lock.acquire()
+
+    try:
+        checkpoint_handle.write(uca + "\t" + result + "\t" + quota_amount + "\n")
+        checkpoint_handle.flush()
+        os.fsync(checkpoint_handle.fileno())
+
+        results[result].append(uca)
+
+    finally:
+        checkpoint_lock.release()
+
+
+
+# Set the quota of users taken from set_queue until a None is taken
+def set_quota_worker():
+    devnull = open(os.devnull, "w")
+
+    while True:
+        uca = set_queue.get()
+
+        if uca is None:
+            break
+
+        fs_proc = subprocess.Popen(["fs", "setquota", uca_path(uca), quota_amount], stdout=devnull, shell=False)
+        status = fs_proc.wait()
+
+        if status == 0:
+            write_checkpoint(uca, "applied")
+
+        else:
+            sys.stderr.write("Failed to set quota on user " + uca + ", fs exited with a status of " + str(status) + "\n")
+
+            # Failures aren't checkpointed so the next run tries them again
+            checkpoint_lock.acquire()
+            results["failed"].append(uca)
+            checkpoint_lock.release()
+
+    devnull.close()
+
+
+
+
+
+if options.usage_db is not None:
+    if len(args) != 1:
+        parser.error("Only a quota amount is needed with --usage-db, see --help")
+
+    quota_amount = args[0]
+
+else:
+    if len(args) != 2:
+        parser.error("A UCA file and a quota amount are needed, see --help")
+
+    uca_file = args[0]
+    quota_amount = args[1]
+
+    try:
+        uca_file_handle = open(uca_file, "r")
+
+    except:
+        fatal_error("Unable to open UCA file, see --help.")
+
+try:
+    int(quota_amount)
+
+except ValueError:
+    fatal_error("Quota amount " + quota_amount + " is not a number of KB, see --help.")
+
+if options.batch_size < 1 or options.workers < 1:
+    parser.error("--batch-size and --workers must be at least 1")
+
+if options.checkpoint is None:
+    if options.usage_db is not None:
+        options.checkpoint = options.usage_db + ".checkpoint"
+
     else:
-        sys.stderr.write("Failed\n\n")
-    
+        options.checkpoint = uca_file + ".checkpoint"
+
+
+
+if options.usage_db is not None:
+    try:
+        ucas = read_usage_ucas(options.usage_db, options.above)
+
+    except sqlite3.Error:
+        fatal_error("Unable to read users from usage table " + options.usage_db + ", see --help.")
+
+    print "Found " + str(len(ucas)) + " users over " + str(options.above) + "% of their quota in " + options.usage_db
+
+else:
+    ucas = []
+    seen = set()
+    for line in uca_file_handle:
+        uca = line.strip()
+
+        if len(uca) < 2 or uca in seen:
+            continue
+
+        seen.add(uca)
+        ucas.append(uca)
+
+    uca_file_handle.close()
+
+done = read_checkpoint(options.checkpoint, quota_amount)
+
+try:
+    checkpoint_handle = open(options.checkpoint, "a")
+
+except IOError:
+    fatal_error("Unable to open checkpoint file " + options.checkpoint + ".")
+
+checkpoint_lock = threading.Lock()
+results = {"applied" : [], "skipped" : [], "failed" : []}
+set_queue = Queue.Queue(options.workers * 4)
+
+workers = []
+for i in xrange(options.workers):
+    worker = threading.Thread(target=set_quota_worker)
+    worker.daemon = True
+    worker.start()
+
+    workers.append(worker)
+
+todo = [user for user in ucas if user not in done]
+
+if len(done) > 0:
+    print "Carrying on from checkpoint " + options.checkpoint + ", " + str(len(ucas) - len(todo)) + " users were already done"
+
+# Look up a batch while the workers set the quotas of the last one
+for batch_start in xrange(0, len(todo), options.batch_size):
+    batch = todo[batch_start:batch_start + options.batch_size]
+    quotas = get_quotas(batch)
+
+    for uca in batch:
+        if uca not in quotas:
+            sys.stderr.write("Failed to get the current quota of user " + uca + "\n")
+
+            checkpoint_lock.acquire()
+            results["failed"].append(uca)
+            checkpoint_lock.release()
+
+        # Verify the new quota is greater than the current quota
+        elif quotas[uca] is None or quotas[uca] >= int(quota_amount):
+            write_checkpoint(uca, "skipped")
+
+        else:
+            set_queue.put(uca)
+
+    print "Looked up " + str(min(batch_start + options.batch_size, len(todo))) + " of " + str(len(todo)) + " users, " + \
+        str(len(results["applied"])) + " applied, " + str(len(results["skipped"])) + " skipped, " + str(len(results["failed"])) + " failed so far"
+
+for worker in workers:
+    set_queue.put(None)
+
+for worker in workers:
+    worker.join()
+
+checkpoint_handle.close()
+
+print ""
+print "Quota " + quota_amount + " on " + str(len(ucas)) + " users:"
+print "    Applied:                       " + str(len(results["applied"]))
+print "    Skipped (already at or above): " + str(len(results["skipped"]))
+print "    Done by an earlier run:        " + str(len(ucas) - len(todo))
+print "    Failed:                        " + str(len(results["failed"]))
+
+if len(results["failed"]) > 0:
+    sys.stderr.write("Failed users (run again to retry them): " + " ".join(sorted(results["failed"])) + "\n")
+    sys.exit(1)
@@ -20,12 +20,15 @@ import datetime
 import traceback
 import subprocess
 import re
+import threading
 from optparse import OptionParser
 
 
 
 ASCII_RED = "\033[31m"
 ASCII_ENDCOLOR = "\033[0m"
+OUTPUT_LOCK = threading.Lock()
+API_LOCK = threading.Lock()
 
 
 
@@ -36,6 +39,16 @@ def timestamp():
 
 
 
+def log(message):
+    """Print a message with a timestamp as one whole line, snapshots are handled in threads at once
+    """
+
+    with OUTPUT_LOCK:
+        sys.stdout.write(timestamp() + message + "\n")
+        sys.stdout.flush()
+
+
+
 def error(error_string, exit_status=1, syslog_tag=None):
     """Print a stack trace, exception, and an error string to STDERR
        then exit with the exit status given (default: 1) or don't exit
@@ -64,6 +77,33 @@ def error(error_string, exit_status=1, syslog_tag=None):
 
 
 
+class SnapError(Exception):
+    """Raised by a Snap method which failed, the message says why
+    """
+
+
+
+def api_session(password_file, pool_size):
+    """Return a requests session for API calls to Isilon using the credentials in password_file
+       The credentials are read once and the session keeps up to pool_size connections alive, so every
+       Snap sharing it makes its calls over the same TLS connections
+       A requests.Session is not documented as thread safe, so every call made with it holds API_LOCK
+    """
+
+    session = requests.Session()
+    session.verify = False
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+
+    try:
+        session.auth = ("apiuser", open(password_file, "r").read().rstrip())
+
+    except IOError:
+        error("Unable to acquire credentails", 1, "NOC-NETCOOL-TICKET")
+
+    return session
+
+
+
 class Snap(object):
     """Snap object which contains information about a snapshot and methods to manage it
     """
@@ -72,27 +112,17 @@ class Snap(object):
         backup_dir
         isilon_dir
         snapshot_name
+        session (from api_session(), shared by every Snap)
         """
 
         self.backup_dir = kwargs["backup_dir"]
         self.isilon_dir = kwargs["isilon_dir"]
         self.snapshot_name = kwargs["snapshot_name"]
+        self.session = kwargs["session"]
 
-        self.get_credentials("/path/to/pass.txt")
-
-
-
-    def get_credentials(self, password_file):
-        """Get the credentials to use with API calls to Isilon
-        """
-
-        self.api_username = "apiuser"
-
-        try:
-            self.api_password = open(password_file, "r").read().rstrip()
-
-        except IOError:
-            error("Unable to acquire credentails", 1, "NOC-NETCOOL-TICKET")
+        # What has been done to the snapshot, so a failed start can be undone
+        self.created = False
+        self.mounted = False
 
 
 
@@ -100,7 +130,7 @@ class Snap(object):
         """Create a snapshot on an Isilon array
         """
 
-        print timestamp() + "Creating snapshot named " + self.snapshot_name
+        log("Creating snapshot named " + self.snapshot_name)
 
         url = "https://panacea.sam.example.edu:8080/platform/1/snapshot/snapshots"
 
@@ -109,43 +139,58 @@ class Snap(object):
             "path" : self.isilon_dir,
         }
 
-        response = requests.post(url, verify=False, auth=(self.api_username, self.api_password), json=payload)
+        try:
+            with API_LOCK:
+                response = self.session.post(url, json=payload)
 
-        if "errors" in response.json():
-            error("Failed to create snapshot, server response: " + str(response.json()), 1, "NOC-NETCOOL-TICKET")
+            response_json = response.json()
+
+        except (requests.exceptions.RequestException, ValueError) as err:
+            raise SnapError("Failed to create snapshot " + self.snapshot_name + ": " + str(err))
+
+        if "errors" in response_json:
+            raise SnapError("Failed to create snapshot " + self.snapshot_name + ", server response: " + str(response_json))
+
+        self.created = True
 
 
 
     def remove_snapshot(self):
         """Remove the snapshot on an Isilon array
         """
-        print timestamp() + "Removing snapshot named " + self.snapshot_name
+        log("Removing snapshot named " + self.snapshot_name)
 
         url = "https://panacea.sam.example.edu:8080/platform/1/snapshot/snapshots/" + self.snapshot_name
 
-        response = requests.delete(url, verify=False, auth=(self.api_username, self.api_password))
+        try:
+            with API_LOCK:
+                response = self.session.delete(url)
+
+        except requests.exceptions.RequestException as err:
+            raise SnapError("Failed to remove snapshot " + self.snapshot_name + ": " + str(err))
 
         try:
             if "errors" in response.json():
-                # Do not exit non-zero here or NetBackup will consider the backup as failed and throw it away
-                error("Failed to create snapshot, server response: " + str(response.json()), 0, "NOC-NETCOOL-TICKET")
+                raise SnapError("Failed to remove snapshot " + self.snapshot_name + ", server response: " + str(response.json()))
 
         except ValueError:
             # "No JSON object could be decoded" - Ok, no 'errors' so no problem.
             pass
 
+        self.created = False
+
 
 
     def mount_snapshot(self):
         """ Mount a snapshot directory from an Isilon cluster
         """
 
-        print timestamp() + "Mounting snapshot at " + self.backup_dir
+        log("Mounting snapshot at " + self.backup_dir)
 
         mounts = open("/proc/mounts", "r").read()
 
         if re.search(self.backup_dir, mounts) is not None:
-            error("Failed to mount snapshot at " + self.backup_dir + ", a filesystem is already mounted there", 1, "NOC-NETCOOL-TICKET")
+            raise SnapError("Failed to mount snapshot at " + self.backup_dir + ", a filesystem is already mounted there")
 
 
         if os.path.exists(self.backup_dir) is False:
@@ -153,14 +198,16 @@ class Snap(object):
                 os.mkdir(self.backup_dir, 0700)
 
             except OSError:
-                error("Failed to create backup mount directory " + self.backup_dir, 1, "NOC-NETCOOL-TICKET")
+                raise SnapError("Failed to create backup mount directory " + self.backup_dir)
 
 
         mount_proc = subprocess.Popen(["mount", "-t", "nfs", "-o", "vers=3,proto=tcp", "sc-system.isilon.sam.example.edu:/ifs/.snapshot/" + self.snapshot_name, self.backup_dir], stdin=None, shell=False)
         status = mount_proc.wait()
 
         if status != 0:
-            error("Failed to mount snapshot at " + self.backup_dir + ", mount returned status " + str(status), 1, "NOC-NETCOOL-TICKET")
+            raise SnapError("Failed to mount snapshot at " + self.backup_dir + ", mount returned status " + str(status))
+
+        self.mounted = True
 
 
 
@@ -168,14 +215,72 @@ class Snap(object):
         """ Unmount the snapshot
         """
 
-        print timestamp() + "Unmounting snapshot at " + self.backup_dir
+        log("Unmounting snapshot at " + self.backup_dir)
 
         umount_proc = subprocess.Popen(["umount", self.backup_dir], stdin=None, shell=False)
         status = umount_proc.wait()
 
         if status != 0:
-            # Do not exit non-zero here or NetBackup will consider the backup as failed and throw it away
-            error("Failed to unmount snapshot at " + self.backup_dir + ", mount returned status " + str(status), 0, "NOC-NETCOOL-TICKET")
+            raise SnapError("Failed to unmount snapshot at " + self.backup_dir + ", umount returned status " + str(status))
+
+        self.mounted = False
+
+
+
+def start_snap(snap):
+    """Create then mount a snapshot
+    """
+
+    snap.create_snapshot()
+    snap.mount_snapshot()
+
+
+
+def stop_snap(snap):
+    """Unmount then remove whatever of a snapshot is mounted and created
+       A snapshot which is still mounted is not removed out from under the mount
+    """
+
+    if snap.mounted:
+        snap.unmount_snapshot()
+
+    if snap.created:
+        snap.remove_snapshot()
+
+
+
+def run_concurrently(action, snaps):
+    """Run action(snap) on every snap at once, each in its own thread
+       Return a list of (snap, error message) of the ones which failed
+    """
+
+    failures = []
+    failures_lock = threading.Lock()
+
+    def run(snap):
+        try:
+            action(snap)
+
+        except SnapError as err:
+            with failures_lock:
+                failures.append((snap, str(err)))
+
+        # Anything else is as much a failure, we have to know to roll back
+        except Exception as err:
+            traceback.print_exc()
+
+            with failures_lock:
+                failures.append((snap, "Unexpected error handling snapshot " + snap.snapshot_name + ": " + str(err)))
+
+    threads = [threading.Thread(target=run, args=(snap,)) for snap in snaps]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return failures
 
 
 
@@ -217,50 +322,74 @@ if __name__ == "__main__":
 
 
 
-    print timestamp() + "Panacea backup script invoked with: " + str(nbu_args)
+    log("Panacea backup script invoked with: " + str(nbu_args))
 
 
 
-    # Set up the snap objects
+    # Set up the snap objects, all sharing one API session
     snaps = list()
 
     if nbu_args["policy_name"] == "DATA-PANACEA-SNAP-HOME":
+        session = api_session("/path/to/pass.txt", 1)
+
         snap_obj = Snap(
             backup_dir="/backup/sam/home",
             isilon_dir="/ifs/sam/home",
-            snapshot_name="nbu_home" + "-" + nbu_args["policy_name"] + "-" + nbu_args["schedule_type"]
+            snapshot_name="nbu_home" + "-" + nbu_args["policy_name"] + "-" + nbu_args["schedule_type"],
+            session=session
         )
 
         snaps.append(snap_obj)
 
     elif nbu_args["policy_name"] == "DATA-PANACEA-SNAP-OPT":
         # This policy has 4 NFS exports to handle
-        for directory in ["sam", "pkg", "mpi", "htc"]:
+        directories = ["sam", "pkg", "mpi", "htc"]
+
+        session = api_session("/path/to/pass.txt", len(directories))
+
+        for directory in directories:
             snap_obj = Snap(
                 backup_dir="/backup/sam/opt/" + directory,
                 isilon_dir="/ifs/sam/opt/" + directory,
-                snapshot_name="nbu_opt_" + directory + "-" + nbu_args["policy_name"] + "-" + nbu_args["schedule_type"]
+                snapshot_name="nbu_opt_" + directory + "-" + nbu_args["policy_name"] + "-" + nbu_args["schedule_type"],
+                session=session
             )
 
             snaps.append(snap_obj)
 
     else:
-        print timestamp() + "Policy name " + nbu_args["policy_name"] + " was not expected, exiting."
+        log("Policy name " + nbu_args["policy_name"] + " was not expected, exiting.")
         sys.exit(0)
 
 
 
     if len(sys.argv) == 5: # If we received 4 args we are the start script
-        for snap in snaps:
-            snap.create_snapshot()
-            snap.mount_snapshot()
+        # Every directory is snapshotted and mounted at once, NetBackup only waits as long as the slowest one
+        failures = run_concurrently(start_snap, snaps)
+
+        if len(failures) > 0:
+            for (snap, error_string) in failures:
+                error(error_string, None, "NOC-NETCOOL-TICKET")
+
+            # All or nothing, don't leave NetBackup backing up some of the directories or snapshots nobody will remove
+            log("Rolling back the snapshots which were set up")
+
+            for (snap, error_string) in run_concurrently(stop_snap, [snap for snap in snaps if snap.created or snap.mounted]):
+                error(error_string, None, "NOC-NETCOOL-TICKET")
+
+            error("Failed to set up " + str(len(failures)) + " of " + str(len(snaps)) + " snapshots for policy " + nbu_args["policy_name"] + ", none are being backed up", 1, "NOC-NETCOOL-TICKET")
 
     elif len(sys.argv) == 6: # If we received 5 args we are the end script
+        # The start script made and mounted these
         for snap in snaps:
-            snap.unmount_snapshot()
-            snap.remove_snapshot()
+            snap.created = True
+            snap.mounted = True
+
+        # Do not exit non-zero here or NetBackup will consider the backup as failed and throw it away
+        for (snap, error_string) in run_concurrently(stop_snap, snaps):
+            error(error_string, None, "NOC-NETCOOL-TICKET")
 
 
-    print timestamp() + "Returning to NetBackup"
+    log("Returning to NetBackup")
 
     sys.exit(0)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# Description: Stand-in for the NetBackup admin commands nb_policy_report.py runs, for testing and benchmarking
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+# Install with "nb_fake_admincmd.py --install DIR" then point nb_policy_report.py at it with "-M name=DIR".
+# The command to act as is taken from the name it was called by (bpplclients, bppllist or bpschedule).
+# Output is generated, not stored, so it is the same every time for the same settings no matter the scale.
+# Settings come from the environment since the reporter runs the commands with fixed arguments:
+#
+# NB_FAKE_POLICIES          Number of policies at run 0 (default: 1000)
+# NB_FAKE_CLIENTS           Clients per policy (default: 5)
+# NB_FAKE_INCLUDES          Include paths per policy (default: 10)
+# NB_FAKE_SCHEDULES         Number of schedules (default: 50)
+# NB_FAKE_SEED              Seed for everything generated (default: 1)
+# NB_FAKE_RUN               Number of rounds of changes applied on top of run 0 (default: 0)
+# NB_FAKE_CHANGE_PERCENT    Percent of policies and schedules changed in each round (default: 1)
+# NB_FAKE_ADD_PERCENT       Percent of NB_FAKE_POLICIES added in each round (default: 0.1)
+# NB_FAKE_REMOVE_PERCENT    Percent of policies removed in each round (default: 0.1)
+
+
+
+import sys
+import os
+import zlib
+
+
+
+commands = ["bpplclients", "bppllist", "bpschedule"]
+
+
+
+# Return an environment setting as the given type
+def setting(name, default, setting_type=int):
+    return setting_type(os.environ.get(name, default))
+
+
+
+policy_count = setting("NB_FAKE_POLICIES", 1000)
+clients_per_policy = setting("NB_FAKE_CLIENTS", 5)
+includes_per_policy = setting("NB_FAKE_INCLUDES", 10)
+schedule_count = setting("NB_FAKE_SCHEDULES", 50)
+seed = setting("NB_FAKE_SEED", 1)
+run = setting("NB_FAKE_RUN", 0)
+change_percent = setting("NB_FAKE_CHANGE_PERCENT", 1, float)
+add_percent = setting("NB_FAKE_ADD_PERCENT", 0.1, float)
+remove_percent = setting("NB_FAKE_REMOVE_PERCENT", 0.1, float)
+
+
+
+# Return a stable number from 0 to 9999 for a tuple of values, the same for every invocation
+def roll(*values):
+    return zlib.crc32(repr((seed,) + values)) % 10000
+
+
+
+# Return the number of rounds up to the current run in which an object was hit by a kind of change
+def times_hit(kind, number, first_round, percent):
+    return len([i for i in xrange(max(first_round, 1), run + 1) if roll(kind, i, number) < percent * 100])
+
+
+
+added_per_round = int(policy_count * add_percent / 100)
+
+
+
+# Return the round a policy was added in, 0 for the policies which were there from the start
+def first_round_of(number):
+    if number < policy_count:
+        return 0
+
+    # Nothing is ever added so this policy never shows up
+    if added_per_round == 0:
+        return run + 1
+
+    return (number - policy_count) / added_per_round + 1
+
+
+
+# Return True if a policy exists at the current run
+def policy_exists(number):
+    if number < 0 or first_round_of(number) > run:
+        return False
+
+    return times_hit("remove", number, first_round_of(number) + 1, remove_percent) == 0
+
+
+
+# Return a list of (number, first_round) of the policies which exist at the current run
+def existing_policies():
+    numbers = xrange(policy_count + run * added_per_round)
+
+    return [(number, first_round_of(number)) for number in numbers if policy_exists(number)]
+
+
+
+def policy_name(number):
+    return "POLICY-" + "%06d" % number
+
+
+
+def client_name(number, index):
+    return "client-" + "%06d" % ((number * 7 + index) % (policy_count * 2)) + ".example.edu"
+
+
+
+# Return the lines of a policy as "bppllist -L" shows it
+def policy_lines(number, first_round):
+    version = times_hit("change", number, first_round + 1, change_percent)
+
+    lines = [
+        "Policy Name:       " + policy_name(number),
+        "Policy Type:         Standard (0)",
+        "Active:              yes",
+        "Effective date:      01/01/2015 00:00:00",
+        "Generation:          " + str(1 + version),
+        "Residence:           stu-disk-" + "%02d" % ((number + version) % 8),
+        "Volume Pool:         NetBackup",
+        "Max Jobs/Policy:     Unlimited",
+        "Keyword:             (none specified)",
+    ]
+
+    for index in xrange(clients_per_policy):
+        lines.append("HW/OS/Client:  Linux         RedHat2.6.18  " + client_name(number, index))
+
+    for index in xrange(includes_per_policy):
+        lines.append("Include:  /data/" + ["home", "opt", "var", "srv", "scratch"][(number + index) % 5] + "/" + str(index) + ("/v" + str(version) if index == 0 and version > 0 else ""))
+
+    for schedule in ["Full", "Incr"]:
+        lines.append("Schedule:          " + schedule)
+        lines.append("  Type:            " + ("Full Backup" if schedule == "Full" else "Differential Incremental Backup"))
+        lines.append("  Frequency:       every " + ("7 days" if schedule == "Full" else "1 day"))
+        lines.append("  Retention Level: 1 (2 weeks)")
+
+    lines.append("")
+
+    return lines
+
+
+
+# Return the lines of a policy as "bppllist -l" (raw) shows it, the generation is the 19th field of INFO
+def policy_raw_lines(number, first_round):
+    version = times_hit("change", number, first_round + 1, change_percent)
+
+    lines = [
+        "CLASS " + policy_name(number) + " *NULL* 0 750000 0 *NULL*",
+        "NAMES",
+        "INFO " + " ".join(["0"] * 18) + " " + str(1 + version) + " 0 0 0",
+        "KEY *NULL*",
+        "RES stu-disk-" + "%02d" % ((number + version) % 8),
+    ]
+
+    for index in xrange(clients_per_policy):
+        lines.append("CLIENT " + client_name(number, index) + " Linux RedHat2.6.18 0 0 0 0 ?")
+
+    for index in xrange(includes_per_policy):
+        lines.append("INCLUDE /data/" + str(index))
+
+    return lines
+
+
+
+# Return the lines of a schedule as "bpschedule -L" shows it
+def schedule_lines(number):
+    version = times_hit("schedule", number, 1, change_percent)
+
+    return [
+        "Schedule:              SCHEDULE-" + "%04d" % number,
+        "  Type:                Full Backup",
+        "  Frequency:           every " + str(7 + version) + " days",
+        "  Retention Level:     " + str(number % 10),
+        "  Daily Windows:",
+        "    Sunday     " + "%02d" % ((number + version) % 24) + ":00:00  -->  Sunday     23:59:59",
+        "",
+    ]
+
+
+
+def write_lines(lines):
+    sys.stdout.write("\n".join(lines) + "\n")
+
+
+
+def bpplclients(args):
+    write_lines([
+        "Hardware         OS             Client",
+        "---------------  -------------  --------------",
+    ])
+
+    clients = set()
+    for (number, first_round) in existing_policies():
+        for index in xrange(clients_per_policy):
+            clients.add(client_name(number, index))
+
+    for client in sorted(clients):
+        write_lines(["Linux            RedHat2.6.18   " + client])
+
+    return 0
+
+
+
+def bppllist(args):
+    if len(args) >= 2 and args[0] == "-allpolicies" and args[1] == "-L":
+        for (number, first_round) in existing_policies():
+            write_lines(policy_lines(number, first_round))
+
+        return 0
+
+    if len(args) >= 2 and args[0] == "-allpolicies" and args[1] == "-l":
+        for (number, first_round) in existing_policies():
+            write_lines(policy_raw_lines(number, first_round))
+
+        return 0
+
+    if len(args) >= 2 and args[1] == "-L":
+        try:
+            number = int(args[0][len("POLICY-"):]) if args[0].startswith("POLICY-") else -1
+
+        except ValueError:
+            number = -1
+
+        if policy_exists(number):
+            write_lines(policy_lines(number, first_round_of(number)))
+            return 0
+
+        # "no entity was found"
+        return 227
+
+    sys.stderr.write("bppllist stand-in: unsupported arguments " + " ".join(args) + "\n")
+    return 20
+
+
+
+def bpschedule(args):
+    for number in xrange(schedule_count):
+        write_lines(schedule_lines(number))
+
+    return 0
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--install":
+        # Make a directory of links named after each admin command pointing back to us
+        if not os.path.isdir(sys.argv[2]):
+            os.makedirs(sys.argv[2])
+
+        for command in commands:
+            link = os.path.join(sys.argv[2], command)
+
+            if os.path.lexists(link):
+                os.unlink(link)
+
+            os.symlink(os.path.abspath(__file__), link)
+
+        sys.exit(0)
+
+    command = os.path.basename(sys.argv[0])
+
+    if command not in commands:
+        sys.stderr.write("Usage: " + command + " --install DIR\n" + "Then run DIR/bpplclients, DIR/bppllist or DIR/bpschedule\n")
+        sys.exit(1)
+
+    # The reporter passes -M master when collecting from a remote master, we have only one
+    args = sys.argv[1:]
+    if "-M" in args:
+        index = args.index("-M")
+        del args[index:index + 2]
+
+    sys.exit(globals()[command](args))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Description: Fast line diff for very large NetBackup policies, used by nb_policy_report.py
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+# difflib.SequenceMatcher is quadratic on long inputs with many repeated lines, which is what a policy with
+# thousands of include paths or clients looks like.  This is a patience diff: every line is hashed to an
+# integer once, the common prefix and suffix are stripped, lines which appear exactly once on both sides are
+# matched up with a longest increasing subsequence and the gaps between them are diffed the same way.
+# Gaps with no unique lines left fall back to difflib when small and are reported as replaced when not.
+# Large, mostly-append changes are handled in close to linear time.
+
+
+
+import bisect
+import difflib
+
+
+
+# Gaps without unique lines are handed to difflib when len(a) * len(b) is at most this
+difflib_fallback_limit = 250000
+
+
+
+# Return the indexes of the longest increasing subsequence of values
+def _longest_increasing_subsequence(values):
+    tails = [] # tails[k] is the smallest value ending an increasing run of length k + 1
+    tail_indexes = []
+    previous = [None] * len(values)
+
+    for (i, value) in enumerate(values):
+        k = bisect.bisect_left(tails, value)
+
+        if k > 0:
+            previous[i] = tail_indexes[k - 1]
+
+        if k == len(tails):
+            tails.append(value)
+            tail_indexes.append(i)
+
+        else:
+            tails[k] = value
+            tail_indexes[k] = i
+
+    result = []
+    i = tail_indexes[-1] if len(tail_indexes) > 0 else None
+    while i is not None:
+        result.append(i)
+        i = previous[i]
+
+    result.reverse()
+
+    return result
+
+
+
+# Return a sorted list of (a_index, b_index) pairs of matching lines between two lists of hashed lines
+def _matching_lines(a, b):
+    matches = []
+    ranges = [(0, len(a), 0, len(b))]
+
+    while len(ranges) > 0:
+        (alo, ahi, blo, bhi) = ranges.pop()
+
+        # Common prefix and suffix
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+
+        if alo == ahi or blo == bhi:
+            continue
+
+        # Lines which appear exactly once on each side
+        a_counts = {}
+        for i in xrange(alo, ahi):
+            line = a[i]
+            if line in a_counts:
+                a_counts[line] = -1
+            else:
+                a_counts[line] = i
+
+        b_counts = {}
+        for j in xrange(blo, bhi):
+            line = b[j]
+            if a_counts.get(line, -1) == -1:
+                continue
+            if line in b_counts:
+                b_counts[line] = -1
+            else:
+                b_counts[line] = j
+
+        unique = sorted((a_counts[line], j) for (line, j) in b_counts.iteritems() if j != -1)
+
+        if len(unique) == 0:
+            if (ahi - alo) * (bhi - blo) <= difflib_fallback_limit:
+                matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+
+                for (i, j, size) in matcher.get_matching_blocks():
+                    for k in xrange(size):
+                        matches.append((alo + i + k, blo + j + k))
+
+            continue
+
+        # Anchor on the unique lines which are in the same order on both sides and diff the gaps between them
+        anchors = [unique[k] for k in _longest_increasing_subsequence([j for (i, j) in unique])]
+
+        (last_i, last_j) = (alo, blo)
+        for (i, j) in anchors:
+            matches.append((i, j))
+            ranges.append((last_i, i, last_j, j))
+            (last_i, last_j) = (i + 1, j + 1)
+
+        ranges.append((last_i, ahi, last_j, bhi))
+
+    matches.sort()
+
+    return matches
+
+
+
+# Return the changed lines between two lists of lines in the form difflib.unified_diff(a, b, n=0) shows
+# them once its headers and "@@" lines are removed: each run of changes as "-" lines then "+" lines
+def line_diff(a, b):
+    # Hash every distinct line to a small integer so comparisons are cheap
+    line_ids = {}
+    a_ids = [line_ids.setdefault(line, len(line_ids)) for line in a]
+    b_ids = [line_ids.setdefault(line, len(line_ids)) for line in b]
+
+    diff = []
+
+    (last_i, last_j) = (0, 0)
+    for (i, j) in _matching_lines(a_ids, b_ids) + [(len(a), len(b))]:
+        for line in a[last_i:i]:
+            diff.append("-" + line)
+
+        for line in b[last_j:j]:
+            diff.append("+" + line)
+
+        (last_i, last_j) = (i + 1, j + 1)
+
+    return diff
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Description: Compare the speed of nb_linediff and difflib on synthetic NetBackup policies
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+import sys
+import re
+import time
+import random
+import collections
+import difflib
+from optparse import OptionParser
+
+import nb_linediff
+
+
+
+# How were we called?
+parser = OptionParser("%prog [options]\n" +
+    "Compare the speed of nb_linediff and difflib on synthetic NetBackup policies.\n" +
+    "Each diff is also checked to turn the old policy into the new one."
+)
+
+parser.add_option(
+    "-l", "--lines",
+    action="store", type="int", dest="lines", default=10000,
+    help="Number of include and client lines in each synthetic policy (default: %default)"
+)
+
+parser.add_option(
+    "-s", "--seed",
+    action="store", type="int", dest="seed", default=1,
+    help="Random seed for the synthetic policies (default: %default)"
+)
+
+parser.add_option(
+    "--skip-difflib",
+    action="store_true", dest="skip_difflib", default=False,
+    help="Only time nb_linediff, difflib can take minutes on large policies"
+)
+
+(options, args) = parser.parse_args()
+
+
+
+# Return the lines of a policy as "bppllist -L" shows it with a large include and client list
+def make_policy(name, line_count, rng):
+    lines = [
+        "Policy Type:         Standard (0)\n",
+        "Active:              yes\n",
+        "Generation:          1\n",
+        "Residence:           stu-disk-01\n",
+        "Volume Pool:         NetBackup\n",
+    ]
+
+    for i in xrange(line_count / 2):
+        lines.append("HW/OS/Client:  Linux         RedHat2.6.18  " + name + "-client-" + str(i) + ".example.edu\n")
+
+    for i in xrange(line_count - line_count / 2):
+        # Include paths repeat heavily between clients, which is what makes difflib slow
+        lines.append("Include:  /data/" + rng.choice(["home", "opt", "var", "srv", "scratch"]) + "/" + str(i % 50) + "\n")
+
+    lines.append("Schedule:          Full\n")
+    lines.append("  Type:            Full Backup\n")
+
+    return lines
+
+
+
+# Return a changed copy of a policy for each kind of change we see in production
+def mutations(lines, rng):
+    appended = lines[:-2] + ["Include:  /data/new/" + str(i) + "\n" for i in xrange(len(lines) / 20)] + lines[-2:]
+
+    scattered = lines[:]
+    for i in rng.sample(xrange(5, len(lines) - 2), len(lines) / 100):
+        scattered[i] = scattered[i].replace(".example.edu", ".example.org")
+
+    middle = len(lines) / 2
+    inserted = lines[:middle] + ["HW/OS/Client:  Linux         RedHat2.6.18  inserted-" + str(i) + "\n" for i in xrange(200)] + lines[middle:]
+
+    removed = lines[:middle - 500] + lines[middle + 500:]
+
+    shuffled = lines[:5] + sorted(lines[5:-2], key=lambda line: rng.random()) + lines[-2:]
+
+    return [
+        ("append 5%", appended),
+        ("scattered 1% edits", scattered),
+        ("block insert", inserted),
+        ("block delete", removed),
+        ("reordered", shuffled),
+    ]
+
+
+
+# Return the "-" and "+" lines of difflib's n=0 unified diff without the headers and "@@" lines,
+# the same way nb_policy_report.py shows them
+def difflib_diff(a, b):
+    return [line for line in list(difflib.unified_diff(a, b, n=0))[2:] if not re.search("^@@", line)]
+
+
+
+# Sanity check a diff: taking the "-" lines out of a and the "+" lines out of b must leave the same lines
+def diff_is_valid(a, b, diff):
+    removed = collections.Counter(line[1:] for line in diff if line.startswith("-"))
+    added = collections.Counter(line[1:] for line in diff if line.startswith("+"))
+
+    return collections.Counter(a) - removed == collections.Counter(b) - added
+
+
+
+rng = random.Random(options.seed)
+policy = make_policy("policy", options.lines, rng)
+
+sys.stdout.write("Policy of " + str(len(policy)) + " lines\n\n")
+sys.stdout.write("%-22s %14s %14s %12s %12s\n" % ("change", "nb_linediff s", "difflib s", "fast lines", "difflib lines"))
+
+for (description, changed) in mutations(policy, rng):
+    start = time.time()
+    fast_diff = nb_linediff.line_diff(policy, changed)
+    fast_time = time.time() - start
+
+    if not diff_is_valid(policy, changed, fast_diff):
+        sys.stderr.write("nb_linediff produced an invalid diff for change: " + description + "\n")
+        sys.exit(1)
+
+    if options.skip_difflib:
+        sys.stdout.write("%-22s %14.3f %14s %12d %12s\n" % (description, fast_time, "-", len(fast_diff), "-"))
+        continue
+
+    start = time.time()
+    slow_diff = difflib_diff(policy, changed)
+    slow_time = time.time() - start
+
+    sys.stdout.write("%-22s %14.3f %14.3f %12d %12d\n" % (description, fast_time, slow_time, len(fast_diff), len(slow_diff)))
@@ -19,8 +19,20 @@ import re
 import subprocess
 import syslog
 import pickle
+import sqlite3
+import zlib
+import time
+import hashlib
 import datetime
+import resource
 import difflib
+import nb_linediff
+import threading
+import Queue
+import signal
+import functools
+import itertools
+import multiprocessing
 from optparse import OptionParser
 
 
@@ -30,7 +42,102 @@ parser = OptionParser("%prog [options]\n" +
     "Report changes to NetBackup policies and schedules.\n" +
     "WARNING: This program compares against the last known state of policies and schedules.\n" + 
     "This means running this will affect the next run's report!\n" + 
-    "State data is held in /usr/local/nb_policy_reporter/.\n"
+    "State data is held in /usr/local/nb_policy_reporter/state.db, every run is kept so past runs can be compared\n" +
+    "with --list-runs, --diff-runs and --since without querying NetBackup.\n" +
+    "Which policies back up a client, include a path or use a schedule is answered from the state store with\n" +
+    "--which-client, --which-include and --which-schedule.\n" +
+    "Several masters can be reported on at once with --master, each keeps its own state under the state directory.\n"
+)
+
+parser.add_option(
+    "-M", "--master",
+    action="append", type="string", dest="masters", default=[], metavar="MASTER[=ADMINCMD_DIR]",
+    help="Collect from this master server rather than the local one, may be given more than once.  " +
+        "The admin commands are ran locally with -M MASTER unless a directory holding stand-in admin commands for the master is given."
+)
+
+parser.add_option(
+    "--clients-timeout",
+    action="store", type="int", dest="clients_timeout", default=3600,
+    help="Seconds to wait for bpplclients before giving up (default: %default)"
+)
+
+parser.add_option(
+    "--policies-timeout",
+    action="store", type="int", dest="policies_timeout", default=3600,
+    help="Seconds to wait for bppllist (each call of it in incremental mode) before giving up (default: %default)"
+)
+
+parser.add_option(
+    "--schedules-timeout",
+    action="store", type="int", dest="schedules_timeout", default=3600,
+    help="Seconds to wait for bpschedule before giving up (default: %default)"
+)
+
+parser.add_option(
+    "-i", "--incremental",
+    action="store_true", dest="incremental", default=False,
+    help="Only fetch the full definition of policies whose generation changed since the last run"
+)
+
+parser.add_option(
+    "--fetch-workers",
+    action="store", type="int", dest="fetch_workers", default=8,
+    help="Number of policies to fetch at once in incremental mode (default: %default)"
+)
+
+parser.add_option(
+    "--list-runs",
+    action="store_true", dest="list_runs", default=False,
+    help="List the runs held in the state store and exit"
+)
+
+parser.add_option(
+    "--diff-runs",
+    action="store", type="int", nargs=2, dest="diff_runs", default=None, metavar="FIRST_RUN SECOND_RUN",
+    help="Report the differences between two past runs (see --list-runs) and exit"
+)
+
+parser.add_option(
+    "--since",
+    action="store", type="string", dest="since", default=None, metavar="YYYY-MM-DD[ HH:MM]",
+    help="Report the differences between the state at the given time and the latest run and exit"
+)
+
+parser.add_option(
+    "--which-client",
+    action="store", type="string", dest="which_client", default=None, metavar="CLIENT",
+    help="List the policies backing up a client as of the latest run and exit, shell style wildcards (* ? [...]) may be used"
+)
+
+parser.add_option(
+    "--which-include",
+    action="store", type="string", dest="which_include", default=None, metavar="PATH",
+    help="List the policies including a path as of the latest run and exit, shell style wildcards may be used"
+)
+
+parser.add_option(
+    "--which-schedule",
+    action="store", type="string", dest="which_schedule", default=None, metavar="SCHEDULE",
+    help="List the policies with a schedule of this name as of the latest run and exit, shell style wildcards may be used"
+)
+
+parser.add_option(
+    "--diff-processes",
+    action="store", type="int", dest="diff_processes", default=multiprocessing.cpu_count(),
+    help="Number of processes to spread the diffs of changed policies and schedules over (default: %default)"
+)
+
+parser.add_option(
+    "--state-dir",
+    action="store", type="string", dest="state_dir", default="/usr/local/nb_policy_reporter",
+    help="Directory to hold state data in (default: %default)"
+)
+
+parser.add_option(
+    "--timings",
+    action="store_true", dest="timings", default=False,
+    help="Show how long each phase of the run took and the peak RSS at the end of it on STDERR"
 )
 
 (options, args) = parser.parse_args()
@@ -49,376 +156,1086 @@ syslog.openlog(os.path.basename(sys.argv[0]), syslog.LOG_NOWAIT, syslog.LOG_SYSL
 
 
 # Prepare needed directories
-if not os.path.isdir("/usr/local/nb_policy_reporter"):
+if not os.path.isdir(options.state_dir):
     try:
-        os.mkdir("/usr/local/nb_policy_reporter", 0755)
+        os.mkdir(options.state_dir, 0755)
         
     except Exception as err:
-        sys.stderr.write("Failed to create directory /usr/local/nb_policy_reporter: " + str(err) + " - EXITING\n")
-        #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to create directory /usr/local/nb_policy_reporter - EXITING")
+        sys.stderr.write("Failed to create directory " + options.state_dir + ": " + str(err) + " - EXITING\n")
+        #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to create directory " + options.state_dir + " - EXITING")
     
         sys.exit(1)
 
+
+
+# Note how long a phase of the run took and the peak RSS so far (ours and our largest child's, e.g. a diff process),
+# shown at the end with --timings
+phase_timings = []
+phase_start = time.time()
+
+def end_phase(phase):
+    global phase_start
+
+    now = time.time()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    phase_timings.append((phase, now - phase_start, peak_rss, children_peak_rss))
+    phase_start = now
+
         
         
+# Only needed to read the pickles older versions saved their state in
 class policy_class:
     pass
 
 class schedule_class:
     pass
-        
-        
-        
-# The main data structures
-clients = {
-    "current_list" : [],
-    "last_list" : [],
-    "new_list" : [],
-    "removed_list" : [],
-}
-schedules = {
-    "current_list" : [],
-    "last_list" : [],
-    "new_list" : [],
-    "removed_list" : [],
-    "eachschedulename" : {
-        "current_data" : [],
-        "last_data" : [],
-    },
-}
-policies = {
-    "current_list" : [],
-    "last_list" : [],
-    "new_list" : [],
-    "removed_list" : [],
-    "eachpolicyname" : {
-        "current_data" : [],
-        "last_data" : [],
-    },
-}
 
 
 
+# Read "-L" style output from a NetBackup command one record at a time
+# A record starts at a line matching header_regex (e.g. "Policy Name:" or "Schedule:")
+# and runs until the next header, only the record being built is held in memory
+# Yields (name, lines) tuples with each line ending in "\n" and blank lines dropped
+def read_records(stream, header_regex):
+    header = re.compile(header_regex)
+
+    name = None
+    lines = []
+
+    for line in iter(stream.readline, ""):
+        line = line.rstrip()
+
+        if not line:
+            continue
+
+        match = header.match(line)
+
+        # We hit a new record, hand back the one we were building
+        if match:
+            if name is not None:
+                yield (name, lines)
+
+            name = match.group(1)
+            lines = []
+
+        # We hit a config line
+        elif name is not None:
+            lines.append(line + "\n")
+
+    if name is not None:
+        yield (name, lines)
+
+
+
+# Return a digest of a record's lines, used to tell if a record changed without diffing it
+# Lines matching ignore_regex (e.g. the policy "Generation" counter) do not count
+def record_digest(lines, ignore_regex=None):
+    digest = hashlib.md5()
+
+    for line in lines:
+        if ignore_regex is not None and re.match(ignore_regex, line):
+            continue
+
+        digest.update(line)
+
+    return digest.hexdigest()
+
+
+
+# Compare two {name: digest} dicts and return sorted lists of the names which are
+# new, removed and changed (same name with a different digest)
+def compare_digests(last_digests, current_digests):
+    current_names = set(current_digests)
+    last_names = set(last_digests)
+
+    new_list = sorted(current_names - last_names)
+    removed_list = sorted(last_names - current_names)
+    changed_list = sorted(name for name in current_names & last_names if current_digests[name] != last_digests[name])
+
+    return (new_list, removed_list, changed_list)
+
+
+
+# Return the clients, include paths and schedule names of a policy's "-L" lines as three sets
+# A field continued on the following lines (e.g. more include paths) is indented with no name of its own
+def parse_policy(lines):
+    field_regex = re.compile("^\s*([A-Za-z][A-Za-z/ ]+?):(?:\s+|$)(.*)$")
+
+    (clients, includes, schedules) = (set(), set(), set())
+
+    field = None
+    for line in lines:
+        match = field_regex.match(line)
+
+        if match:
+            field = match.group(1)
+            value = match.group(2).strip()
+
+        else:
+            value = line.strip()
+
+        if not value:
+            continue
+
+        if field == "HW/OS/Client":
+            # Hardware and OS can hold spaces, the client name never does
+            clients.add(value.split()[-1].lower())
+
+        elif field == "Include":
+            includes.add(value)
+
+        elif field == "Schedule":
+            schedules.add(value)
+
+    return (clients, includes, schedules)
+
+
+
+# Read the output of bpplclients one client at a time
+def read_clients(stream):
+    header = re.compile("^(Hardware\s+|-+|\s*$)")
+
+    for line in iter(stream.readline, ""):
+        line = line.rstrip()
+
+        # Skip the header lines
+        if header.match(line):
+            continue
+
+        yield line.lower().split()[2]
+
 
 
 #
-# Get the previous data
+# State store
 #
 
-# Clients
-try:
-    if os.path.isfile("/usr/local/nb_policy_reporter/clients.pkl"):
-        pickle_handle = open("/usr/local/nb_policy_reporter/clients.pkl", "r")
-        
-        clients = pickle.load(pickle_handle)
-        
-        pickle_handle.close()
-        
-    else:
-        sys.stderr.write("WARNING: Previous data for clients not found, moving on anyway\n")
-    
-    
-except Exception as err:
-    sys.stderr.write("Failed to get the get the previous data for clients: " + str(err) + "\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get the get the previous data for clients:"  + str(err))
-    
-    
-# Schedules
-try:
-    if os.path.isfile("/usr/local/nb_policy_reporter/schedules.pkl"):
-        pickle_handle = open("/usr/local/nb_policy_reporter/schedules.pkl", "r")
-        
-        schedules = pickle.load(pickle_handle)
-        
-        pickle_handle.close()
-        
+# Every run is recorded in an SQLite database.  Only the records which are new, changed or
+# removed in a run are written (a removal is a row with a NULL digest) so the state as of any
+# run is the latest row of each name at or before that run.  Policy and schedule bodies are
+# stored once per digest, compressed, and are only read back when a diff needs them.
+# The clients, include paths and schedules of the latest run's policies are also kept as an
+# index from each of them to the policies using it, so it can be queried without NetBackup.
+
+state_dir = options.state_dir
+
+
+
+# Open (and create if needed) the state store
+# Each master's store is only ever used by one thread at a time, but not always the same one
+def open_state(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.text_factory = str
+
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, run_time INTEGER NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS bodies (digest TEXT PRIMARY KEY, body BLOB NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS records (kind TEXT NOT NULL, name TEXT NOT NULL, run_id INTEGER NOT NULL, digest TEXT, generation TEXT, PRIMARY KEY (kind, name, run_id))")
+        db.execute("CREATE INDEX IF NOT EXISTS records_run ON records (run_id)")
+        db.execute("CREATE TABLE IF NOT EXISTS policy_index (kind TEXT NOT NULL, key TEXT NOT NULL, policy TEXT NOT NULL, PRIMARY KEY (kind, key, policy))")
+        db.execute("CREATE INDEX IF NOT EXISTS policy_index_policy ON policy_index (policy)")
+        db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+
+    return db
+
+
+
+# Return (run_id, run_time) of the latest run at or before the given time (default: now) or None
+def find_run(db, before_time=None):
+    if before_time is None:
+        return db.execute("SELECT run_id, run_time FROM runs ORDER BY run_id DESC LIMIT 1").fetchone()
+
+    return db.execute("SELECT run_id, run_time FROM runs WHERE run_time <= ? ORDER BY run_id DESC LIMIT 1", (before_time,)).fetchone()
+
+
+
+# Return {name: (digest, generation)} of a kind ("client", "policy" or "schedule") as of a run
+def load_state(db, kind, run_id):
+    state = {}
+
+    for (name, digest, generation) in db.execute(
+        "SELECT records.name, records.digest, records.generation FROM records " +
+        "JOIN (SELECT name, MAX(run_id) AS run_id FROM records WHERE kind = ? AND run_id <= ? GROUP BY name) AS latest " +
+        "ON records.name = latest.name AND records.run_id = latest.run_id WHERE records.kind = ?",
+        (kind, run_id, kind)
+    ):
+        if digest is not None:
+            state[name] = (digest, generation)
+
+    return state
+
+
+
+# Return the lines of a policy or schedule body of a master by digest
+def load_body(master, digest):
+    if digest in master.pending_bodies:
+        return master.pending_bodies[digest]
+
+    row = master.db.execute("SELECT body FROM bodies WHERE digest = ?", (digest,)).fetchone()
+
+    if row is None:
+        return []
+
+    return zlib.decompress(str(row[0])).splitlines(True)
+
+
+
+# Record a run of a master in one transaction, only what changed since the last run is written
+def save_run(master, run_time):
+    db = master.db
+
+    with db:
+        run_id = db.execute("INSERT INTO runs (run_time) VALUES (?)", (run_time,)).lastrowid
+
+        for client in master.clients["new_list"]:
+            db.execute("INSERT INTO records (kind, name, run_id, digest) VALUES ('client', ?, ?, '')", (client, run_id))
+
+        for client in master.clients["removed_list"]:
+            db.execute("INSERT INTO records (kind, name, run_id, digest) VALUES ('client', ?, ?, NULL)", (client, run_id))
+
+        for (kind, data) in [("policy", master.policies), ("schedule", master.schedules)]:
+            generations = data.get("current_generations", {})
+            last_generations = data.get("last_generations", {})
+
+            # A new generation with the same content is saved so incremental runs don't fetch it again
+            regenerated_list = [name for name in generations if name in data["last_digests"] and generations[name] != last_generations.get(name)]
+
+            for name in set(data["new_list"] + data["changed_list"] + regenerated_list):
+                digest = data["current_digests"][name]
+
+                if digest in master.pending_bodies:
+                    db.execute("INSERT OR IGNORE INTO bodies (digest, body) VALUES (?, ?)", (digest, sqlite3.Binary(zlib.compress("".join(master.pending_bodies[digest])))))
+
+                db.execute("INSERT INTO records (kind, name, run_id, digest, generation) VALUES (?, ?, ?, ?, ?)", (kind, name, run_id, digest, generations.get(name)))
+
+            for name in data["removed_list"]:
+                db.execute("INSERT INTO records (kind, name, run_id, digest) VALUES (?, ?, ?, NULL)", (kind, name, run_id))
+
+        update_index(master, run_id)
+
+    return run_id
+
+
+
+# Bring the policy index up to date with a run being saved, only new, changed and removed policies are touched
+# The index is built from every policy once if it was not made from the run before (e.g. a store made before it existed)
+def update_index(master, run_id):
+    db = master.db
+    data = master.policies
+
+    indexed_run = db.execute("SELECT value FROM settings WHERE name = 'index_run'").fetchone()
+    last_run_id = master.last_run[0] if master.last_run is not None else None
+
+    if indexed_run is not None and (last_run_id is None or int(indexed_run[0]) == last_run_id):
+        stale_list = data["new_list"] + data["changed_list"] + data["removed_list"]
+        index_list = data["new_list"] + data["changed_list"]
+
     else:
-        sys.stderr.write("WARNING: Previous data for schedules not found, moving on anyway\n")
-    
-    
-except Exception as err:
-    sys.stderr.write("Failed to get the get the previous data for schedules: " + str(err) + "\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get the get the previous data for schedules:"  + str(err))
-    
-    
-# Policies
-try:
-    if os.path.isfile("/usr/local/nb_policy_reporter/policies.pkl"):
-        pickle_handle = open("/usr/local/nb_policy_reporter/policies.pkl", "r")
-        
-        policies = pickle.load(pickle_handle)
-        
+        db.execute("DELETE FROM policy_index")
+        stale_list = []
+        index_list = data["current_digests"].keys()
+
+    for name in stale_list:
+        db.execute("DELETE FROM policy_index WHERE policy = ?", (name,))
+
+    for name in index_list:
+        (clients, includes, schedules) = parse_policy(load_body(master, data["current_digests"][name]))
+
+        db.executemany(
+            "INSERT OR IGNORE INTO policy_index (kind, key, policy) VALUES (?, ?, ?)",
+            [("client", key, name) for key in clients] + [("include", key, name) for key in includes] + [("schedule", key, name) for key in schedules]
+        )
+
+    db.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('index_run', ?)", (str(run_id),))
+
+
+
+# Return a sorted list of the policies of a master using a client, include path or schedule ("client", "include" or
+# "schedule") matching a shell style pattern
+def query_index(master, kind, pattern):
+    if kind == "client":
+        pattern = pattern.lower()
+
+    return [row[0] for row in master.db.execute("SELECT DISTINCT policy FROM policy_index WHERE kind = ? AND key GLOB ? ORDER BY policy", (kind, pattern))]
+
+
+
+# Bring the pickles older versions saved their state in into a master's empty state store as its first run
+def import_pickles(master):
+    if find_run(master.db) is not None or not os.path.isfile(state_dir + "/policies.pkl"):
+        return
+
+    sys.stderr.write("WARNING: Importing previous data from " + state_dir + "/*.pkl into " + master.state_file + "\n")
+
+    imported = {}
+    for kind in ["clients", "schedules", "policies"]:
+        imported[kind] = {"current_list" : []}
+
+        if not os.path.isfile(state_dir + "/" + kind + ".pkl"):
+            continue
+
+        pickle_handle = open(state_dir + "/" + kind + ".pkl", "r")
+
+        imported[kind] = pickle.load(pickle_handle)
+
         pickle_handle.close()
-        
-    else:
-        sys.stderr.write("WARNING: Previous data for policies not found, moving on anyway\n")
-    
-    
-except Exception as err:
-    sys.stderr.write("Failed to get the get the previous data for policies: " + str(err) + "\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get the get the previous data for policies:"  + str(err))
-    
-    
-    
-# Move current to last
-clients["last_list"] = clients["current_list"][:]
-schedules["last_list"] = schedules["current_list"][:]
-policies["last_list"] = policies["current_list"][:]
-clients["current_list"] = []
-schedules["current_list"] = []
-policies["current_list"] = []
-        
-        
-        
-        
-        
+
+    old_master = new_master(master.name, master.admincmd, master.remote, master.state_file)
+    old_master.db = master.db
+
+    old_master.clients["new_list"] = sorted(set(imported["clients"]["current_list"]))
+
+    for (kind, data) in [("schedules", old_master.schedules), ("policies", old_master.policies)]:
+        data["current_generations"] = imported[kind].get("current_generations", {})
+
+        for name in set(imported[kind]["current_list"]):
+            lines = imported[kind][name].current_data
+            digest = record_digest(lines, policy_ignore_regex if kind == "policies" else None)
+
+            old_master.pending_bodies[digest] = lines
+            data["new_list"].append(name)
+            data["current_digests"][name] = digest
+
+    save_run(old_master, int(os.stat(state_dir + "/policies.pkl")[8]))
+
+    for kind in ["clients", "schedules", "policies"]:
+        if os.path.isfile(state_dir + "/" + kind + ".pkl"):
+            os.rename(state_dir + "/" + kind + ".pkl", state_dir + "/" + kind + ".pkl-imported")
+
+
+
+# Return a copy of a master comparing the state as of two of its past runs
+# It has the same shape as a live run so write_report() can be used on it
+def compare_runs(master, first_run_id, second_run_id):
+    old_master = new_master(master.name, master.admincmd, master.remote, master.state_file)
+    old_master.db = master.db
+
+    first_clients = load_state(master.db, "client", first_run_id)
+    second_clients = load_state(master.db, "client", second_run_id)
+
+    old_master.clients["new_list"] = sorted(set(second_clients) - set(first_clients))
+    old_master.clients["removed_list"] = sorted(set(first_clients) - set(second_clients))
+
+    for (kind, data) in [("policy", old_master.policies), ("schedule", old_master.schedules)]:
+        data["last_digests"] = dict((name, value[0]) for (name, value) in load_state(master.db, kind, first_run_id).items())
+        data["current_digests"] = dict((name, value[0]) for (name, value) in load_state(master.db, kind, second_run_id).items())
+
+        (data["new_list"], data["removed_list"], data["changed_list"]) = compare_digests(data["last_digests"], data["current_digests"])
+
+    return old_master
+
+
+
+
+
 #
-# Clients
+# Reporting
 #
 
-# Get the current list of clients
-try:
-    clients_proc = subprocess.Popen(["/usr/openv/netbackup/bin/admincmd/bpplclients"], stdin=None, stdout=subprocess.PIPE, shell=False)
-    out = clients_proc.communicate()[0]
-    
-    for line in out.split(os.linesep):
-        line = line.rstrip()
-        
-        # Skip the header lines and add the client to the current list of clients
-        match = re.search("^(Hardware\s+|-+|^\s*$)", line)
-        if match: continue
-        
-        clients["current_list"].append(line.lower().split()[2])
-        
-        
-except Exception as err:
-    sys.stderr.write("Failed to get the current list of clients: " + str(err) + " - EXITING\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get current list of clients - EXITING")
-    
-    sys.exit(1)
-        
-        
-        
-# Compare the client lists   
-clients["new_list"] = [i for i in clients["current_list"] if i not in clients["last_list"]]
-clients["removed_list"] = [i for i in clients["last_list"] if i not in clients["current_list"]]
-        
-        
-        
-        
+# Return the lines of a diff between two versions of a policy or schedule as the report shows them
+# difflib is quadratic on very large policies so those go through nb_linediff, which gives the same format
+def render_diff(last_data, current_data, ignore_regex=None):
+    if len(last_data) + len(current_data) > fast_diff_threshold:
+        diff = nb_linediff.line_diff(last_data, current_data)
+
+    else:
+        diff = list(difflib.unified_diff(last_data, current_data, n=0))
+
+        # Remove junk I don't want
+        del diff[0:2]
+
+    pretty_diff = []
+    for line in diff:
+        if not re.search("^@@", line) and (ignore_regex is None or not re.search(ignore_regex, line)):
+            pretty_diff.append(line)
+
+    return pretty_diff
+
+
+
+# render_diff() taking its arguments as one tuple, for multiprocessing
+def render_diff_job(job):
+    return render_diff(*job)
+
+
+
+# Return an iterator of the rendered diffs of each changed record in data["changed_list"], in order
+# The bodies are read from the state store in batches and each batch is diffed by the process pool (if any)
+# so the report comes out the same as a serial run no matter how many processes are used
+def render_diffs(master, data, ignore_regex, pool):
+    names = data["changed_list"]
+    batch_size = options.diff_processes * 16
+
+    for start in range(0, len(names), batch_size):
+        jobs = [(load_body(master, data["last_digests"][name]), load_body(master, data["current_digests"][name]), ignore_regex) for name in names[start:start + batch_size]]
+
+        if pool is None:
+            results = itertools.imap(render_diff_job, jobs)
+
+        else:
+            results = pool.map(render_diff_job, jobs, max(1, len(jobs) / (options.diff_processes * 4)))
+
+        for pretty_diff in results:
+            yield pretty_diff
+
+
+
+# Write the report of what changed on a master between two states
+def write_report(master, report_time, since_time):
+    clients = master.clients
+    policies = master.policies
+    schedules = master.schedules
+
+    sys.stdout.write("Server: " + master.name + "\n")
+    sys.stdout.write("Date: " + datetime.datetime.fromtimestamp(report_time).strftime("%Y-%m-%d at %T") + "\n")
+    if since_time is not None:
+        sys.stdout.write("Differences since: " + datetime.datetime.fromtimestamp(since_time).strftime("%Y-%m-%d at %T") + "\n\n")
+    else:
+        sys.stdout.write("Differences since: The beginning of time\n\n")
+
+
+    # Counts
+    sys.stdout.write("New clients: " + str(len(clients["new_list"])) + "\n")
+    sys.stdout.write("Removed clients: " + str(len(clients["removed_list"])) + "\n")
+
+    sys.stdout.write("New policies: " + str(len(policies["new_list"])) + "\n")
+    sys.stdout.write("Removed policies: " + str(len(policies["removed_list"])) + "\n")
+
+    sys.stdout.write("New schedules: " + str(len(schedules["new_list"])) + "\n")
+    sys.stdout.write("Removed schedules: " + str(len(schedules["removed_list"])) + "\n")
+
+
+    # Change list
+    if len(clients["new_list"]) > 0:
+        sys.stdout.write("\nNew clients:\n")
+        for client in sorted(clients["new_list"]):
+            sys.stdout.write(client + "\n")
+
+    if len(clients["removed_list"]) > 0:
+        sys.stdout.write("\nRemoved clients:\n")
+        for client in sorted(clients["removed_list"]):
+            sys.stdout.write(client + "\n")
+
+
+    if len(policies["new_list"]) > 0:
+        sys.stdout.write("\nNew policies:\n")
+        for policy in sorted(policies["new_list"]):
+            sys.stdout.write(policy + "\n")
+
+    if len(policies["removed_list"]) > 0:
+        sys.stdout.write("\nRemoved policies:\n")
+        for policy in sorted(policies["removed_list"]):
+            sys.stdout.write(policy + "\n")
+
+
+    if len(schedules["new_list"]) > 0:
+        sys.stdout.write("\nNew schedules:\n")
+        for schedule in sorted(schedules["new_list"]):
+            sys.stdout.write(schedule + "\n")
+
+    if len(schedules["removed_list"]) > 0:
+        sys.stdout.write("\nRemoved schedules:\n")
+        for schedule in sorted(schedules["removed_list"]):
+            sys.stdout.write(schedule + "\n")
+
+
+
+    # A global change can touch thousands of policies at once, spread their diffs over every core
+    # A handful of changes is quicker to diff here than to hand to other processes
+    pool = None
+    if options.diff_processes > 1 and len(policies["changed_list"]) + len(schedules["changed_list"]) > options.diff_processes:
+        pool = multiprocessing.Pool(options.diff_processes)
+
+    try:
+        # Show the differences in each changed policy, unchanged policies have matching digests and are never diffed
+        for (policy, pretty_diff) in itertools.izip(policies["changed_list"], render_diffs(master, policies, policy_diff_ignore_regex, pool)):
+            sys.stdout.write("\n\nChanges in policy " + policy + ":\n" + "".join(pretty_diff))
+
+
+
+        # Show the differences in each changed schedule
+        for (schedule, pretty_diff) in itertools.izip(schedules["changed_list"], render_diffs(master, schedules, None, pool)):
+            sys.stdout.write("\n\nChanges in schedule " + schedule + ":\n" + "".join(pretty_diff))
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+
+
+
+class master_class:
+    pass
+
+
+
+# Return a master with empty data structures
+# admincmd is the directory holding its admin commands, if remote is True they are passed "-M name"
+def new_master(name, admincmd, remote, state_file):
+    master = master_class()
+    master.name = name
+    master.admincmd = admincmd
+    master.remote = remote
+    master.state_file = state_file
+    master.db = None
+    master.last_run = None
+    master.error = None
+
+    # Bodies of records seen during this run which are not in the state store yet, by digest
+    master.pending_bodies = {}
+
+    # The main data structures
+    master.clients = {
+        "current_list" : [],
+        "last_list" : [],
+        "new_list" : [],
+        "removed_list" : [],
+    }
+    master.schedules = {
+        "current_list" : [],
+        "new_list" : [],
+        "removed_list" : [],
+        "changed_list" : [],
+        "current_digests" : {},
+        "last_digests" : {},
+    }
+    master.policies = {
+        "current_list" : [],
+        "new_list" : [],
+        "removed_list" : [],
+        "changed_list" : [],
+        "current_digests" : {},
+        "last_digests" : {},
+        "current_generations" : {},
+        "last_generations" : {},
+    }
+
+    return master
+
+
+
+# Return the argv to run one of a master's admin commands
+def admin_command(master, command, *args):
+    argv = [master.admincmd + "/" + command] + list(args)
+
+    if master.remote:
+        argv = argv + ["-M", master.name]
+
+    return argv
+
+
+
+# Where the NetBackup admin commands live
+admincmd_dir = "/usr/openv/netbackup/bin/admincmd"
+
+# Exit status of bppllist for a policy which does not exist
+policy_not_found_status = 227
+
+# Lines which change on every policy modification and are not worth reporting on
+policy_ignore_regex = "^.?\s*Generation"
+
+# The same lines in a unified diff, where each line starts with one of " ", "-" or "+"
+policy_diff_ignore_regex = "^." + policy_ignore_regex[len("^.?"):]
+
+# Policies and schedules with more lines than this between both versions are diffed with nb_linediff
+fast_diff_threshold = 2000
+
+# The field of the INFO line in "bppllist -allpolicies -l" (raw) output holding the policy generation
+raw_generation_field = 19
+
+
+
+
 
 #
-# Policies
+# Collect the current data
 #
 
-# Get the current list of policies
-try:
-    policies_proc = subprocess.Popen(["/usr/openv/netbackup/bin/admincmd/bppllist", "-allpolicies", "-L"], stdin=None, stdout=subprocess.PIPE, shell=False)
-    out = policies_proc.communicate()[0]
-    
-    for line in out.split(os.linesep):
-        line = line.rstrip()
-        
-        if re.match("^$", line): continue
-        
-        match = re.match("^Policy Name:\s+(.*)$", line)
+# Add each client from bpplclients to the master's current list of clients
+def consume_clients(master, stream):
+    for client in read_clients(stream):
+        master.clients["current_list"].append(client)
 
-        # We hit a new policy
-        if match:
-            policy = match.group(1)
-            
+
+
+# Add each policy from bppllist to the master's current policies
+# Only bodies which differ from the last run are kept, the rest are already in the state store
+def consume_policies(master, stream):
+    policies = master.policies
+
+    for policy, lines in read_records(stream, "^Policy Name:\s+(.*)$"):
+        digest = record_digest(lines, policy_ignore_regex)
+
+        policies["current_list"].append(policy)
+        policies["current_digests"][policy] = digest
+
+        if policies["last_digests"].get(policy) != digest:
+            master.pending_bodies[digest] = lines
+
+        for line in lines:
+            match = re.match("^\s*Generation:\s+(\S+)", line)
+            if match:
+                policies["current_generations"][policy] = match.group(1)
+                break
+
+
+
+# Add each policy name and generation from "bppllist -allpolicies -l" to the master's current generations
+# Only the CLASS and INFO lines are looked at, the rest of the raw output is thrown away as it is read
+def consume_policy_generations(master, stream):
+    policy = None
+
+    for line in iter(stream.readline, ""):
+        fields = line.split()
+
+        if len(fields) == 0:
+            continue
+
+        if fields[0] == "CLASS":
+            policy = fields[1]
+
+        elif fields[0] == "INFO" and policy is not None:
+            master.policies["current_generations"][policy] = fields[raw_generation_field]
+            policy = None
+
+
+
+# Add each schedule from bpschedule to the master's current schedules
+def consume_schedules(master, stream):
+    schedules = master.schedules
+
+    for schedule, lines in read_records(stream, "^Schedule:\s+(.*)$"):
+        digest = record_digest(lines)
+
+        schedules["current_list"].append(schedule)
+        schedules["current_digests"][schedule] = digest
+
+        if schedules["last_digests"].get(schedule) != digest:
+            master.pending_bodies[digest] = lines
+
+
+
+class command_class:
+    pass
+
+
+
+# Kill a command which has run past its timeout
+# The command runs in its own process group so anything it spawned which holds the pipe open dies too
+def kill_command(command, proc):
+    command.timed_out = True
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+    except OSError:
+        pass
+
+
+
+# Run a command and hand its output to command.consumer as it arrives
+# The command is killed if it runs longer than command.timeout seconds
+# Sets command.error to a description of what went wrong or leaves it as None and command.status to the exit status
+def run_command(command):
+    command.error = None
+    command.timed_out = False
+    command.status = None
+
+    try:
+        # Commands are started from several threads at once, without close_fds each one would hold the write end of the
+        # pipes of those started alongside it and a reader would not see EOF until the slowest of them exited
+        proc = subprocess.Popen(command.argv, stdin=None, stdout=subprocess.PIPE, shell=False, close_fds=True, preexec_fn=os.setpgrp)
+
+    except Exception as err:
+        command.error = str(err)
+        return
+
+    timer = threading.Timer(command.timeout, kill_command, [command, proc])
+    timer.start()
+
+    try:
+        command.consumer(proc.stdout)
+
+    except Exception as err:
+        command.error = str(err)
+
+        # Don't leave the command blocked on a pipe nobody is reading
+        kill_command(command, proc)
+        command.timed_out = False
+
+    finally:
+        status = proc.wait()
+        timer.cancel()
+        timer.join()
+
+    command.status = status
+
+    if command.timed_out:
+        command.error = os.path.basename(command.argv[0]) + " timed out after " + str(command.timeout) + " seconds"
+
+    elif command.error is None and status != 0:
+        command.error = os.path.basename(command.argv[0]) + " exited with a status of " + str(status)
+
+
+
+# Fetch the full definition of only those policies whose generation changed since the last run
+# The cheap name/generation listing is ran first as a normal command, then "bppllist <policy> -L"
+# is ran for each new or changed policy by a pool of options.fetch_workers threads
+# A policy removed between the listing and its fetch is left out as if it was never listed
+def run_incremental_policy_fetch(master, command):
+    policies = master.policies
+
+    run_command(command)
+
+    if command.error is not None:
+        return
+
+    fetch_queue = Queue.Queue()
+
+    for policy, generation in policies["current_generations"].items():
+        # Unchanged policies keep the definition we already have
+        if policies["last_generations"].get(policy) == generation and policy in policies["last_digests"]:
             policies["current_list"].append(policy)
-        
-            # Move current to last and create the policy object
-            policy_obj = policy_class()
-            policy_obj.name = policy
-            policy_obj.current_data = []
-            try:
-                if policies[policy_obj.name]:
-                    policy_obj.last_data = policies[policy_obj.name].current_data[:]
-            except KeyError:
-                policy_obj.last_data = []
-                
-            policies[policy_obj.name] = policy_obj
-            
-        # We hit a config line
+            policies["current_digests"][policy] = policies["last_digests"][policy]
+
         else:
-            policies[policy_obj.name].current_data.append(line + "\n")
-            
-            
-except Exception as err:
-    sys.stderr.write("Failed to get the current list of policies: " + str(err) + " - EXITING\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get current list of policies - EXITING")
-    
-    sys.exit(1)
+            fetch_command = command_class()
+            fetch_command.argv = admin_command(master, "bppllist", policy, "-L")
+            fetch_command.timeout = command.timeout
+            fetch_command.consumer = functools.partial(consume_policies, master)
+
+            fetch_queue.put(fetch_command)
+
+    fetch_count = fetch_queue.qsize()
+    fetch_errors = []
+
+    def fetch_worker():
+        while True:
+            try:
+                fetch_command = fetch_queue.get_nowait()
+
+            except Queue.Empty:
+                return
+
+            run_command(fetch_command)
+
+            if not fetch_command.timed_out and fetch_command.status == policy_not_found_status:
+                policies["current_generations"].pop(fetch_command.argv[1], None)
+
+            elif fetch_command.error is not None:
+                fetch_errors.append(fetch_command.argv[1] + ": " + fetch_command.error)
+
+    workers = []
+    for i in range(min(options.fetch_workers, fetch_count)):
+        worker = threading.Thread(target=fetch_worker)
+        worker.daemon = True
+        worker.start()
+
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    if len(fetch_errors) > 0:
+        command.error = str(len(fetch_errors)) + " of " + str(fetch_count) + " policy fetches failed, first failure was " + fetch_errors[0]
+
+
+
+# Collect the current data from a master and compare it to the last run
+# Sets master.error to a description of what went wrong or leaves it as None
+def collect_master(master):
+    clients = master.clients
+    policies = master.policies
+    schedules = master.schedules
+
+    # Get the previous data
+    try:
+        master.db = open_state(master.state_file)
+
+        if master.state_file == state_dir + "/state.db":
+            import_pickles(master)
+
+        master.last_run = find_run(master.db)
+
+    except Exception as err:
+        master.error = "Failed to open the state store " + master.state_file + ": " + str(err)
+        return
+
+    # Move current to last
+    if master.last_run is not None:
+        clients["last_list"] = load_state(master.db, "client", master.last_run[0]).keys()
+
+        for (name, (digest, generation)) in load_state(master.db, "policy", master.last_run[0]).items():
+            policies["last_digests"][name] = digest
+
+            if generation is not None:
+                policies["last_generations"][name] = generation
+
+        for (name, (digest, generation)) in load_state(master.db, "schedule", master.last_run[0]).items():
+            schedules["last_digests"][name] = digest
+
+    else:
+        sys.stderr.write("WARNING: Previous data for " + master.name + " not found, moving on anyway\n")
+
+
+
+    # The commands are independent so run them all at once, the run takes as long as the slowest one
+    commands = []
+
+    if options.incremental:
+        policies_command = ("policies", admin_command(master, "bppllist", "-allpolicies", "-l"), options.policies_timeout, consume_policy_generations, functools.partial(run_incremental_policy_fetch, master))
+
+    else:
+        policies_command = ("policies", admin_command(master, "bppllist", "-allpolicies", "-L"), options.policies_timeout, consume_policies, run_command)
+
+    for (description, argv, timeout, consumer, runner) in [
+        ("clients", admin_command(master, "bpplclients"), options.clients_timeout, consume_clients, run_command),
+        policies_command,
+        ("schedules", admin_command(master, "bpschedule", "-L"), options.schedules_timeout, consume_schedules, run_command),
+    ]:
+        command = command_class()
+        command.description = description
+        command.argv = argv
+        command.timeout = timeout
+        command.consumer = functools.partial(consumer, master)
+        command.thread = threading.Thread(target=runner, args=(command,))
+        command.thread.daemon = True
+        command.thread.start()
+
+        commands.append(command)
+
+    errors = []
+    for command in commands:
+        command.thread.join()
+
+        if command.error is not None:
+            errors.append("Failed to get the current list of " + command.description + ": " + command.error)
+
+    if len(errors) > 0:
+        master.error = ", ".join(errors)
+        return
+
 
 
+    # Compare the client lists   
+    clients["new_list"] = sorted(set(clients["current_list"]) - set(clients["last_list"]))
+    clients["removed_list"] = sorted(set(clients["last_list"]) - set(clients["current_list"]))
 
-# Compare the policy lists   
-policies["new_list"] = [i for i in policies["current_list"] if i not in policies["last_list"]]
-policies["removed_list"] = [i for i in policies["last_list"] if i not in policies["current_list"]]
+    # Compare the policy lists   
+    (policies["new_list"], policies["removed_list"], policies["changed_list"]) = compare_digests(policies["last_digests"], policies["current_digests"])
+
+    # Compare the schedule lists   
+    (schedules["new_list"], schedules["removed_list"], schedules["changed_list"]) = compare_digests(schedules["last_digests"], schedules["current_digests"])
 
 
 
 
 
 #
-# Schedules
+# Masters
 #
 
-# Get the current list of schedules
-current_schedules = []
-try:
-    schedules_proc = subprocess.Popen(["/usr/openv/netbackup/bin/admincmd/bpschedule", "-L"], stdin=None, stdout=subprocess.PIPE, shell=False)
-    out = schedules_proc.communicate()[0]
-    
-    for line in out.split(os.linesep):
-        line = line.rstrip()
-        
-        if re.match("^$", line): continue
-        
-        match = re.match("^Schedule:\s+(.*)$", line)
+# Without --master the local master is used and its state is kept directly in the state directory
+masters = []
 
-        # We hit a new schedule
-        if match:
-            schedule = match.group(1)
-            
-            schedules["current_list"].append(schedule)
-        
-            # Move current to last and create the schedule object
-            schedule_obj = schedule_class()
-            schedule_obj.name = schedule
-            schedule_obj.current_data = []
+if len(options.masters) == 0:
+    masters.append(new_master(os.uname()[1], admincmd_dir, False, state_dir + "/state.db"))
+
+for master_spec in options.masters:
+    if "=" in master_spec:
+        (name, admincmd) = master_spec.split("=", 1)
+        master = new_master(name, admincmd, False, state_dir + "/" + name + "/state.db")
+
+    else:
+        master = new_master(master_spec, admincmd_dir, True, state_dir + "/" + master_spec + "/state.db")
+
+    if not os.path.isdir(os.path.dirname(master.state_file)):
+        try:
+            os.mkdir(os.path.dirname(master.state_file), 0755)
+
+        except Exception as err:
+            sys.stderr.write("Failed to create directory " + os.path.dirname(master.state_file) + ": " + str(err) + " - EXITING\n")
+            #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to create directory " + os.path.dirname(master.state_file) + " - EXITING")
+
+            sys.exit(1)
+
+    masters.append(master)
+
+
+
+
+
+#
+# Answer questions about past runs without going to NetBackup
+#
+
+index_queries = [(kind, pattern) for (kind, pattern) in [("client", options.which_client), ("include", options.which_include), ("schedule", options.which_schedule)] if pattern is not None]
+
+if options.list_runs or options.diff_runs is not None or options.since is not None or len(index_queries) > 0:
+    since_time = None
+    if options.since is not None:
+        for time_format in ["%Y-%m-%d %H:%M", "%Y-%m-%d"]:
             try:
-                if schedules[schedule_obj.name]:
-                    schedule_obj.last_data = schedules[schedule_obj.name].current_data[:]
-            except KeyError:
-                schedule_obj.last_data = []
-                
-            schedules[schedule_obj.name] = schedule_obj
-            
-        # We hit a config line
+                since_time = int(time.mktime(time.strptime(options.since, time_format)))
+                break
+
+            except ValueError:
+                pass
+
+        if since_time is None:
+            sys.stderr.write("Unable to understand the time given to --since: " + options.since + " - EXITING\n")
+            sys.exit(1)
+
+    failed = False
+    for master in masters:
+        if master is not masters[0]:
+            sys.stdout.write("\n\n\n")
+
+        try:
+            master.db = open_state(master.state_file)
+
+            if master.state_file == state_dir + "/state.db":
+                import_pickles(master)
+
+        except Exception as err:
+            sys.stderr.write("Failed to open the state store " + master.state_file + ": " + str(err) + "\n")
+            failed = True
+            continue
+
+        if options.list_runs:
+            sys.stdout.write("Server: " + master.name + "\n")
+
+            for (run_id, run_time) in master.db.execute("SELECT run_id, run_time FROM runs ORDER BY run_id"):
+                change_count = master.db.execute("SELECT COUNT(*) FROM records WHERE run_id = ?", (run_id,)).fetchone()[0]
+
+                sys.stdout.write(str(run_id) + "\t" + datetime.datetime.fromtimestamp(run_time).strftime("%Y-%m-%d at %T") + "\t" + str(change_count) + " changes\n")
+
+            continue
+
+        latest_run = find_run(master.db)
+
+        if latest_run is None:
+            sys.stderr.write("No runs are held in the state store " + master.state_file + "\n")
+            failed = True
+            continue
+
+        if len(index_queries) > 0:
+            sys.stdout.write("Server: " + master.name + "\n")
+
+            for (kind, pattern) in index_queries:
+                policies = query_index(master, kind, pattern)
+
+                if len(index_queries) > 1:
+                    sys.stdout.write("Policies with " + kind + " " + pattern + ":\n")
+
+                if len(policies) == 0:
+                    sys.stdout.write("No policies found with " + kind + " " + pattern + "\n")
+
+                for policy in policies:
+                    sys.stdout.write(policy + "\n")
+
+            continue
+
+        if options.diff_runs is not None:
+            runs = []
+            for run_id in options.diff_runs:
+                run = master.db.execute("SELECT run_id, run_time FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+
+                if run is None:
+                    sys.stderr.write("Run " + str(run_id) + " is not held in the state store " + master.state_file + ", see --list-runs\n")
+                    break
+
+                runs.append(run)
+
+            if len(runs) != 2:
+                failed = True
+                continue
+
+            (first_run, second_run) = runs
+
         else:
-            schedules[schedule_obj.name].current_data.append(line + "\n")
-        
-        
-except Exception as err:
-    sys.stderr.write("Failed to get the current list of schedules: " + str(err) + " - EXITING\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get current list of schedules - EXITING")
-    
-    sys.exit(1)
+            # Before the first run nothing existed
+            first_run = find_run(master.db, since_time) or (0, None)
+            second_run = latest_run
 
+        write_report(compare_runs(master, first_run[0], second_run[0]), second_run[1], first_run[1])
 
+    if failed:
+        sys.exit(1)
 
-# Compare the schedule lists   
-schedules["new_list"] = [i for i in schedules["current_list"] if i not in schedules["last_list"]]
-schedules["removed_list"] = [i for i in schedules["last_list"] if i not in schedules["current_list"]]
+    sys.exit(0)
 
 
 
 
 
-        
-        
 #
-# Final output
+# Collect the current data from every master at once, the run takes as long as the slowest master
 #
-        
-sys.stdout.write("Server: " + os.uname()[1] + "\n")
-sys.stdout.write("Date: " + datetime.datetime.today().strftime("%Y-%m-%d at %T") + "\n")
-if os.path.exists("/usr/local/nb_policy_reporter/policies.pkl"):
-    sys.stdout.write("Differences since: " + datetime.datetime.fromtimestamp(os.stat("/usr/local/nb_policy_reporter/policies.pkl")[8]).strftime("%Y-%m-%d at %T") + "\n\n")
-else:
-    sys.stdout.write("Differences since: The beginning of time\n\n")
 
+for master in masters:
+    master.thread = threading.Thread(target=collect_master, args=(master,))
+    master.thread.daemon = True
+    master.thread.start()
+
+failed = False
+for master in masters:
+    master.thread.join()
+
+    if master.error is not None:
+        sys.stderr.write("Failed to collect the current data from " + master.name + ": " + master.error + "\n")
+        #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to collect the current data from " + master.name)
+
+        failed = True
+
+if failed and len(masters) == 1:
+    sys.stderr.write("Unable to collect the current data - EXITING\n")
+    sys.exit(1)
+
+end_phase("collect")
 
-# Counts
-sys.stdout.write("New clients: " + str(len(clients["new_list"])) + "\n")
-sys.stdout.write("Removed clients: " + str(len(clients["removed_list"])) + "\n")
 
-sys.stdout.write("New policies: " + str(len(policies["new_list"])) + "\n")
-sys.stdout.write("Removed policies: " + str(len(policies["removed_list"])) + "\n")
 
-sys.stdout.write("New schedules: " + str(len(schedules["new_list"])) + "\n")
-sys.stdout.write("Removed schedules: " + str(len(schedules["removed_list"])) + "\n")
 
 
-# Change list
-if len(clients["new_list"]) > 0:
-    sys.stdout.write("\nNew clients:\n")
-    for client in sorted(clients["new_list"]):
-        sys.stdout.write(client + "\n")
-        
-if len(clients["removed_list"]) > 0:
-    sys.stdout.write("\nRemoved clients:\n")
-    for client in sorted(clients["removed_list"]):
-        sys.stdout.write(client + "\n")
-        
         
-if len(policies["new_list"]) > 0:
-    sys.stdout.write("\nNew policies:\n")
-    for policy in sorted(policies["new_list"]):
-        sys.stdout.write(policy + "\n")
         
-if len(policies["removed_list"]) > 0:
-    sys.stdout.write("\nRemoved policies:\n")
-    for policy in sorted(policies["removed_list"]):
-        sys.stdout.write(policy + "\n")
-    
+#
+# Final output
+#
 
-if len(schedules["new_list"]) > 0:
-    sys.stdout.write("\nNew schedules:\n")
-    for schedule in sorted(schedules["new_list"]):
-        sys.stdout.write(schedule + "\n")
-        
-if len(schedules["removed_list"]) > 0:
-    sys.stdout.write("\nRemoved schedules:\n")
-    for schedule in sorted(schedules["removed_list"]):
-        sys.stdout.write(schedule + "\n")
-    
-    
-    
-# Compare the current and last version of each policy
-for policy in sorted(policies["current_list"]):
-    # Skip new policies
-    if policy in policies["new_list"]:
+# One report covering every master, masters we could not collect from are listed at the end
+run_time = int(time.time())
+
+first = True
+for master in masters:
+    if master.error is not None:
         continue
-    
-    # Are the current policy and the old policy different?
-    if len(set(policies[policy].current_data).difference(policies[policy].last_data)) is not 0:
-        diff = list(difflib.unified_diff(policies[policy].last_data, policies[policy].current_data, n=0))
-        
-        # Remove junk I don't want
-        del diff[0]
-        del diff[0]
-        pretty_diff = []
-        for line in diff:
-            if not re.search("^@@", line) and not re.search("^.Generation", line):
-                pretty_diff.append(line)
-        
-        sys.stdout.write("\n\nChanges in policy " + policy + ":\n" + "".join(pretty_diff))
 
-        
-        
-# Compare the current and last version of each schedule
-for schedule in sorted(schedules["current_list"]):
-    # Skip new schedules
-    if schedule in schedules["new_list"]:
+    if not first:
+        sys.stdout.write("\n\n\n")
+
+    write_report(master, run_time, master.last_run[1] if master.last_run is not None else None)
+
+    first = False
+
+for master in masters:
+    if master.error is None:
         continue
-    
-    # Are the current schedule and the old schedule different?
-    if len(set(schedules[schedule].current_data).difference(schedules[schedule].last_data)) is not 0:
-        diff = list(difflib.unified_diff(schedules[schedule].last_data, schedules[schedule].current_data, n=0))
-        
-        # Remove junk I don't want
-        del diff[0]
-        del diff[0]
-        pretty_diff = []
-        for line in diff:
-            if not re.search("^@@", line):
-                pretty_diff.append(line)
-        
-        sys.stdout.write("\n\nChanges in schedule " + schedule + ":\n" + "".join(pretty_diff))
+
+    if not first:
+        sys.stdout.write("\n\n\n")
+
+    sys.stdout.write("Server: " + master.name + "\n")
+    sys.stdout.write("Failed to collect the current data: " + master.error + "\n")
+
+    first = False
+
+end_phase("report")
     
     
     
@@ -427,87 +1244,30 @@ for schedule in sorted(schedules["current_list"]):
 # Save the current data
 #
 
-# Clients
-try:
-    # Remove the old pickle
-    try:
-        os.unlink("/usr/local/nb_policy_reporter/clients.pkl-old")
-    
-    except:
-        pass
-    
-    try:
-        os.rename("/usr/local/nb_policy_reporter/clients.pkl", "/usr/local/nb_policy_reporter/clients.pkl-old")
-        
-    except:
-        pass
-    
-    pickle_handle = open("/usr/local/nb_policy_reporter/clients.pkl", "w")
-    
-    pickle.dump(clients, pickle_handle)
-    
-    pickle_handle.close()
-
+for master in masters:
+    if master.error is not None:
+        continue
 
-except Exception as err:
-    sys.stderr.write("Failed to get the save the current data for clients: " + str(err) + "\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get the save the current data for clients: " + str(err))
-    
-    
-    
-# Schedules
-try:
-    # Remove the old pickle
-    try:
-        os.unlink("/usr/local/nb_policy_reporter/schedules.pkl-old")
-        
-    except:
-        pass
-    
     try:
-        os.rename("/usr/local/nb_policy_reporter/schedules.pkl", "/usr/local/nb_policy_reporter/schedules.pkl-old")
-        
-    except:
-        pass
-    
-    pickle_handle = open("/usr/local/nb_policy_reporter/schedules.pkl", "w")
-    
-    pickle.dump(schedules, pickle_handle)
-    
-    pickle_handle.close()
+        save_run(master, run_time)
 
+        master.db.close()
 
-except Exception as err:
-    sys.stderr.write("Failed to get the save the current data for schedules: " + str(err) + "\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get the save the current data for schedules: " + str(err))
-    
-    
+    except Exception as err:
+        sys.stderr.write("Failed to save the current data to the state store " + master.state_file + ": " + str(err) + "\n")
+        #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to save the current data to the state store " + master.state_file + ": " + str(err))
+
+        failed = True
     
-# Policies
-try:
-    # Remove the old pickle
-    try:
-        os.unlink("/usr/local/nb_policy_reporter/policies.pkl-old")
-        
-    except:
-        pass
     
-    try:
-        os.rename("/usr/local/nb_policy_reporter/policies.pkl", "/usr/local/nb_policy_reporter/policies.pkl-old")
-        
-    except:
-        pass
     
-    pickle_handle = open("/usr/local/nb_policy_reporter/policies.pkl", "w")
     
-    pickle.dump(policies, pickle_handle)
     
-    pickle_handle.close()
-
+end_phase("save")
 
-except Exception as err:
-    sys.stderr.write("Failed to get the save the current data for policies: " + str(err) + "\n")
-    #syslog.syslog(syslog.LOG_ERR, "NOC-NETCOOL-TICKET: Failed to get the save the current data for policies: " + str(err))
+if options.timings:
+    for (phase, seconds, peak_rss, children_peak_rss) in phase_timings:
+        sys.stderr.write("Timing: " + phase + " took " + ("%.3f" % seconds) + " seconds, peak RSS " + str(peak_rss) + " KB, largest child peak RSS " + str(children_peak_rss) + " KB\n")
     
     
     
@@ -515,3 +1275,6 @@ except Exception as err:
     
 # Done
 syslog.closelog()
+
+if failed:
+    sys.exit(1)
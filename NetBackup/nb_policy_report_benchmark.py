@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Description: Benchmark nb_policy_report.py against stand-in NetBackup admin commands
+# Written by: Jeff White of the University of Pittsburgh (jaw171@pitt.edu)
+# Version: 1
+# Last change: Initial version
+
+# License:
+# This software is released under version three of the GNU General Public License (GPL) of the
+# Free Software Foundation (FSF), the text of which is available at http://www.fsf.org/licensing/licenses/gpl-3.0.html.
+# Use or modification of this software implies your acceptance of this license and its terms.
+# This is a free software, you are free to change and redistribute it with the terms of the GNU GPL.
+# There is NO WARRANTY, not even for FITNESS FOR A PARTICULAR USE to the extent permitted by law.
+
+
+
+import sys
+import os
+import re
+import subprocess
+import tempfile
+import shutil
+import time
+from optparse import OptionParser
+
+
+
+# How were we called?
+parser = OptionParser("%prog [options]\n" +
+    "Benchmark nb_policy_report.py against stand-in NetBackup admin commands (nb_fake_admincmd.py).\n" +
+    "Runs entirely offline.  For each scale a first run (everything is new), a full run after one round\n" +
+    "of changes and an incremental run after another round are timed, showing the time taken and the peak\n" +
+    "RSS at the end of the collect (parse), report (diff) and save phases of each."
+)
+
+parser.add_option(
+    "-p", "--policies",
+    action="store", type="string", dest="policies", default="1000,10000",
+    help="Comma separated list of policy counts to benchmark (default: %default)"
+)
+
+parser.add_option(
+    "-c", "--change-percent",
+    action="store", type="float", dest="change_percent", default=1,
+    help="Percent of policies and schedules changed between runs (default: %default)"
+)
+
+parser.add_option(
+    "-k", "--keep",
+    action="store_true", dest="keep", default=False,
+    help="Keep the temporary directory with the stand-in commands, state and reports"
+)
+
+(options, args) = parser.parse_args()
+
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+
+# Run the reporter and return [(phase, seconds, peak RSS KB, largest child peak RSS KB)] and the wall clock time
+def run_reporter(work_dir, environment, extra_args, report_file):
+    start = time.time()
+
+    with open(report_file, "w") as report_handle:
+        reporter = subprocess.Popen(
+            [sys.executable, os.path.join(script_dir, "nb_policy_report.py"), "--state-dir", os.path.join(work_dir, "state"), "-M", "benchmark=" + os.path.join(work_dir, "bin"), "--timings"] + extra_args,
+            stdin=None, stdout=report_handle, stderr=subprocess.PIPE, env=environment, shell=False
+        )
+        err = reporter.communicate()[1]
+
+    wall_time = time.time() - start
+
+    if reporter.returncode != 0:
+        sys.stderr.write(err)
+        sys.stderr.write("nb_policy_report.py exited with a status of " + str(reporter.returncode) + "\n")
+        sys.exit(1)
+
+    timings = []
+    for line in err.splitlines():
+        match = re.match("^Timing: (\S+) took (\S+) seconds, peak RSS (\d+) KB, largest child peak RSS (\d+) KB", line)
+
+        if match:
+            timings.append((match.group(1), float(match.group(2)), int(match.group(3)), int(match.group(4))))
+
+    return (timings, wall_time)
+
+
+
+work_dir = tempfile.mkdtemp(prefix="nb_policy_report_benchmark.")
+
+try:
+    subprocess.check_call([sys.executable, os.path.join(script_dir, "nb_fake_admincmd.py"), "--install", os.path.join(work_dir, "bin")])
+    os.mkdir(os.path.join(work_dir, "state"))
+
+    sys.stdout.write("%-9s %-12s %8s   %-26s %-26s %-26s\n" % ("policies", "run", "wall s", "collect s / RSS MB", "report s / RSS MB", "save s / RSS MB"))
+
+    for policy_count in [int(count) for count in options.policies.split(",")]:
+        shutil.rmtree(os.path.join(work_dir, "state"))
+        os.mkdir(os.path.join(work_dir, "state"))
+
+        for (run_number, description, extra_args) in [
+            (0, "first", []),
+            (1, "changed", []),
+            (2, "incremental", ["--incremental"]),
+        ]:
+            environment = dict(os.environ)
+            environment["NB_FAKE_POLICIES"] = str(policy_count)
+            environment["NB_FAKE_SCHEDULES"] = str(max(50, policy_count / 20))
+            environment["NB_FAKE_RUN"] = str(run_number)
+            environment["NB_FAKE_CHANGE_PERCENT"] = str(options.change_percent)
+
+            report_file = os.path.join(work_dir, "report-" + str(policy_count) + "-" + description + ".txt")
+
+            (timings, wall_time) = run_reporter(work_dir, environment, extra_args, report_file)
+
+            columns = []
+            for (phase, seconds, peak_rss, children_peak_rss) in timings:
+                columns.append("%8.3f / %6.1f" % (seconds, peak_rss / 1024.0))
+
+            sys.stdout.write("%-9d %-12s %8.3f   %s\n" % (policy_count, description, wall_time, "   ".join("%-23s" % column for column in columns)))
+
+    if options.keep:
+        sys.stdout.write("\nStand-in commands, state and reports kept in " + work_dir + "\n")
+
+finally:
+    if not options.keep:
+        shutil.rmtree(work_dir)